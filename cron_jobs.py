@@ -1,10 +1,16 @@
 import logging
+import time
 from collections import defaultdict
+from typing import Dict, List, Optional, Set
 
-from telegram import Bot, ParseMode
+from telegram import ParseMode
+from telegram.utils import helpers
 
+from deluge_cluster import DelugeCluster
 from deluge_service import DelugeService
-from repository import TorrentStatus, Repository, COMMON_FOR_ALL_TG_USER_ID
+from repository import Repository
+from telegram_sender import TelegramSender
+from torrent_status_notifier import TorrentStatusNotifier
 
 
 class CronJob:
@@ -29,38 +35,56 @@ class DeleteExpiredCacheJob(CronJob):
     def run(self):
         delete_lines = self._repository.delete_expired_cache()
         logging.debug(f'deleted expired cache rows {delete_lines}')
+        delete_files = self._repository.delete_expired_torrent_files()
+        logging.debug(f'deleted expired torrent files {delete_files}')
 
 
 class NotDownloadedTorrentsStatusCheckJob(CronJob):
     _CHECK_DOWNLOADED_TORRENT_INTERVAL_SECONDS = 60
     _TORRENT_CHECK_NO_DATA_RETRY = defaultdict(lambda: 0)
+    # max torrent ids per one 'core.get_torrents_status' call
+    _STATUS_BATCH_SIZE = 500
 
-    def __init__(self, repository: Repository, bot: Bot, deluge_service: DelugeService):
+    def __init__(self, repository: Repository, telegram_sender: TelegramSender, deluge_service: DelugeCluster,
+                 interval_seconds: int = _CHECK_DOWNLOADED_TORRENT_INTERVAL_SECONDS):
         super().__init__()
         self._repository = repository
-        self._bot = bot
         self._deluge_service = deluge_service
+        self._notifier = TorrentStatusNotifier(repository, telegram_sender)
+        self._interval_seconds = interval_seconds
 
     def interval_seconds(self) -> int:
-        return self._CHECK_DOWNLOADED_TORRENT_INTERVAL_SECONDS
+        return self._interval_seconds
 
     def run(self):
-        for s in self._repository.not_downloaded_torrents():
+        not_downloaded_torrents = self._repository.not_downloaded_torrents()
+        torrent_ids = [s['deluge_torrent_id'] for s in not_downloaded_torrents]
+        torrents_by_id = dict()
+        unavailable_torrent_ids = set()
+        for i in range(0, len(torrent_ids), self._STATUS_BATCH_SIZE):
+            torrents, unavailable = self._deluge_service.torrents_status_and_unavailable(
+                torrent_ids[i:i + self._STATUS_BATCH_SIZE])
+            for t in torrents:
+                torrents_by_id[t['_id']] = t
+            unavailable_torrent_ids |= unavailable
+        # all status updates of the tick are one transaction with write-behind
+        with self._repository.batch():
+            self._apply(not_downloaded_torrents, torrents_by_id, unavailable_torrent_ids)
+
+    def _apply(self, not_downloaded_torrents, torrents_by_id: dict, unavailable_torrent_ids: Set[str]):
+        self._repository.update_metadata(list(torrents_by_id.values()))
+
+        for s in not_downloaded_torrents:
             telegram_user_id = s['tg_user_id']
             deluge_torrent_id = s['deluge_torrent_id']
             old_status = s['deluge_torrent_status']
-            ts = self._deluge_service.torrent_status(deluge_torrent_id)
+            ts = torrents_by_id.get(deluge_torrent_id)
             if ts and ts['name']:
-                torrent_name = ts['name']
-                deluge_state = ts['state']
-
-                if str(deluge_state) == TorrentStatus.DOWNLOADED.value:
-                    if telegram_user_id != COMMON_FOR_ALL_TG_USER_ID:
-                        self._bot.send_message(chat_id=telegram_user_id, text=f"Download `{torrent_name}` completed",
-                                               parse_mode=ParseMode.MARKDOWN)
-                    self._repository.update_status(deluge_torrent_id, TorrentStatus.DOWNLOADED)
-                if str(deluge_state) == TorrentStatus.DOWNLOADING.value:
-                    self._repository.update_status(deluge_torrent_id, TorrentStatus.DOWNLOADING)
+                self._notifier.apply(telegram_user_id, deluge_torrent_id, ts['name'], ts['state'],
+                                     sort_time=ts['completed_time'] or ts['time_added'])
+            elif deluge_torrent_id in unavailable_torrent_ids:
+                # the daemon of the torrent is down, no data doesn't mean the torrent is deleted
+                logging.warning(f"Skipping check status for {deluge_torrent_id}. Deluge daemon is not available.")
             else:
                 logging.warning(f"Skipping check status for {deluge_torrent_id}. No data.")
                 if NotDownloadedTorrentsStatusCheckJob._TORRENT_CHECK_NO_DATA_RETRY[deluge_torrent_id] > 3:
@@ -73,18 +97,119 @@ class NotDownloadedTorrentsStatusCheckJob(CronJob):
 
 class ScanCommonTorrents(CronJob):
     _CHECK_COMMON_TORRENTS_INTERVAL_SECONDS = 60
+    # torrents labeled long after adding are older than the watermark, a periodic full scan picks them up
+    _FULL_SCAN_EVERY_RUNS = 60
 
     def __init__(self, repository: Repository, deluge_service: DelugeService):
         super().__init__()
         self._repository = repository
         self._deluge_service = deluge_service
+        self._time_added_watermark = 0
+        self._runs = 0
 
     def interval_seconds(self) -> int:
         return self._CHECK_COMMON_TORRENTS_INTERVAL_SECONDS
 
     def run(self):
-        labeled_torrents = self._deluge_service.labeled_torrents()
-        for labeled_torrent in labeled_torrents:
-            torrent_id = labeled_torrent['_id']
-            if not self._repository.torrent_exist_by_deluge_id(torrent_id):
-                self._repository.create_common_torrent(torrent_id)
+        full_scan = self._runs % self._FULL_SCAN_EVERY_RUNS == 0
+        self._runs += 1
+        labeled_torrents = self._deluge_service.labeled_torrents(fields=['time_added'])
+        watermark = 0 if full_scan else self._time_added_watermark
+        new_torrents = [t for t in labeled_torrents if t['time_added'] > watermark]
+        if new_torrents:
+            known_torrent_ids = self._repository.all_deluge_torrent_ids()
+            missing_torrents = [(t['_id'], t['time_added'], t.get('_daemon')) for t in new_torrents
+                                if t['_id'] not in known_torrent_ids]
+            if missing_torrents:
+                created = self._repository.create_common_torrents(missing_torrents)
+                logging.debug(f'created common torrents {created}')
+            self._time_added_watermark = max(self._time_added_watermark,
+                                             max(t['time_added'] for t in new_torrents))
+
+
+class _FreeSpaceSample:
+
+    def __init__(self):
+        self.free_space_bytes: Optional[int] = None
+        self.sample_time: Optional[float] = None
+        self.consumption_bytes_per_second = 0.0
+        self.next_alert_time = 0.0
+
+
+class FreeSpaceSampleJob(CronJob):
+    """
+    Samples free space of every deluge daemon in the background, the add path reads the cached value
+    instead of the rpc call. Daemons which are down are reconnected here too, before sampling.
+
+    Free space of a daemon minus bytes left to download by its torrents is its projected free space.
+    When it is under the threshold users are warned at most once per `alert_interval_seconds` per daemon,
+    a full daemon is reported even if others have space.
+    """
+    _SAMPLE_INTERVAL_SECONDS = 60
+    _ALERT_INTERVAL_SECONDS = 60 * 60
+    # weight of the last sample in the smoothed disk consumption rate
+    _RATE_SMOOTHING = 0.3
+
+    def __init__(self, deluge_service: DelugeCluster, telegram_sender: TelegramSender, tg_user_ids: List[int],
+                 threshold_bytes: int, interval_seconds: int = _SAMPLE_INTERVAL_SECONDS,
+                 alert_interval_seconds: int = _ALERT_INTERVAL_SECONDS):
+        super().__init__()
+        self._deluge_service = deluge_service
+        self._telegram_sender = telegram_sender
+        self._tg_user_ids = tg_user_ids
+        self._threshold_bytes = threshold_bytes
+        self._interval_seconds = interval_seconds
+        self._alert_interval_seconds = alert_interval_seconds
+        self._samples: Dict[str, _FreeSpaceSample] = dict()
+
+    def interval_seconds(self) -> int:
+        return self._interval_seconds
+
+    def free_space_bytes(self, daemon: Optional[str] = None) -> Optional[int]:
+        """
+        Free space of the daemon in the last sample, the smallest of all daemons when the daemon is not given
+        or not sampled. None until the first run.
+        """
+        sample = self._samples.get(daemon)
+        if sample is not None:
+            return sample.free_space_bytes
+        free_spaces = [s.free_space_bytes for s in list(self._samples.values())]
+        return min(free_spaces) if free_spaces else None
+
+    def run(self):
+        self._deluge_service.reconnect_if_need()
+        free_space_by_daemon = self._deluge_service.free_space_bytes_by_daemon()
+        pending_by_daemon = self._deluge_service.pending_download_bytes_by_daemon()
+        for daemon, free_space_bytes in free_space_by_daemon.items():
+            self._sample(daemon, free_space_bytes, pending_by_daemon.get(daemon, 0))
+
+    def _sample(self, daemon: str, free_space_bytes: int, pending_bytes: int):
+        sample = self._samples.get(daemon) or _FreeSpaceSample()
+        now = time.monotonic()
+        if sample.sample_time is not None and now > sample.sample_time:
+            rate = max(sample.free_space_bytes - free_space_bytes, 0) / (now - sample.sample_time)
+            sample.consumption_bytes_per_second += self._RATE_SMOOTHING * (rate - sample.consumption_bytes_per_second)
+        sample.free_space_bytes = free_space_bytes
+        sample.sample_time = now
+        self._samples[daemon] = sample
+
+        projected_free_space_bytes = free_space_bytes - pending_bytes
+        logging.debug(f'deluge {daemon} free space {free_space_bytes}, pending downloads {pending_bytes}, '
+                      f'consumption {sample.consumption_bytes_per_second:.0f} bytes/s')
+        if projected_free_space_bytes < self._threshold_bytes and now >= sample.next_alert_time:
+            sample.next_alert_time = now + self._alert_interval_seconds
+            self._alert(daemon, sample, pending_bytes)
+
+    def _alert(self, daemon: str, sample: _FreeSpaceSample, pending_bytes: int):
+        import humanize
+        from emoji import emojize
+        warning_emoji = emojize(':heavy_exclamation_mark:', use_aliases=True)
+        device = f"device of deluge {daemon}" if len(self._deluge_service.daemons()) > 1 else "device"
+        text = (f"{warning_emoji}Warning, on {device} has left {humanize.naturalsize(sample.free_space_bytes)}, "
+                f"downloads in progress need {humanize.naturalsize(pending_bytes)} more")
+        if sample.consumption_bytes_per_second > 0 and sample.free_space_bytes > self._threshold_bytes:
+            seconds_left = (sample.free_space_bytes - self._threshold_bytes) / sample.consumption_bytes_per_second
+            text += f". Free space falls under the limit in about {humanize.naturaldelta(seconds_left)}"
+        for tg_user_id in self._tg_user_ids:
+            self._telegram_sender.send_message(chat_id=tg_user_id, text=helpers.escape_markdown(text, version=2),
+                                               parse_mode=ParseMode.MARKDOWN_V2)
@@ -0,0 +1,325 @@
+import configparser
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Set, Tuple, TypeVar, Union
+
+from deluge_service import DelugeService
+from metrics import with_request_timing
+
+T = TypeVar('T')
+
+PLACEMENT_FREE_SPACE = 'free_space'
+PLACEMENT_ACTIVE_TORRENTS = 'active_torrents'
+
+
+def daemon_configs(config: configparser.ConfigParser) -> Dict[str, configparser.ConfigParser]:
+    """
+    Config of every daemon by its name, from `[deluge:<name>]` sections on top of the common `[deluge]` one.
+
+    Without `[deluge:*]` sections the single `[deluge]` daemon is named 'default'.
+    """
+    names = [s.split(':', 1)[1] for s in config.sections() if s.startswith('deluge:')]
+    if not names:
+        return {'default': config}
+    common = dict(config['deluge']) if config.has_section('deluge') else dict()
+    configs = dict()
+    for name in names:
+        daemon_config = configparser.ConfigParser()
+        daemon_config.read_dict({'deluge': {**common, **dict(config[f'deluge:{name}'])}})
+        configs[name] = daemon_config
+    return configs
+
+
+class DelugeCluster:
+    """
+    DelugeService over one or several deluge daemons.
+
+    New torrents are placed on the daemon with the most free space in the last sample, or with the fewest
+    active torrents, calls about a torrent go to its daemon, and list calls fan out to all daemons in parallel.
+    A daemon which fails to answer is skipped the same way whether there is one daemon or several.
+    The daemon of a torrent is learned when it is added or first seen in a status, statuses carry it in '_daemon'.
+    """
+    # a daemon which failed to connect is retried by `reconnect_if_need` in the background, at most this often
+    _RECONNECT_INTERVAL_SECONDS = 60
+
+    def __init__(self, config: configparser.ConfigParser):
+        self._daemons: Dict[str, DelugeService] = {name: DelugeService(daemon_config)
+                                                   for name, daemon_config in daemon_configs(config).items()}
+        self._placement = config.get('deluge', 'Placement', fallback=PLACEMENT_FREE_SPACE)
+        if self._placement not in (PLACEMENT_FREE_SPACE, PLACEMENT_ACTIVE_TORRENTS):
+            raise ValueError(f"unknown deluge placement '{self._placement}'")
+        self._owners: Dict[str, str] = dict()
+        self._connected: Dict[str, bool] = {name: False for name in self._daemons}
+        self._next_connect_time: Dict[str, float] = {name: 0 for name in self._daemons}
+        # sampled by `free_space_bytes_by_daemon` in the background, placement doesn't ask daemons on every add
+        self._free_space_bytes: Dict[str, int] = dict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=len(self._daemons), thread_name_prefix="deluge-fan-out")
+
+    def daemons(self) -> Dict[str, DelugeService]:
+        return dict(self._daemons)
+
+    def connect(self):
+        """
+        Connects all daemons in parallel, fails only if none of them is reachable.
+        """
+        results = self._fan_out(lambda name, daemon: daemon.connect())
+        with self._lock:
+            for name in self._daemons:
+                if name in results:
+                    self._connected[name] = True
+                else:
+                    self._next_connect_time[name] = time.monotonic() + self._RECONNECT_INTERVAL_SECONDS
+        if not results:
+            raise ConnectionError(f"none of deluge daemons {list(self._daemons)} is reachable")
+        for name in self._daemons:
+            if name not in results:
+                logging.warning(f"Deluge daemon {name} is not connected, new torrents are placed on others")
+
+    def set_owners(self, owners: Dict[str, str]):
+        """
+        Known daemons of torrents, e.g. stored in the repository, unknown daemon names are ignored.
+        """
+        with self._lock:
+            self._owners.update({t: d for t, d in owners.items() if d in self._daemons})
+
+    def daemon_of(self, torrent_id: str) -> Optional[str]:
+        with self._lock:
+            return self._owners.get(torrent_id)
+
+    def add_torrent_magnet(self, magnet_url: str) -> str:
+        name = self._place(1)[0]
+        return self._record(name, self._daemons[name].add_torrent_magnet(magnet_url))
+
+    def add_torrent_file(self, file_name: str, file_base64: Union[str, bytes]) -> str:
+        name = self._place(1)[0]
+        return self._record(name, self._daemons[name].add_torrent_file(file_name, file_base64))
+
+    def add_torrent_magnets(self, magnet_urls: List[str]) -> List[Union[str, Exception]]:
+        return self._add_torrents(magnet_urls, lambda daemon, urls: daemon.add_torrent_magnets(urls))
+
+    def add_torrent_files(self, torrent_files: List[Tuple[str, Union[str, bytes]]]) -> List[Union[str, Exception]]:
+        return self._add_torrents(torrent_files, lambda daemon, files: daemon.add_torrent_files(files))
+
+    def _add_torrents(self, items: list, add: Callable[[DelugeService, list], List[Union[str, Exception]]]) \
+            -> List[Union[str, Exception]]:
+        if not items:
+            return []
+        placement = self._place(len(items))
+        indexes_by_daemon: Dict[str, List[int]] = dict()
+        for index, name in enumerate(placement):
+            indexes_by_daemon.setdefault(name, []).append(index)
+        added = self._fan_out(lambda name, daemon: add(daemon, [items[i] for i in indexes_by_daemon[name]]),
+                              names=list(indexes_by_daemon))
+        results: List[Union[str, Exception]] = [ConnectionError("deluge daemon is not available")] * len(items)
+        for name, daemon_results in added.items():
+            for index, result in zip(indexes_by_daemon[name], daemon_results):
+                results[index] = self._record(name, result) if isinstance(result, str) else result
+        return results
+
+    def _place(self, count: int) -> List[str]:
+        """
+        Daemon names for `count` new torrents, daemons which are down are skipped until they are reconnected.
+        """
+        names = self._connected_names() or list(self._daemons)
+        if len(names) == 1:
+            return names * count
+        if self._placement == PLACEMENT_ACTIVE_TORRENTS:
+            active = self._fan_out(lambda name, daemon: daemon.active_torrents_count(), names=names)
+            if not active:
+                return [names[0]] * count
+            # every placed torrent is active too
+            placement = []
+            for _ in range(count):
+                name = min(active, key=active.get)
+                active[name] += 1
+                placement.append(name)
+            return placement
+        with self._lock:
+            free_space = {name: self._free_space_bytes[name] for name in names if name in self._free_space_bytes}
+        return [max(free_space, key=free_space.get) if free_space else names[0]] * count
+
+    def reconnect_if_need(self):
+        """
+        Connects daemons which are down once their retry time comes. Connecting may take the whole pool backoff,
+        so it runs in a background job, never on the add path.
+        """
+        now = time.monotonic()
+        with self._lock:
+            names = [name for name in self._daemons
+                     if not self._connected[name] and now >= self._next_connect_time[name]]
+        for name in names:
+            try:
+                self._daemons[name].connect()
+            except Exception as e:
+                with self._lock:
+                    self._next_connect_time[name] = time.monotonic() + self._RECONNECT_INTERVAL_SECONDS
+                logging.warning(f"Can't connect to deluge daemon {name}. {e}")
+                continue
+            with self._lock:
+                self._connected[name] = True
+            logging.info(f"Deluge daemon {name} is connected")
+
+    def delete_torrent(self, torrent_id: str):
+        self._daemons[self._owner(torrent_id)].delete_torrent(torrent_id)
+        with self._lock:
+            self._owners.pop(torrent_id, None)
+
+    def torrent_name_by_id(self, torrent_id: str) -> str:
+        return self._daemons[self._owner(torrent_id)].torrent_name_by_id(torrent_id)
+
+    def torrent_status(self, torrent_id: str) -> Dict[str, str]:
+        name = self.daemon_of(torrent_id)
+        if name:
+            return self._daemons[name].torrent_status(torrent_id)
+        statuses = self._fan_out(lambda n, daemon: daemon.torrent_status(torrent_id))
+        for name, status in statuses.items():
+            if status:
+                self._record(name, torrent_id)
+                return status
+        return {}
+
+    def torrents_status(self, torrent_ids: List[str], fresh=False) -> List[Dict[str, str]]:
+        return self.torrents_status_and_unavailable(torrent_ids, fresh=fresh)[0]
+
+    def torrents_status_and_unavailable(self, torrent_ids: List[str], fresh=False) \
+            -> Tuple[List[Dict[str, str]], Set[str]]:
+        """
+        Statuses of the torrents and ids of the torrents without a status because their daemon failed to answer.
+        A torrent with an unknown daemon is unavailable when any daemon failed and no other one has it.
+        """
+        # ids of torrents with an unknown daemon are asked from all daemons
+        ids_by_daemon: Dict[str, List[str]] = {name: [] for name in self._daemons}
+        unknown_ids = []
+        with self._lock:
+            for torrent_id in torrent_ids:
+                name = self._owners.get(torrent_id)
+                if name:
+                    ids_by_daemon[name].append(torrent_id)
+                else:
+                    unknown_ids.append(torrent_id)
+        for ids in ids_by_daemon.values():
+            ids += unknown_ids
+        ids_by_daemon = {name: ids for name, ids in ids_by_daemon.items() if ids}
+        if not ids_by_daemon:
+            return [], set()
+        statuses = self._fan_out(lambda name, daemon: daemon.torrents_status(ids_by_daemon[name], fresh=fresh),
+                                 names=list(ids_by_daemon))
+        torrents = self._merge(statuses)
+        failed = [name for name in ids_by_daemon if name not in statuses]
+        if not failed:
+            return torrents, set()
+        found_ids = {t['_id'] for t in torrents}
+        return torrents, {torrent_id for name in failed for torrent_id in ids_by_daemon[name]
+                          if torrent_id not in found_ids}
+
+    def is_cached_torrent(self, torrent_id: str) -> bool:
+        return any(daemon.is_cached_torrent(torrent_id) for daemon in self._daemons.values())
+
+    def labeled_torrents(self, fields: List[str] = None) -> List[Dict[str, str]]:
+        return self._merge(self._fan_out(lambda name, daemon: daemon.labeled_torrents(fields=fields)))
+
+    def is_labeled_torrent(self, torrent_id: str) -> bool:
+        name = self.daemon_of(torrent_id)
+        names = [name] if name else list(self._daemons)
+        labeled = self._fan_out(lambda n, daemon: daemon.is_labeled_torrent(torrent_id), names=names)
+        for name, is_labeled in labeled.items():
+            if is_labeled:
+                self._record(name, torrent_id)
+                return True
+        return False
+
+    def stop_download_torrents(self):
+        self._fan_out(lambda name, daemon: daemon.stop_download_torrents(), raise_error=True)
+
+    def resume_download_torrents(self):
+        self._fan_out(lambda name, daemon: daemon.resume_download_torrents(), raise_error=True)
+
+    def free_space_bytes_by_daemon(self) -> Dict[str, int]:
+        """
+        Free space by daemon name, of the connected daemons which answered. The result is kept for placement,
+        a daemon which didn't answer is considered down and gets no new torrents until it is reconnected.
+        """
+        names = self._connected_names()
+        free_space = self._fan_out(lambda name, daemon: daemon.free_space_bytes(), names=names)
+        with self._lock:
+            self._free_space_bytes = dict(free_space)
+            for name in names:
+                if name not in free_space:
+                    self._connected[name] = False
+                    self._next_connect_time[name] = time.monotonic()
+        return free_space
+
+    def pending_download_bytes_by_daemon(self) -> Dict[str, int]:
+        return self._fan_out(lambda name, daemon: daemon.pending_download_bytes(), names=self._connected_names())
+
+    def status_cache_stats(self) -> dict:
+        stats = dict()
+        for daemon in self._daemons.values():
+            for key, value in daemon.status_cache_stats().items():
+                stats[key] = stats.get(key, 0) + value
+        return stats
+
+    def pool_metrics(self) -> Dict[str, dict]:
+        return {name: daemon.pool_metrics() for name, daemon in self._daemons.items()}
+
+    def disconnect(self):
+        self._executor.shutdown(wait=False)
+        for daemon in self._daemons.values():
+            daemon.disconnect()
+
+    def _connected_names(self) -> List[str]:
+        with self._lock:
+            return [name for name, connected in self._connected.items() if connected]
+
+    def _owner(self, torrent_id: str) -> str:
+        name = self.daemon_of(torrent_id)
+        if name is None and len(self._daemons) > 1:
+            self.torrent_status(torrent_id)
+            name = self.daemon_of(torrent_id)
+        # an unknown torrent is left to the first daemon to report the error
+        return name or next(iter(self._daemons))
+
+    def _record(self, name: str, torrent_id: str) -> str:
+        with self._lock:
+            self._owners[torrent_id] = name
+        return torrent_id
+
+    def _merge(self, torrents_by_daemon: Dict[str, List[Dict[str, str]]]) -> List[Dict[str, str]]:
+        torrents = []
+        with self._lock:
+            for name, daemon_torrents in torrents_by_daemon.items():
+                for t in daemon_torrents:
+                    t['_daemon'] = name
+                    self._owners[t['_id']] = name
+                    torrents.append(t)
+        return torrents
+
+    def _fan_out(self, fn: Callable[[str, DelugeService], T], names: Optional[List[str]] = None,
+                 raise_error=False) -> Dict[str, T]:
+        """
+        Calls `fn` for every daemon in parallel, returns results of daemons which did not fail.
+        With `raise_error` the first error is raised after all calls are done.
+        """
+        names = list(self._daemons) if names is None else names
+        if len(names) == 1:
+            # no thread hop for a single daemon
+            name = names[0]
+            results_by_name = {name: lambda: fn(name, self._daemons[name])}
+        else:
+            call = with_request_timing(fn)
+            futures = {name: self._executor.submit(call, name, self._daemons[name]) for name in names}
+            results_by_name = {name: future.result for name, future in futures.items()}
+        results = dict()
+        error = None
+        for name, result in results_by_name.items():
+            try:
+                results[name] = result()
+            except Exception as e:
+                error = error or e
+                logging.error(f"Deluge daemon {name} call failed. {e}")
+        if error and raise_error:
+            raise error
+        return results
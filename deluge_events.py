@@ -0,0 +1,197 @@
+import logging
+import socket
+import struct
+import threading
+import zlib
+from datetime import timedelta
+from typing import Callable, Dict
+
+from deluge_client import DelugeRPCClient
+from deluge_client.client import RPC_EVENT, DelugeClientException
+from deluge_client.rencode import loads
+
+from deluge_cluster import DelugeCluster
+from repeated_task import RepeatJob, RepeatedJobManager
+from repository import Repository, TorrentStatus
+from torrent_status_notifier import TorrentStatusNotifier
+
+_MESSAGE_HEADER_SIZE = 5
+
+
+class DelugeEventListener(threading.Thread):
+    """
+    Keeps a dedicated connection to the deluge daemon subscribed to events and dispatches them to handlers.
+
+    `deluge-client` drops events received while waiting for a rpc response, so events are read
+    on their own socket, which is never used for regular calls.
+    """
+
+    def __init__(self, client_factory: Callable[[], DelugeRPCClient],
+                 handlers: Dict[str, Callable[..., None]],
+                 reconnect_backoff_seconds: float = 1, max_reconnect_backoff_seconds: float = 60):
+        super().__init__(name="deluge-event-listener", daemon=True)
+        self._client_factory = client_factory
+        self._handlers = handlers
+        self._reconnect_backoff_seconds = reconnect_backoff_seconds
+        self._max_reconnect_backoff_seconds = max_reconnect_backoff_seconds
+        self._stop_event = threading.Event()
+        self._client = None
+        self._buffer = b''
+
+    def run(self):
+        backoff = self._reconnect_backoff_seconds
+        while not self._stop_event.is_set():
+            try:
+                self._subscribe()
+                backoff = self._reconnect_backoff_seconds
+                while not self._stop_event.is_set():
+                    event = self._read_event()
+                    if event:
+                        self._dispatch(*event)
+            except (OSError, DelugeClientException, zlib.error) as e:
+                if self._stop_event.is_set():
+                    break
+                logging.warning(f"Deluge event connection lost, reconnect in {backoff} seconds. {e}")
+                self._close()
+                self._stop_event.wait(backoff)
+                backoff = min(backoff * 2, self._max_reconnect_backoff_seconds)
+        self._close()
+
+    def stop(self):
+        self._stop_event.set()
+        self._close()
+
+    def _subscribe(self):
+        self._buffer = b''
+        self._client = self._client_factory()
+        self._client.connect()
+        # https://github.com/deluge-torrent/deluge/blob/deluge-2.0.3/deluge/core/daemon.py#L194
+        self._client.call('daemon.set_event_interest', list(self._handlers.keys()))
+        logging.info(f"Subscribed to deluge events {list(self._handlers.keys())}")
+
+    def _read_event(self):
+        try:
+            header = self._read(_MESSAGE_HEADER_SIZE)
+        except socket.timeout:
+            # no events for a while, give a chance to check the stop flag
+            return None
+        if self._client.deluge_protocol_version is None:
+            length = struct.unpack('!i', header[1:])[0]
+        else:
+            length = struct.unpack('!I', header[1:])[0]
+        message = list(loads(zlib.decompress(self._read_exactly(length)), decode_utf8=True))
+        if message[0] != RPC_EVENT:
+            return None
+        return message[1], message[2]
+
+    def _read(self, size: int) -> bytes:
+        # partial data stays in the buffer when the socket times out in the middle of a message
+        while len(self._buffer) < size:
+            chunk = self._client._socket.recv(64 * 1024)
+            if not chunk:
+                raise ConnectionResetError("deluge closed the event connection")
+            self._buffer += chunk
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def _read_exactly(self, size: int) -> bytes:
+        while True:
+            try:
+                return self._read(size)
+            except socket.timeout:
+                if self._stop_event.is_set():
+                    raise
+
+    def _dispatch(self, event_name: str, args):
+        handler = self._handlers.get(event_name)
+        if not handler:
+            return
+        try:
+            handler(*args)
+        except Exception as e:
+            logging.error(f"Deluge event {event_name}{tuple(args)} handler error. {e}")
+
+    def _close(self):
+        client, self._client = self._client, None
+        if client:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+
+
+class TorrentEventsHandler:
+    """
+    Reflects deluge torrent events in the repository right away, polling stays only as a safety net.
+    """
+    # the bot labels and stores own torrents right after adding, don't race with it
+    _ADDED_TORRENT_CHECK_DELAY = timedelta(seconds=10)
+
+    def __init__(self, repository: Repository, deluge_service: DelugeCluster, notifier: TorrentStatusNotifier,
+                 delayed_jobs: RepeatedJobManager):
+        """
+        `delayed_jobs` runs the checks of added torrents, a burst of added events queues jobs instead of threads.
+        """
+        self._repository = repository
+        self._deluge_service = deluge_service
+        self._notifier = notifier
+        self._delayed_jobs = delayed_jobs
+
+    def handlers(self) -> Dict[str, Callable[..., None]]:
+        # https://github.com/deluge-torrent/deluge/blob/deluge-2.0.3/deluge/event.py
+        return {
+            'TorrentAddedEvent': self.on_torrent_added,
+            'TorrentRemovedEvent': self.on_torrent_removed,
+            'TorrentStateChangedEvent': self.on_torrent_state_changed,
+            'TorrentFinishedEvent': self.on_torrent_finished,
+        }
+
+    def on_torrent_added(self, torrent_id: str, from_state: bool = False):
+        # torrents loaded from the daemon session state are not new, ScanCommonTorrents picks up unknown ones
+        if from_state:
+            return
+        self._delayed_jobs.schedule(RepeatJob(f"torrent_added_{torrent_id}",
+                                              lambda: self._create_common_torrent_if_need(torrent_id),
+                                              repeat_interval=self._ADDED_TORRENT_CHECK_DELAY,
+                                              repeat_count=1))
+
+    def _create_common_torrent_if_need(self, torrent_id: str):
+        try:
+            if not self._repository.torrent_exist_by_deluge_id(torrent_id) and \
+                    self._deluge_service.is_labeled_torrent(torrent_id):
+                self._repository.create_common_torrent(torrent_id,
+                                                       deluge_daemon=self._deluge_service.daemon_of(torrent_id))
+        except Exception as e:
+            logging.error(f"Can't create common torrent {torrent_id}. {e}")
+
+    def on_torrent_removed(self, torrent_id: str):
+        if not self._not_downloaded(torrent_id):
+            return
+        # the bot removes and adds a torrent again on reload, the event may come after the torrent is back
+        torrents, unavailable = self._deluge_service.torrents_status_and_unavailable([torrent_id], fresh=True)
+        if torrents or unavailable:
+            return
+        self._repository.delete_not_downloaded_torrent(torrent_id)
+
+    def on_torrent_state_changed(self, torrent_id: str, state: str):
+        self._apply(torrent_id, state)
+
+    def on_torrent_finished(self, torrent_id: str):
+        self._apply(torrent_id)
+
+    def _not_downloaded(self, torrent_id: str) -> list:
+        return [t for t in self._repository.torrents_by_deluge_id(torrent_id)
+                if t['deluge_torrent_status'] != str(TorrentStatus.DOWNLOADED)]
+
+    def _apply(self, torrent_id: str, state: str = None):
+        not_downloaded = self._not_downloaded(torrent_id)
+        if not not_downloaded:
+            return
+        # the cached status may be older than the event
+        torrents = self._deluge_service.torrents_status([torrent_id], fresh=True)
+        if not torrents or not torrents[0]['name']:
+            return
+        ts = torrents[0]
+        self._repository.update_metadata(torrents)
+        for t in not_downloaded:
+            self._notifier.apply(t['tg_user_id'], torrent_id, ts['name'], state or ts['state'])
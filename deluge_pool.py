@@ -0,0 +1,181 @@
+import logging
+import socket
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from queue import LifoQueue, Empty
+from typing import Callable, TypeVar
+
+from deluge_client import DelugeRPCClient
+from deluge_client.client import ConnectionLostException, CallTimeoutException, FailedToReconnectException, \
+    InvalidHeaderException
+
+T = TypeVar('T')
+
+# errors after which the client socket is considered broken and has to be reconnected, a bad header or body
+# means the stream is out of sync with the daemon and the next response would be read from the middle
+_CONNECTION_ERRORS = (socket.error, ConnectionLostException, CallTimeoutException, FailedToReconnectException,
+                      InvalidHeaderException, zlib.error)
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+@dataclass
+class PoolMetrics:
+    size: int = 0
+    in_use: int = 0
+    acquired: int = 0
+    wait_seconds_total: float = 0.0
+    wait_seconds_max: float = 0.0
+    reconnects: int = 0
+    connection_errors: int = 0
+    health_checks: int = 0
+    health_check_failures: int = 0
+
+
+class _PooledConnection:
+
+    def __init__(self):
+        self.client = None
+        self.connected_once = False
+        self.last_used_time = 0.0
+
+
+class DelugeClientPool:
+    """
+    Fixed size pool of DelugeRPCClient connections, safe to share between threads.
+
+    Every call borrows one client exclusively, so concurrent handlers don't interleave on one socket.
+    Clients are connected lazily and broken ones are reconnected with exponential backoff. A client idle for
+    longer than `idle_check_seconds` is probed with 'daemon.info' before use, the daemon or a firewall may
+    have dropped its socket meanwhile.
+    """
+
+    def __init__(self, client_factory: Callable[[], DelugeRPCClient], size: int = 4,
+                 acquire_timeout_seconds: float = 30, max_reconnect_attempts: int = 5,
+                 reconnect_backoff_seconds: float = 0.5, max_reconnect_backoff_seconds: float = 10,
+                 idle_check_seconds: float = 30):
+        assert size > 0, "pool size must be positive"
+        self._acquire_timeout_seconds = acquire_timeout_seconds
+        self._idle_check_seconds = idle_check_seconds
+        self._max_reconnect_attempts = max_reconnect_attempts
+        self._reconnect_backoff_seconds = reconnect_backoff_seconds
+        self._max_reconnect_backoff_seconds = max_reconnect_backoff_seconds
+        self._client_factory = client_factory
+        self._idle = LifoQueue(maxsize=size)
+        self._connections = [_PooledConnection() for _ in range(size)]
+        for connection in self._connections:
+            self._idle.put(connection)
+        self._metrics = PoolMetrics(size=size)
+        self._metrics_lock = threading.Lock()
+
+    def call(self, fn: Callable[[DelugeRPCClient], T], retry=True) -> T:
+        """
+        Run `fn` with a healthy client. On connection error the client is reconnected and `fn` retried once.
+
+        Calls which must not run twice, e.g. adding a torrent, pass `retry=False` and get the error instead:
+        the daemon may have done the call already when the connection broke or the response timed out.
+        """
+        with self._connection() as connection:
+            try:
+                return fn(connection.client)
+            except _CONNECTION_ERRORS as e:
+                logging.warning(f"Deluge connection error, reconnecting. {e}")
+                with self._metrics_lock:
+                    self._metrics.connection_errors += 1
+                self._close(connection)
+                if not retry:
+                    raise
+                self._ensure_connected(connection)
+                return fn(connection.client)
+
+    def connect(self):
+        """
+        Eagerly connect one client, to fail fast on wrong credentials.
+        """
+        with self._connection():
+            pass
+
+    def metrics(self) -> dict:
+        with self._metrics_lock:
+            return asdict(self._metrics)
+
+    def disconnect(self):
+        for connection in self._connections:
+            self._close(connection)
+
+    @contextmanager
+    def _connection(self):
+        start = time.monotonic()
+        try:
+            connection = self._idle.get(timeout=self._acquire_timeout_seconds)
+        except Empty:
+            raise PoolTimeoutError(f"no free deluge connection in {self._acquire_timeout_seconds} seconds")
+        wait_seconds = time.monotonic() - start
+        with self._metrics_lock:
+            self._metrics.in_use += 1
+            self._metrics.acquired += 1
+            self._metrics.wait_seconds_total += wait_seconds
+            self._metrics.wait_seconds_max = max(self._metrics.wait_seconds_max, wait_seconds)
+        try:
+            self._ensure_connected(connection)
+            yield connection
+        finally:
+            connection.last_used_time = time.monotonic()
+            with self._metrics_lock:
+                self._metrics.in_use -= 1
+            self._idle.put(connection)
+
+    def _ensure_connected(self, connection: _PooledConnection):
+        if connection.client is not None and connection.client.connected and self._is_alive(connection):
+            return
+        backoff = self._reconnect_backoff_seconds
+        attempt = 1
+        while True:
+            # DelugeRPCClient can't reuse a closed socket, so every connect attempt starts with a fresh client
+            connection.client = self._client_factory()
+            try:
+                connection.client.connect()
+                with self._metrics_lock:
+                    if connection.connected_once:
+                        self._metrics.reconnects += 1
+                connection.connected_once = True
+                return
+            except _CONNECTION_ERRORS as e:
+                self._close(connection)
+                if attempt >= self._max_reconnect_attempts:
+                    raise
+                logging.warning(f"Can't connect to deluge (attempt {attempt}), retry in {backoff} seconds. {e}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self._max_reconnect_backoff_seconds)
+                attempt += 1
+
+    def _is_alive(self, connection: _PooledConnection) -> bool:
+        # `connected` only tells that the login succeeded once, a recently used client is trusted
+        if time.monotonic() - connection.last_used_time < self._idle_check_seconds:
+            return True
+        with self._metrics_lock:
+            self._metrics.health_checks += 1
+        try:
+            connection.client.call('daemon.info')
+            return True
+        except _CONNECTION_ERRORS as e:
+            logging.warning(f"Idle deluge connection is dead, reconnecting. {e}")
+            with self._metrics_lock:
+                self._metrics.health_check_failures += 1
+            self._close(connection)
+            return False
+
+    @staticmethod
+    def _close(connection: _PooledConnection):
+        if connection.client is None:
+            return
+        try:
+            connection.client.disconnect()
+        except Exception:
+            pass
+        connection.client = None
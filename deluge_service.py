@@ -1,19 +1,55 @@
+import logging
+import socket
+from concurrent.futures import ThreadPoolExecutor
 from distutils.util import strtobool
-from typing import Dict, List
+from typing import Callable, Dict, List, Tuple, Union
 
 from deluge_client import DelugeRPCClient
 
+from deluge_pool import DelugeClientPool
+from metrics import DELUGE_RPC_SECONDS, with_request_timing
+from status_cache import TorrentStatusCache
+
+
+class _DelugeRPCClient(DelugeRPCClient):
+    """
+    `deluge-client` creates the socket in the constructor with the class `timeout`, and again on reconnect.
+    """
+
+    def __init__(self, *args, timeout: float, **kwargs):
+        # socket timeout, applied to every rpc call of the client
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def _create_socket(self, ssl_version=None):
+        super()._create_socket(ssl_version)
+        # deluge-client writes the header and the body of a request separately, with nagle the body waits
+        # for the delayed ack of the header, about 40ms per rpc call
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
 
 class DelugeService:
     # list of deluge fields - https://libtorrent.org/single-page-ref.html
+    _STATUS_FIELDS = ['name', 'state', 'progress', 'completed_time', 'time_added', 'total_wanted', 'total_done']
+    _TORRENT_STATUS_FIELDS = ['name', 'state']
+    _ACTIVE_STATES = ('Downloading', 'Checking')
+    # torrents which are going to write to the disk, queued ones start once a download slot is free
+    _PENDING_DOWNLOAD_STATES = _ACTIVE_STATES + ('Queued',)
 
     def __init__(self, config):
-        self._deluge_client = DelugeRPCClient(config.get('deluge', 'host'),
-                                              int(config.get('deluge', 'port')),
-                                              config.get('deluge', 'username'),
-                                              config.get('deluge', 'password'),
-                                              decode_utf8=True)
-        self._deluge_client.connect()
+        self._config = config
+        self._timeout_seconds = float(config.get('deluge', 'TimeoutSeconds', fallback='20'))
+        pool_size = int(config.get('deluge', 'PoolSize', fallback='4'))
+        self._pool = DelugeClientPool(self.create_client,
+                                      size=pool_size,
+                                      acquire_timeout_seconds=self._timeout_seconds,
+                                      idle_check_seconds=float(config.get('deluge', 'IdleCheckSeconds',
+                                                                          fallback='30')))
+        # bulk calls are pipelined over all pooled connections
+        self._bulk_executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="deluge-bulk")
+        self._status_cache = TorrentStatusCache(
+            ttl_seconds=float(config.get('deluge', 'StatusCacheTtlSeconds', fallback='2')),
+            max_size=int(config.get('deluge', 'StatusCacheMaxSize', fallback='10000')))
         self._label_enable = False
         try:
             self._label_enable = bool(strtobool(config.get('deluge', 'LabelEnable', fallback='false')))
@@ -22,27 +58,84 @@ class DelugeService:
 
         self._label_id = config.get('deluge', 'LabelId', fallback=None)
 
+    def connect(self):
+        """
+        Connects one pooled client and creates the label, the constructor does not touch the daemon.
+        """
+        self._pool.connect()
         if self._is_label_enabled():
             self.create_label(self._label_id)
 
+    def create_client(self) -> DelugeRPCClient:
+        client = _DelugeRPCClient(self._config.get('deluge', 'host'),
+                                  int(self._config.get('deluge', 'port')),
+                                  self._config.get('deluge', 'username'),
+                                  self._config.get('deluge', 'password'),
+                                  decode_utf8=True,
+                                  automatic_reconnect=False,
+                                  timeout=self._timeout_seconds)
+        # `client.core.x(...)` resolves `client.call` on every access, the instance attribute times all rpc methods
+        rpc_call = client.call
+
+        def timed_call(method, *args, **kwargs):
+            with DELUGE_RPC_SECONDS.time(method):
+                return rpc_call(method, *args, **kwargs)
+
+        client.call = timed_call
+        return client
+
     def add_torrent_magnet(self, magnet_url: str) -> str:
         # https://github.com/deluge-torrent/deluge/blob/deluge-2.0.3/deluge/core/core.py#L556
-        torrent_id = self._deluge_client.core.add_torrent_magnet(magnet_url, {})
+        torrent_id = self._pool.call(lambda c: c.core.add_torrent_magnet(magnet_url, {}), retry=False)
         if self._is_label_enabled():
             self.set_torrent_label(torrent_id, self._label_id)
         return torrent_id
 
-    def add_torrent_file(self, file_name: str, file_base64_str: str) -> str:
+    def add_torrent_file(self, file_name: str, file_base64: Union[str, bytes]) -> str:
         # https://github.com/deluge-torrent/deluge/blob/deluge-2.0.3/deluge/core/core.py#L407
-        torrent_id = self._deluge_client.core.add_torrent_file(file_name, file_base64_str, {})
+        # base64 bytes are sent as is, the daemon decodes the dump with b64decode which accepts both types
+        torrent_id = self._pool.call(lambda c: c.core.add_torrent_file(file_name, file_base64, {}), retry=False)
         if self._is_label_enabled():
             self.set_torrent_label(torrent_id, self._label_id)
         return torrent_id
 
+    def add_torrent_magnets(self, magnet_urls: List[str]) -> List[Union[str, Exception]]:
+        """
+        Adds all magnets concurrently and labels them afterwards, the result has torrent id or error for each magnet.
+        """
+        return self._add_torrents([lambda c, url=url: c.core.add_torrent_magnet(url, {}) for url in magnet_urls])
+
+    def add_torrent_files(self, torrent_files: List[Tuple[str, Union[str, bytes]]]) -> List[Union[str, Exception]]:
+        """
+        Bulk version of `add_torrent_file`, `torrent_files` are pairs of file name and base64 of the file.
+        """
+        return self._add_torrents([lambda c, name=name, dump=dump: c.core.add_torrent_file(name, dump, {})
+                                   for name, dump in torrent_files])
+
+    def _add_torrents(self, add_calls: List[Callable]) -> List[Union[str, Exception]]:
+        # rpc calls on the executor threads are counted in the breakdown of the calling handler
+        add_safe = with_request_timing(lambda add_call: self._call_safe(add_call, retry=False))
+        results = list(self._bulk_executor.map(add_safe, add_calls))
+        if self._is_label_enabled():
+            torrent_ids = [r for r in results if isinstance(r, str)]
+            label_calls = [lambda c, torrent_id=torrent_id: c.label.set_torrent(torrent_id, self._label_id)
+                           for torrent_id in torrent_ids]
+            label_results = self._bulk_executor.map(with_request_timing(self._call_safe), label_calls)
+            for torrent_id, result in zip(torrent_ids, label_results):
+                if isinstance(result, Exception):
+                    logging.error(f"Set label {self._label_id} to torrent {torrent_id} failed. {result}")
+        return results
+
+    def _call_safe(self, fn: Callable, retry=True):
+        try:
+            return self._pool.call(fn, retry=retry)
+        except Exception as e:
+            return e
+
     def create_label(self, label_id: str):
         # https://github.com/deluge-torrent/deluge/blob/deluge-2.0.3/deluge/plugins/Label/deluge_label/core.py#L178
         try:
-            self._deluge_client.label.add(label_id)
+            self._pool.call(lambda c: c.label.add(label_id))
         except Exception as e:
             if 'Exception: Label already exists' not in str(e):
                 raise e
@@ -50,54 +143,100 @@ class DelugeService:
     def delete_label(self, label_id: str):
         # https://github.com/deluge-torrent/deluge/blob/deluge-2.0.3/deluge/plugins/Label/deluge_label/core.py#L193
         try:
-            self._deluge_client.label.remove(label_id)
+            self._pool.call(lambda c: c.label.remove(label_id))
         except Exception as e:
             if 'Exception: Unknown Label' not in str(e):
                 raise e
 
     def get_labels(self) -> List[str]:
         # https://github.com/deluge-torrent/deluge/blob/deluge-2.0.3/deluge/plugins/Label/deluge_label/core.py#L173
-        return self._deluge_client.label.get_labels()
+        return self._pool.call(lambda c: c.label.get_labels())
 
     def set_torrent_label(self, torrent_id: str, label_id: str):
         # https://github.com/deluge-torrent/deluge/blob/deluge-2.0.3/deluge/plugins/Label/deluge_label/core.py#L312
-        self._deluge_client.label.set_torrent(torrent_id, label_id)
+        self._pool.call(lambda c: c.label.set_torrent(torrent_id, label_id))
 
     def delete_torrent(self, torrent_id: str):
         # https://github.com/deluge-torrent/deluge/blob/deluge-2.0.3/deluge/core/core.py#L574
-        self._deluge_client.core.remove_torrent(torrent_id, False)
+        self._pool.call(lambda c: c.core.remove_torrent(torrent_id, False), retry=False)
+        self._status_cache.invalidate(torrent_id)
 
     def torrent_name_by_id(self, torrent_id: str) -> str:
         # https://github.com/deluge-torrent/deluge/blob/deluge-2.0.3/deluge/core/core.py#L758
-        return self._deluge_client.core.get_torrent_status(torrent_id, ['name'])['name']
+        return self._pool.call(lambda c: c.core.get_torrent_status(torrent_id, ['name']))['name']
 
     def torrent_status(self, torrent_id: str) -> Dict[str, str]:
-        # https://github.com/deluge-torrent/deluge/blob/deluge-2.0.3/deluge/core/core.py#L758
-        return self._deluge_client.core.get_torrent_status(torrent_id, ['name', 'state'])
+        return self._cached_torrents_status([torrent_id], self._TORRENT_STATUS_FIELDS).get(torrent_id, {})
 
-    def torrents_status(self, torrent_ids: List[str]) -> List[Dict[str, str]]:
-        fields = ['name', 'state', 'progress', 'completed_time', 'time_added', 'total_wanted', 'total_done']
-        # https://github.com/deluge-torrent/deluge/blob/deluge-2.0.3/deluge/core/core.py#L772
-        torrents_dict = self._deluge_client.core.get_torrents_status({"id": [i for i in torrent_ids]}, fields)
+    def torrents_status(self, torrent_ids: List[str], fresh=False) -> List[Dict[str, str]]:
+        """
+        Statuses of the torrents, `fresh` ones are loaded from deluge bypassing the cache, e.g. on a status event.
+        """
+        if fresh:
+            for torrent_id in torrent_ids:
+                self._status_cache.invalidate(torrent_id)
+            torrents_dict = self._load_torrents_status(torrent_ids, self._STATUS_FIELDS)
+        else:
+            torrents_dict = self._cached_torrents_status(torrent_ids, self._STATUS_FIELDS)
         return DelugeService._dict_key_to_obj(torrents_dict)
 
-    def labeled_torrents(self) -> List[Dict[str, str]]:
+    def is_cached_torrent(self, torrent_id: str) -> bool:
+        # deluge had the torrent a few seconds ago, only the cache is looked up
+        return any(self._status_cache.contains(torrent_id, fields)
+                   for fields in (self._STATUS_FIELDS, self._TORRENT_STATUS_FIELDS))
+
+    def status_cache_stats(self) -> dict:
+        return self._status_cache.stats()
+
+    def _cached_torrents_status(self, torrent_ids: List[str], fields: List[str]) -> Dict[str, Dict[str, str]]:
+        return self._status_cache.get_many(torrent_ids, fields, lambda ids: self._load_torrents_status(ids, fields))
+
+    def _load_torrents_status(self, torrent_ids: List[str], fields: List[str]) -> Dict[str, Dict[str, str]]:
+        # https://github.com/deluge-torrent/deluge/blob/deluge-2.0.3/deluge/core/core.py#L772
+        return self._pool.call(lambda c: c.core.get_torrents_status({"id": torrent_ids}, fields))
+
+    def labeled_torrents(self, fields: List[str] = None) -> List[Dict[str, str]]:
         if self._is_label_enabled():
-            fields = ['name', 'state', 'progress', 'completed_time', 'time_added', 'total_wanted', 'total_done']
-            labeled_torrents = self._deluge_client.core.get_torrents_status({'label': self._label_id}, fields)
+            fields = fields or self._STATUS_FIELDS
+            labeled_torrents = self._pool.call(
+                lambda c: c.core.get_torrents_status({'label': self._label_id}, fields))
             return DelugeService._dict_key_to_obj(labeled_torrents)
         else:
             return []
 
+    def is_labeled_torrent(self, torrent_id: str) -> bool:
+        if self._is_label_enabled():
+            torrents = self._pool.call(
+                lambda c: c.core.get_torrents_status({'id': [torrent_id], 'label': self._label_id}, ['name']))
+            return torrent_id in torrents
+        else:
+            return False
+
     def stop_download_torrents(self):
-        self._deluge_client.core.set_config({'max_download_speed': "0"})
+        self._pool.call(lambda c: c.core.set_config({'max_download_speed': "0"}))
 
     def resume_download_torrents(self):
-        self._deluge_client.core.set_config({'max_download_speed': "-1"})
+        self._pool.call(lambda c: c.core.set_config({'max_download_speed': "-1"}))
 
     def free_space_bytes(self) -> int:
         # https://github.com/deluge-torrent/deluge/blob/deluge-2.0.3/deluge/core/core.py#L1235
-        return self._deluge_client.core.get_free_space()
+        return self._pool.call(lambda c: c.core.get_free_space())
+
+    def active_torrents_count(self) -> int:
+        """
+        Torrents being downloaded or checked, finished and paused ones are not counted.
+        """
+        torrents = self._pool.call(
+            lambda c: c.core.get_torrents_status({'state': list(self._ACTIVE_STATES)}, ['name']))
+        return len(torrents)
+
+    def pending_download_bytes(self) -> int:
+        """
+        Bytes left to download by active and queued torrents, seeding and paused ones are not asked for.
+        """
+        torrents = self._pool.call(lambda c: c.core.get_torrents_status({'state': list(self._PENDING_DOWNLOAD_STATES)},
+                                                                        ['total_wanted', 'total_done']))
+        return sum(max((t['total_wanted'] or 0) - (t['total_done'] or 0), 0) for t in torrents.values())
 
     def _is_label_enabled(self) -> bool:
         if self._label_enable and self._label_id:
@@ -115,5 +254,9 @@ class DelugeService:
             torrents.append(value)
         return torrents
 
+    def pool_metrics(self) -> dict:
+        return self._pool.metrics()
+
     def disconnect(self):
-        self._deluge_client.disconnect()
+        self._bulk_executor.shutdown(wait=False)
+        self._pool.disconnect()
@@ -0,0 +1,102 @@
+import base64
+import re
+from hashlib import sha1
+from typing import Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+
+# https://www.bittorrent.org/beps/bep_0009.html#magnet-uri-format
+_BTIH_PREFIX = 'urn:btih:'
+_HEX_INFOHASH = re.compile('^[0-9a-fA-F]{40}$')
+_BASE32_INFOHASH = re.compile('^[A-Za-z2-7]{32}$')
+_INTEGER_MAX_LENGTH = 32
+
+
+class BencodeError(ValueError):
+    pass
+
+
+def magnet_infohash(magnet_uri: str) -> Optional[str]:
+    """
+    Lowercase hex v1 infohash of the magnet, the same value deluge uses as torrent id.
+    None for links without a `urn:btih` topic.
+    """
+    parsed = urlparse(magnet_uri.strip())
+    if parsed.scheme != 'magnet':
+        return None
+    for topic in parse_qs(parsed.query).get('xt', []):
+        if not topic.lower().startswith(_BTIH_PREFIX):
+            continue
+        value = topic[len(_BTIH_PREFIX):]
+        if _HEX_INFOHASH.match(value):
+            return value.lower()
+        if _BASE32_INFOHASH.match(value):
+            return base64.b32decode(value.upper()).hex()
+    return None
+
+
+def torrent_file_infohash(data: bytes) -> Optional[str]:
+    """
+    Lowercase hex sha1 of the bencoded `info` dict of a .torrent file, None if the file is not a valid torrent.
+    """
+    try:
+        info_start, info_end = _info_span(data)
+    except BencodeError:
+        return None
+    return sha1(memoryview(data)[info_start:info_end]).hexdigest()
+
+
+def _info_span(data: bytes) -> Tuple[int, int]:
+    # the infohash is taken over the original bytes of the info value, they are never re-encoded
+    if data[0:1] != b'd':
+        raise BencodeError('torrent is not a dictionary')
+    position = 1
+    while data[position:position + 1] != b'e':
+        key_start, key_end = _string_span(data, position)
+        value_end = _skip_value(data, key_end)
+        if data[key_start:key_end] == b'info':
+            if data[key_end:key_end + 1] != b'd':
+                raise BencodeError('info is not a dictionary')
+            return key_end, value_end
+        position = value_end
+    raise BencodeError('torrent has no info dictionary')
+
+
+def _string_span(data: bytes, position: int) -> Tuple[int, int]:
+    """
+    Start and end offsets of the content of the bencoded string `<length>:<content>` at `position`.
+    """
+    colon = data.find(b':', position, position + _INTEGER_MAX_LENGTH)
+    length = data[position:colon]
+    if colon < 0 or not length.isdigit():
+        raise BencodeError(f'invalid string at {position}')
+    end = colon + 1 + int(length)
+    if end > len(data):
+        raise BencodeError(f'string at {position} is out of the data')
+    return colon + 1, end
+
+
+def _skip_value(data: bytes, position: int) -> int:
+    """
+    Offset right after the bencoded value starting at `position`, iterative to survive deeply nested files.
+    """
+    depth = 0
+    while True:
+        token = data[position:position + 1]
+        if token == b'i':
+            end = data.find(b'e', position, position + _INTEGER_MAX_LENGTH)
+            if end < 0:
+                raise BencodeError(f'invalid integer at {position}')
+            position = end + 1
+        elif token in (b'l', b'd'):
+            depth += 1
+            position += 1
+            continue
+        elif token == b'e' and depth > 0:
+            depth -= 1
+            position += 1
+        elif token.isdigit():
+            _, position = _string_span(data, position)
+        else:
+            raise BencodeError(f'invalid token at {position}')
+        if depth == 0:
+            return position
@@ -2,27 +2,41 @@
 
 import base64
 import configparser
+import io
 import json
 import logging
 import os.path
 import re
+import secrets
 import signal
 import sys
-from datetime import datetime
+import threading
+import zipfile
+from concurrent.futures import Future
 from functools import wraps
 from hashlib import sha256
+from typing import List, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
 
-import humanize
-from emoji import emojize
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, ParseMode
 from telegram.ext import CallbackQueryHandler, CallbackContext, MessageHandler, Filters, Updater, CommandHandler
 from telegram.utils import helpers
 
-from cron_jobs import DeleteExpiredCacheJob, NotDownloadedTorrentsStatusCheckJob, ScanCommonTorrents
-from deluge_service import DelugeService
+from cron_jobs import DeleteExpiredCacheJob, FreeSpaceSampleJob, NotDownloadedTorrentsStatusCheckJob, \
+    ScanCommonTorrents
+from deluge_events import DelugeEventListener, TorrentEventsHandler
+from deluge_cluster import DelugeCluster
+from infohash import magnet_infohash, torrent_file_infohash
+from metrics import timed_handler, label_request, HANDLER_SECONDS, TELEGRAM_API_SECONDS, REGISTRY, \
+    MetricsServer
+from profiler import SamplingProfiler
 from repeated_task import RepeatJob, RepeatedJobManager
 from repository import Repository, TorrentStatus
 from schedule_thread import ScheduleThread
+from telegram_sender import TelegramSender
+from torrent_renderer import TorrentLineRenderer
+from torrent_status_notifier import TorrentStatusNotifier
+from webhook import WebhookServer
 
 config = configparser.ConfigParser()
 config.read('config.ini')
@@ -31,22 +45,22 @@ _DB_SQLITE_FILE = 'db.sqlite3'
 logging.basicConfig(level=config.get('logging', 'level', fallback='INFO'),
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-deluge_service = DelugeService(config)
-
-repository = Repository(_DB_SQLITE_FILE)
-
-ALLOWED_TELEGRAM_USER_IDS = [int(x) for x in config['telegram'].get('UserIds', "").split(",")]
+# without config.ini the module is still importable, e.g. by tools/benchmark.py
+ALLOWED_TELEGRAM_USER_IDS = [int(x) for x in config.get('telegram', 'UserIds', fallback="").split(",") if x.strip()]
 LIST_TORRENT_SIZE = 5
+# callback data of the list paging buttons, followed by the keyset cursor '<sort_time>_<id>'
+NEXT_LIST_PREFIX = 'next_list_'
+PREV_LIST_PREFIX = 'prev_list_'
+MAGNET_PATTERN = 'magnet:\\?\\S+'
+# telegram limit of a message text is 4096 characters
+MESSAGE_MAX_LENGTH = 4000
+# handlers running longer are logged with the time spent in rpc, db and telegram calls
+SLOW_HANDLER_SECONDS = float(config.get('metrics', 'SlowHandlerSeconds', fallback='2'))
 
-EMOJI_MAP = {
-    TorrentStatus.CREATED: emojize(':arrow_down:', use_aliases=True),
-    TorrentStatus.DOWNLOADED: emojize(':white_check_mark:', use_aliases=True),
-    TorrentStatus.DOWNLOADING: emojize(':arrow_double_down:', use_aliases=True),
-    TorrentStatus.QUEUED: emojize(':back:', use_aliases=True),
-    TorrentStatus.MOVING: emojize(':soon:', use_aliases=True),
-    TorrentStatus.ERROR: emojize(':sos:', use_aliases=True),
-    TorrentStatus.UNKNOWN_STUB: emojize(':question:', use_aliases=True)
-}
+
+def edit_callback_message(query, text: str, **kwargs):
+    return app.telegram_sender.edit_message_text(chat_id=query.message.chat_id, message_id=query.message.message_id,
+                                                 text=text, **kwargs)
 
 
 def repeat_job_id(user_id: int, message_id: int) -> str:
@@ -59,44 +73,77 @@ def restricted(func):
         user_id = update.effective_user.id
         if user_id not in ALLOWED_TELEGRAM_USER_IDS:
             logging.warning("Unauthorized access denied for {}.".format(user_id))
-            context.bot.send_message(chat_id=update.effective_chat.id, text="You are not authorized")
+            app.telegram_sender.send_message(chat_id=update.effective_chat.id, text="You are not authorized")
+            return
+        return func(update, context, *args, **kwargs)
+
+    return wrapped
+
+
+def deluge_required(func):
+    @wraps(func)
+    def wrapped(update, context, *args, **kwargs):
+        if not app.deluge_ready.is_set():
+            app.telegram_sender.send_message(chat_id=update.effective_chat.id,
+                                             text="Deluge is not connected yet, try again later")
             return
         return func(update, context, *args, **kwargs)
 
     return wrapped
 
 
+@timed_handler(HANDLER_SECONDS, SLOW_HANDLER_SECONDS)
 @restricted
+@deluge_required
 def handle_message(update: Update, context: CallbackContext) -> None:
     message = update.message.text
     chat_id: int = update.effective_chat.id
     user_id: int = update.effective_user.id
-    if isinstance(message, str) and message.startswith('magnet'):
+    magnet_uris = re.findall(MAGNET_PATTERN, message) if isinstance(message, str) else []
+    if len(magnet_uris) > 1:
+        bulk_download_torrents(chat_id, user_id, magnet_uris=magnet_uris)
+    elif isinstance(message, str) and message.startswith('magnet'):
         magnet_uri = message
+        local_torrent_id = magnet_infohash(magnet_uri)
+        if is_known_torrent(local_torrent_id):
+            reply_already_exist_torrent(chat_id, local_torrent_id, cache_key_magnet_value(local_torrent_id, user_id),
+                                        magnet_uri)
+            return
         try:
             torrent_name, deluge_torrent_id = start_download_torrent_by_magnet(magnet_uri, user_id,
                                                                                override_on_exist=True)
-            context.bot.send_message(chat_id=chat_id,
-                                     text=f"Downloading `{helpers.escape_markdown(torrent_name, version=2)}`",
-                                     parse_mode=ParseMode.MARKDOWN_V2)
+            app.telegram_sender.send_message(chat_id=chat_id,
+                                             text=f"Downloading `{helpers.escape_markdown(torrent_name, version=2)}`",
+                                             parse_mode=ParseMode.MARKDOWN_V2)
 
-            notify_about_free_space_if_need(chat_id, context.bot)
+            notify_about_free_space_if_need(chat_id, [deluge_torrent_id])
 
         except Exception as e:
-            torrent_id_matcher = torrent_id_matcher_from_exception(e)
-            if type(e) and type(e).__name__ == 'AddTorrentError' and torrent_id_matcher:
-                already_exist_torrent_id = torrent_id_matcher.group(1)
-                cache_key = cache_key_magnet_value(already_exist_torrent_id, user_id)
-                repository.create_cache(cache_key, magnet_uri, override_on_exist=True)
-                reply_markup = build_reply_markup(already_exist_torrent_id, cache_key)
-                context.bot.send_message(chat_id=chat_id,
-                                         text='Torrent already downloaded, what to do?', reply_markup=reply_markup)
+            already_exist_torrent_id = already_exist_torrent_id_from_exception(e, local_torrent_id)
+            if already_exist_torrent_id:
+                reply_already_exist_torrent(chat_id, already_exist_torrent_id,
+                                            cache_key_magnet_value(already_exist_torrent_id, user_id), magnet_uri)
             else:
-                context.bot.send_message(chat_id=chat_id, text="Error add torrent: {}".format(str(e)))
+                app.telegram_sender.send_message(chat_id=chat_id, text="Error add torrent: {}".format(str(e)))
     else:
-        context.bot.send_message(chat_id=chat_id,
-                                 text="Link is not magnet",
-                                 parse_mode=ParseMode.MARKDOWN_V2)
+        app.telegram_sender.send_message(chat_id=chat_id,
+                                         text="Link is not magnet",
+                                         parse_mode=ParseMode.MARKDOWN_V2)
+
+
+def torrent_file_max_size_bytes():
+    # https://core.telegram.org/bots/api#getfile bots can download files up to 20 MB
+    max_size_mb = float(config.get('telegram', 'MaxTorrentFileSizeMb', fallback='10'))
+    return int(max_size_mb * 1024 * 1024)
+
+
+def bulk_max_torrents() -> int:
+    return int(config.get('telegram', 'MaxBulkTorrents', fallback='100'))
+
+
+def bulk_max_archive_uncompressed_bytes() -> int:
+    max_size_mb = float(config.get('telegram', 'MaxBulkArchiveUncompressedMb', fallback='50'))
+    return int(max_size_mb * 1024 * 1024)
 
 
 def storage_lower_threshold_notification_bytes():
@@ -104,24 +151,28 @@ def storage_lower_threshold_notification_bytes():
     return threshold_gb * 1024 * 1024 * 1024
 
 
+@timed_handler(HANDLER_SECONDS, SLOW_HANDLER_SECONDS)
 @restricted
+@deluge_required
 def handle_button_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
 
     # CallbackQueries need to be answered, even if no notification to the user is needed
     # Some clients may have trouble otherwise. See https://core.telegram.org/bots/api#callbackquery
-    query.answer()
+    with TELEGRAM_API_SECONDS.time('answer_callback_query'):
+        query.answer()
 
     try:
-        cache_value = repository.get_cache(query.data)
+        cache_value = app.repository.get_cache(query.data)
         user_id: int = query.from_user.id
         if cache_value:
             callback_data = json.loads(cache_value['value'])
             if is_already_exist_callback(callback_data):
                 torrent_id = callback_data['torrent_id']
+                label_request(f"handle_button_callback_{callback_data['action']}")
                 if callback_data['action'] == 'reload':
                     logging.debug('callback_action reload, torrent_id {}'.format(torrent_id))
-                    cache_value = repository.get_cache(callback_data['cache_key'])
+                    cache_value = app.repository.get_cache(callback_data['cache_key'])
                     if not cache_value:
                         raise ValueError(f"no value for 'cache_key': {callback_data['cache_key']}")
                     cache_key = cache_value['key']
@@ -130,229 +181,405 @@ def handle_button_callback(update: Update, context: CallbackContext) -> None:
                         raise ValueError(f"empty value for 'cache_key': {callback_data['cache_key']}")
 
                     if '_magnet_value' in cache_key and cache_value.startswith('magnet'):
-                        deluge_service.delete_torrent(torrent_id)
+                        delete_torrent_if_exist(torrent_id)
                         torrent_name, deluge_torrent_id = start_download_torrent_by_magnet(cache_value, user_id,
                                                                                            override_on_exist=True)
-                        query.edit_message_text(f'Downloading `{helpers.escape_markdown(torrent_name, version=2)}`',
-                                                parse_mode=ParseMode.MARKDOWN_V2)
+                        edit_callback_message(query,
+                                              f'Downloading `{helpers.escape_markdown(torrent_name, version=2)}`',
+                                              parse_mode=ParseMode.MARKDOWN_V2)
 
-                        notify_about_free_space_if_need(update.effective_chat.id, context.bot)
+                        notify_about_free_space_if_need(update.effective_chat.id, [deluge_torrent_id])
                     elif '_file_value' in cache_key and len(cache_value) > 1:
-                        torrent_name = deluge_service.torrent_name_by_id(torrent_id)
-                        deluge_service.delete_torrent(torrent_id)
-                        torrent_name, deluge_torrent_id = start_download_torrent_by_file(cache_value,
+                        file_base64 = cached_torrent_file_base64(cache_value)
+                        torrent_name = torrent_name_or_id(torrent_id)
+                        delete_torrent_if_exist(torrent_id)
+                        torrent_name, deluge_torrent_id = start_download_torrent_by_file(file_base64,
                                                                                          f'{torrent_name}.torrent',
                                                                                          user_id,
                                                                                          override_on_exist=True)
-                        query.edit_message_text(f'Downloading `{helpers.escape_markdown(torrent_name, version=2)}`',
-                                                parse_mode=ParseMode.MARKDOWN_V2)
-                        notify_about_free_space_if_need(update.effective_chat.id, context.bot)
+                        edit_callback_message(query,
+                                              f'Downloading `{helpers.escape_markdown(torrent_name, version=2)}`',
+                                              parse_mode=ParseMode.MARKDOWN_V2)
+                        notify_about_free_space_if_need(update.effective_chat.id, [deluge_torrent_id])
                 if callback_data['action'] == 'skip':
                     logging.debug('callback_action skip, torrent_id {}'.format(torrent_id))
-                    query.edit_message_text(
-                        f'Torrent `{helpers.escape_markdown(deluge_service.torrent_name_by_id(torrent_id), version=2)}`'
-                        f' already exist. Skipping download.', parse_mode=ParseMode.MARKDOWN_V2)
+                    torrent_name = torrent_name_or_id(torrent_id)
+                    edit_callback_message(query,
+                                          f'Torrent `{helpers.escape_markdown(torrent_name, version=2)}`'
+                                          f' already exist. Skipping download.', parse_mode=ParseMode.MARKDOWN_V2)
         else:
-            if "next_list_" in query.data:
-                offset = int(query.data.split('next_list_')[1])
+            if query.data.startswith(NEXT_LIST_PREFIX) or query.data.startswith(PREV_LIST_PREFIX):
+                backward = query.data.startswith(PREV_LIST_PREFIX)
+                label_request('handle_button_callback_list_page')
+                cursor = list_cursor_from_callback_data(PREV_LIST_PREFIX if backward else NEXT_LIST_PREFIX,
+                                                        query.data)
+                if cursor is None:
+                    edit_callback_message(query, "The list is expired, send /list again")
+                    return
 
                 def print_message():
-                    reply_markup, text = torrents_list_message(user_id, offset=offset)
-                    context.bot.edit_message_text(chat_id=update.effective_chat.id,
-                                                  message_id=update.effective_message.message_id,
-                                                  text=text,
-                                                  reply_markup=reply_markup,
-                                                  parse_mode=ParseMode.MARKDOWN_V2)
-
-                message_reload_manager.schedule(
+                    reply_markup, text = torrents_list_message(user_id, cursor=cursor, backward=backward)
+                    app.telegram_sender.edit_message_text(chat_id=update.effective_chat.id,
+                                                          message_id=update.effective_message.message_id,
+                                                          text=text,
+                                                          reply_markup=reply_markup,
+                                                          parse_mode=ParseMode.MARKDOWN_V2)
+
+                app.message_reload_manager.schedule(
                     RepeatJob(repeat_job_id(user_id, update.effective_message.message_id), print_message))
                 print_message()
             else:
                 raise ValueError(f'cache is not found by key {query.data} for user {user_id} '
                                  f'({query.from_user.first_name})')
     except Exception as e:
-        query.edit_message_text("Sorry, I'm broke. Try to download later.", parse_mode=ParseMode.MARKDOWN_V2)
+        edit_callback_message(query, "Sorry, I'm broke. Try to download later.", parse_mode=ParseMode.MARKDOWN_V2)
         logging.error('error on process callback_data {}, error: {}'.format(query.data, str(e)))
 
 
-def notify_about_free_space_if_need(chat_id: int, bot):
-    free_space_bytes = deluge_service.free_space_bytes()
-    if free_space_bytes < storage_lower_threshold_notification_bytes():
-        humanize_free_space = helpers.escape_markdown(humanize.naturalsize(free_space_bytes),
-                                                      version=2)
-        warning_emoji = emojize(':heavy_exclamation_mark:', use_aliases=True)
-        bot.send_message(chat_id=chat_id,
-                         text=f"{warning_emoji}Warning, on device has left {humanize_free_space}",
-                         parse_mode=ParseMode.MARKDOWN_V2)
-
-
+def notify_about_free_space_if_need(chat_id: int, torrent_ids: List[str]):
+    # sampled per deluge daemon in the background by FreeSpaceSampleJob, unknown until its first run,
+    # only daemons of the added torrents are checked
+    daemons = list(dict.fromkeys(app.deluge_service.daemon_of(torrent_id) for torrent_id in torrent_ids))
+    for daemon in daemons:
+        free_space_bytes = app.free_space_sample_job.free_space_bytes(daemon)
+        if free_space_bytes is not None and free_space_bytes < storage_lower_threshold_notification_bytes():
+            import humanize
+            from emoji import emojize
+            humanize_free_space = helpers.escape_markdown(humanize.naturalsize(free_space_bytes),
+                                                          version=2)
+            device = f"device of deluge {helpers.escape_markdown(daemon, version=2)}" \
+                if daemon and len(app.deluge_service.daemons()) > 1 else "device"
+            warning_emoji = emojize(':heavy_exclamation_mark:', use_aliases=True)
+            app.telegram_sender.send_message(chat_id=chat_id,
+                                             text=f"{warning_emoji}Warning, on {device} has left {humanize_free_space}",
+                                             parse_mode=ParseMode.MARKDOWN_V2)
+
+
+@timed_handler(HANDLER_SECONDS, SLOW_HANDLER_SECONDS)
 @restricted
+@deluge_required
 def handle_file(update: Update, context: CallbackContext):
     file_name = update.message.document.file_name
     root, ext = os.path.splitext(file_name)
     chat_id: int = update.effective_chat.id
     user_id: int = update.effective_user.id
-    if ext == '.torrent':
-        file_id = update.message.document.file_id
-        file = context.bot.get_file(file_id)
-        base64_file_str = base64.b64encode(file.download_as_bytearray()).decode("utf-8")
+    if ext == '.zip':
+        zip_bytes = download_document(update, context)
+        if zip_bytes is not None:
+            try:
+                torrent_files = torrent_files_from_zip(zip_bytes)
+            except Exception as e:
+                app.telegram_sender.send_message(chat_id=chat_id, text="Error read zip file: {}".format(str(e)))
+                return
+            bulk_download_torrents(chat_id, user_id, torrent_files=torrent_files)
+    elif ext == '.torrent':
+        file_bytes = download_document(update, context)
+        if file_bytes is None:
+            return
+        local_torrent_id = torrent_file_infohash(file_bytes)
+        if is_known_torrent(local_torrent_id):
+            reply_already_exist_torrent(chat_id, local_torrent_id, cache_key_file_value(local_torrent_id, user_id),
+                                        app.repository.create_torrent_file(file_bytes))
+            return
+        file_base64 = base64.b64encode(file_bytes)
         try:
-            torrent_name, deluge_torrent_id = start_download_torrent_by_file(base64_file_str, file_name, user_id,
+            torrent_name, deluge_torrent_id = start_download_torrent_by_file(file_base64, file_name, user_id,
                                                                              override_on_exist=True)
-            context.bot.send_message(chat_id=chat_id,
-                                     text=f"Downloading `{helpers.escape_markdown(torrent_name, version=2)}`",
-                                     parse_mode=ParseMode.MARKDOWN_V2)
+            app.telegram_sender.send_message(chat_id=chat_id,
+                                             text=f"Downloading `{helpers.escape_markdown(torrent_name, version=2)}`",
+                                             parse_mode=ParseMode.MARKDOWN_V2)
 
-            notify_about_free_space_if_need(chat_id, context.bot)
+            notify_about_free_space_if_need(chat_id, [deluge_torrent_id])
 
         except Exception as e:
-            torrent_id_matcher = torrent_id_matcher_from_exception(e)
-            if type(e) and type(e).__name__ == 'AddTorrentError' and torrent_id_matcher:
-                already_exist_torrent_id = torrent_id_matcher.group(1)
-                cache_key = cache_key_file_value(already_exist_torrent_id, user_id)
-                repository.create_cache(cache_key, base64_file_str, override_on_exist=True)
-                reply_markup = build_reply_markup(already_exist_torrent_id, cache_key)
-                context.bot.send_message(chat_id=chat_id,
-                                         text='Torrent already downloaded, what to do?', reply_markup=reply_markup)
+            already_exist_torrent_id = already_exist_torrent_id_from_exception(e, local_torrent_id)
+            if already_exist_torrent_id:
+                reply_already_exist_torrent(chat_id, already_exist_torrent_id,
+                                            cache_key_file_value(already_exist_torrent_id, user_id),
+                                            app.repository.create_torrent_file(file_bytes))
             else:
-                context.bot.send_message(chat_id=chat_id,
-                                         text="Error add torrent file: {}".format(str(e)))
+                app.telegram_sender.send_message(chat_id=chat_id,
+                                                 text="Error add torrent file: {}".format(str(e)))
     else:
-        context.bot.send_message(chat_id=chat_id,
-                                 text=f"File `{helpers.escape_markdown(file_name, version=2)}` is not a `.torrent`",
-                                 parse_mode=ParseMode.MARKDOWN_V2)
-
-
+        app.telegram_sender.send_message(chat_id=chat_id,
+                                         text=f"File `{helpers.escape_markdown(file_name, version=2)}` "
+                                              f"is not a `.torrent` or `.zip`",
+                                         parse_mode=ParseMode.MARKDOWN_V2)
+
+
+def download_document(update: Update, context: CallbackContext) -> Optional[bytearray]:
+    document = update.message.document
+    file_size = document.file_size or 0
+    if file_size > torrent_file_max_size_bytes():
+        import humanize
+        file_size_str = humanize.naturalsize(file_size)
+        app.telegram_sender.send_message(chat_id=update.effective_chat.id,
+                                         text=f"File `{helpers.escape_markdown(document.file_name, version=2)}` "
+                                              f"is too big \\({helpers.escape_markdown(file_size_str, version=2)}\\)",
+                                         parse_mode=ParseMode.MARKDOWN_V2)
+        return None
+    with TELEGRAM_API_SECONDS.time('get_file'):
+        file = context.bot.get_file(document.file_id)
+    # the only full copy of the file, base64 is encoded once right for the rpc call
+    with TELEGRAM_API_SECONDS.time('download_file'):
+        return file.download_as_bytearray()
+
+
+def torrent_files_from_zip(zip_bytes: bytearray) -> List[Tuple[str, bytes]]:
+    with zipfile.ZipFile(io.BytesIO(zip_bytes)) as archive:
+        members = [m for m in archive.infolist() if not m.is_dir() and m.filename.lower().endswith('.torrent')]
+        if not members:
+            raise ValueError("no .torrent files in the archive")
+        if len(members) > bulk_max_torrents():
+            raise ValueError(f"more than {bulk_max_torrents()} .torrent files in the archive")
+        too_big = [m.filename for m in members if m.file_size > torrent_file_max_size_bytes()]
+        if too_big:
+            raise ValueError(f"too big files {', '.join(too_big)}")
+        # the sizes are from the archive directory, a member is never read past its size
+        if sum(m.file_size for m in members) > bulk_max_archive_uncompressed_bytes():
+            raise ValueError(f"the archive has more than {bulk_max_archive_uncompressed_bytes() // (1024 * 1024)} MB "
+                             f"of .torrent files")
+        return [(os.path.basename(m.filename), archive.read(m)) for m in members]
+
+
+def bulk_download_torrents(chat_id: int, user_id: int, magnet_uris: List[str] = (),
+                           torrent_files: List[Tuple[str, bytes]] = ()):
+    """
+    Adds many torrents with a few rpc round trips and replies with one summary message.
+
+    Torrents already known by infohash are skipped, the rest is added concurrently over the deluge connections.
+    """
+    if len(magnet_uris) + len(torrent_files) > bulk_max_torrents():
+        app.telegram_sender.send_message(chat_id=chat_id, text=f"Too many torrents, send at most {bulk_max_torrents()}")
+        return
+    seen_torrent_ids = set()
+    skipped: List[str] = []
+
+    def is_new(title: str, torrent_id: Optional[str]) -> bool:
+        if is_known_torrent(torrent_id) or torrent_id in seen_torrent_ids:
+            skipped.append(title)
+            return False
+        if torrent_id:
+            seen_torrent_ids.add(torrent_id)
+        return True
+
+    new_magnet_uris = [uri for uri in magnet_uris if is_new(magnet_display_name(uri), magnet_infohash(uri))]
+    new_torrent_files = [(name, data) for name, data in torrent_files
+                         if is_new(name, torrent_file_infohash(data))]
+    titles = [magnet_display_name(uri) for uri in new_magnet_uris] + [name for name, _ in new_torrent_files]
+    results = app.deluge_service.add_torrent_magnets(new_magnet_uris) + app.deluge_service.add_torrent_files(
+        [(name, base64.b64encode(data)) for name, data in new_torrent_files])
+
+    added_torrent_ids = [r for r in results if isinstance(r, str)]
+    failed = [f"{title}: {result}" for title, result in zip(titles, results) if not isinstance(result, str)]
+    if added_torrent_ids:
+        app.repository.create_torrents(user_id, added_torrent_ids,
+                                       deluge_daemons={torrent_id: app.deluge_service.daemon_of(torrent_id)
+                                                       for torrent_id in added_torrent_ids})
+    names = {t['_id']: t['name'] for t in app.deluge_service.torrents_status(added_torrent_ids)}
+
+    lines = [f"Downloading {len(added_torrent_ids)} torrents"]
+    lines += [f"  {names.get(torrent_id, torrent_id)}" for torrent_id in added_torrent_ids]
+    if skipped:
+        lines += [f"Already downloaded, skipped {len(skipped)}"] + [f"  {title}" for title in skipped]
+    if failed:
+        lines += [f"Failed {len(failed)}"] + [f"  {error}" for error in failed]
+    text = '\n'.join(lines)
+    if len(text) > MESSAGE_MAX_LENGTH:
+        text = text[:MESSAGE_MAX_LENGTH] + '\n...'
+    app.telegram_sender.send_message(chat_id=chat_id, text=text)
+
+    if added_torrent_ids:
+        notify_about_free_space_if_need(chat_id, added_torrent_ids)
+
+
+def magnet_display_name(magnet_uri: str) -> str:
+    display_names = parse_qs(urlparse(magnet_uri).query).get('dn')
+    return display_names[0] if display_names else magnet_infohash(magnet_uri) or magnet_uri[:60]
+
+
+@timed_handler(HANDLER_SECONDS, SLOW_HANDLER_SECONDS)
 @restricted
+@deluge_required
 def handle_torrents_list(update: Update, context: CallbackContext):
     chat_id: int = update.effective_chat.id
     user_id: int = update.effective_chat.id
 
     reply_markup, text = torrents_list_message(user_id)
-    message = context.bot.send_message(chat_id=chat_id,
-                                       text=text,
-                                       parse_mode=ParseMode.MARKDOWN_V2,
-                                       reply_markup=reply_markup)
-
-    def update_torrent_list():
-        reply_markup, text = torrents_list_message(user_id)
-        context.bot.edit_message_text(chat_id=chat_id,
-                                      message_id=message.message_id,
-                                      text=text,
-                                      parse_mode=ParseMode.MARKDOWN_V2,
-                                      reply_markup=reply_markup)
-
-    message_reload_manager.schedule(RepeatJob(repeat_job_id(user_id, message.message_id), update_torrent_list))
-
-
-def torrents_list_message(user_id: int, limit: int = LIST_TORRENT_SIZE, offset: int = 0):
-    user_torrents = repository.all_user_torrents(user_id, limit=LIST_TORRENT_SIZE * 3, offset=offset)
-    # TODO: fix not exists torrent from local db
-    torrents = deluge_service.torrents_status([i['deluge_torrent_id'] for i in user_torrents])
-    # last updated at the end of the list
-    sorted_torrents = sorted(torrents,
-                             key=lambda r: r['completed_time'] if r['completed_time'] > 0 else r['time_added'],
-                             reverse=True)
-
-    def build_message_line(t) -> str:
-        progress = t.get('progress', -1.0)
-        torrent_status = TorrentStatus.get_by_value_safe(t['state'])
-        emoji_t = EMOJI_MAP.get(TorrentStatus.UNKNOWN_STUB)
-        if torrent_status is TorrentStatus.ERROR:
-            emoji_t = EMOJI_MAP.get(TorrentStatus.ERROR)
-        elif progress >= 100 and torrent_status is TorrentStatus.MOVING:
-            emoji_t = EMOJI_MAP.get(TorrentStatus.MOVING)
-        elif progress >= 100:
-            emoji_t = EMOJI_MAP.get(TorrentStatus.DOWNLOADED)
-        elif progress > 0:
-            emoji_t = EMOJI_MAP.get(TorrentStatus.DOWNLOADING)
-        elif progress == 0:
-            emoji_t = EMOJI_MAP.get(TorrentStatus.CREATED)
-        if progress >= 100:
-            filex_size_progress = f"{humanize.naturalsize(t['total_wanted'])} {int(progress)}%"
-        else:
-            filex_size_progress = f"{humanize.naturalsize(t['total_done'])} / " \
-                                  f"{humanize.naturalsize(t['total_wanted'])} {int(progress)}%"
-        return f"{emoji_t} **{helpers.escape_markdown(t['name'], version=2)}** \n " \
-               f"{helpers.escape_markdown(filex_size_progress, version=2)}, added " \
-               f"{humanize.naturaldate(datetime.fromtimestamp(t['time_added']))} \n"
-
-    if offset > 0:
-        if len(sorted_torrents) > LIST_TORRENT_SIZE:
-            button_list = [
-                InlineKeyboardButton("prev", callback_data=f"next_list_{offset - limit}"),
-                InlineKeyboardButton("next", callback_data=f"next_list_{offset + limit}")
-            ]
+
+    def schedule_torrent_list_update(sent: Future):
+        # called by the sender thread once the message is sent, the dispatcher doesn't wait for the send queue
+        if sent.exception() is not None:
+            logging.error(f"Can't send torrents list to chat {chat_id}. {sent.exception()}")
+            return
+        message_id = sent.result().message_id
+
+        def update_torrent_list():
+            reply_markup, text = torrents_list_message(user_id)
+            app.telegram_sender.edit_message_text(chat_id=chat_id,
+                                                  message_id=message_id,
+                                                  text=text,
+                                                  parse_mode=ParseMode.MARKDOWN_V2,
+                                                  reply_markup=reply_markup)
+
+        app.message_reload_manager.schedule(RepeatJob(repeat_job_id(user_id, message_id), update_torrent_list))
+
+    app.telegram_sender.send_message(chat_id=chat_id,
+                                     text=text,
+                                     parse_mode=ParseMode.MARKDOWN_V2,
+                                     reply_markup=reply_markup).add_done_callback(schedule_torrent_list_update)
+
+
+def list_callback_data(prefix: str, user_torrent) -> str:
+    return f"{prefix}{user_torrent['sort_time']!r}_{user_torrent['id']}"
+
+
+def list_cursor_from_callback_data(prefix: str, callback_data: str) -> Optional[Tuple[float, int]]:
+    # None for buttons of lists sent before the keyset cursor, 'next_list_<offset>' in a different order
+    if '_' not in callback_data[len(prefix):]:
+        return None
+    sort_time, row_id = callback_data[len(prefix):].rsplit('_', 1)
+    return float(sort_time), int(row_id)
+
+
+def finished_torrent_snapshot(user_torrent) -> Optional[dict]:
+    # finished torrents don't change anymore and are rendered from the local database
+    snapshot = Repository.metadata_snapshot(user_torrent)
+    if snapshot and user_torrent['deluge_torrent_status'] == str(TorrentStatus.DOWNLOADED) \
+            and snapshot['progress'] >= 100:
+        return snapshot
+    return None
+
+
+def torrents_list_message(user_id: int, limit: int = LIST_TORRENT_SIZE, cursor: Optional[Tuple[float, int]] = None,
+                          backward=False):
+    # one extra row tells whether there is one more page in the direction of paging
+    user_torrents = app.repository.user_torrents_page(user_id, limit + 1, cursor=cursor, backward=backward)
+    has_more = len(user_torrents) > limit
+    if has_more:
+        user_torrents = user_torrents[1:] if backward else user_torrents[:limit]
+    torrents_by_id = dict()
+    in_flight_torrent_ids = []
+    for user_torrent in user_torrents:
+        snapshot = finished_torrent_snapshot(user_torrent)
+        if snapshot:
+            torrents_by_id[snapshot['_id']] = snapshot
         else:
-            button_list = [InlineKeyboardButton("prev", callback_data=f"next_list_{offset - limit}")]
-    else:
-        button_list = [InlineKeyboardButton("next", callback_data=f"next_list_{limit}")]
-    reply_markup = InlineKeyboardMarkup([button_list])
-    message_lines = [build_message_line(t) for t in sorted_torrents[:LIST_TORRENT_SIZE]]
+            in_flight_torrent_ids.append(user_torrent['deluge_torrent_id'])
+    if in_flight_torrent_ids:
+        # TODO: fix not exists torrent from local db
+        live_torrents = app.deluge_service.torrents_status(in_flight_torrent_ids)
+        app.repository.update_metadata(live_torrents)
+        torrents_by_id.update({t['_id']: t for t in live_torrents})
+    sorted_torrents = [torrents_by_id[i['deluge_torrent_id']] for i in user_torrents
+                       if i['deluge_torrent_id'] in torrents_by_id]
+
+    has_prev = has_more if backward else cursor is not None
+    has_next = True if backward else has_more
+    button_list = []
+    if user_torrents and has_prev:
+        button_list.append(InlineKeyboardButton("prev", callback_data=list_callback_data(PREV_LIST_PREFIX,
+                                                                                         user_torrents[0])))
+    if user_torrents and has_next:
+        button_list.append(InlineKeyboardButton("next", callback_data=list_callback_data(NEXT_LIST_PREFIX,
+                                                                                         user_torrents[-1])))
+    reply_markup = InlineKeyboardMarkup([button_list]) if button_list else None
+    message_lines = [app.torrent_renderer.list_line(t) for t in sorted_torrents]
     text = '\n'.join(message_lines)
     return reply_markup, text
 
 
+@timed_handler(HANDLER_SECONDS, SLOW_HANDLER_SECONDS)
 @restricted
+@deluge_required
 def handle_last_torrent_status(update: Update, context: CallbackContext):
     chat_id: int = update.effective_chat.id
     user_id: int = update.effective_chat.id
-    user_torrent = repository.last_torrent(user_id)
-    torrent = deluge_service.torrent_status(user_torrent['deluge_torrent_id'])
-
-    def build_message_line(t) -> str:
-        progress = t.get('progress', -1.0)
-        torrent_status = TorrentStatus.get_by_value_safe(t['state'])
-        emoji_t = EMOJI_MAP.get(TorrentStatus.UNKNOWN_STUB)
-        if torrent_status is TorrentStatus.ERROR:
-            emoji_t = EMOJI_MAP.get(TorrentStatus.ERROR)
-        elif progress >= 100 and torrent_status is TorrentStatus.MOVING:
-            emoji_t = EMOJI_MAP.get(TorrentStatus.MOVING)
-        elif progress >= 100:
-            emoji_t = EMOJI_MAP.get(TorrentStatus.DOWNLOADED)
-        elif progress > 0:
-            emoji_t = EMOJI_MAP.get(TorrentStatus.DOWNLOADING)
-        elif progress == 0:
-            emoji_t = EMOJI_MAP.get(TorrentStatus.CREATED)
-
-        progress_message = ''
-        if 0 <= progress < 100:
-            progress_message = f" `{progress}%`"
-
-        return f"{emoji_t}{helpers.escape_markdown(progress_message, version=2)} " \
-               f"`{helpers.escape_markdown(t['name'], version=2)}`"
-
-    context.bot.send_message(chat_id=chat_id,
-                             text=build_message_line(torrent),
-                             parse_mode=ParseMode.MARKDOWN_V2)
+    user_torrent = app.repository.last_torrent(user_id)
+    torrent = finished_torrent_snapshot(user_torrent) or \
+        app.deluge_service.torrent_status(user_torrent['deluge_torrent_id'])
+
+    app.telegram_sender.send_message(chat_id=chat_id,
+                                     text=app.torrent_renderer.status_line(torrent),
+                                     parse_mode=ParseMode.MARKDOWN_V2)
 
 
+@timed_handler(HANDLER_SECONDS, SLOW_HANDLER_SECONDS)
 @restricted
+@deluge_required
 def handle_stop_download_torrents(update: Update, context: CallbackContext):
     chat_id: int = update.effective_chat.id
-    deluge_service.stop_download_torrents()
-    context.bot.send_message(chat_id=chat_id, text='Stopping download torrents', parse_mode=ParseMode.MARKDOWN_V2)
+    app.deluge_service.stop_download_torrents()
+    app.telegram_sender.send_message(chat_id=chat_id, text='Stopping download torrents',
+                                     parse_mode=ParseMode.MARKDOWN_V2)
 
 
+@timed_handler(HANDLER_SECONDS, SLOW_HANDLER_SECONDS)
 @restricted
+@deluge_required
 def handle_resume_download_torrents(update: Update, context: CallbackContext):
-    deluge_service.resume_download_torrents()
+    app.deluge_service.resume_download_torrents()
     chat_id: int = update.effective_chat.id
-    context.bot.send_message(chat_id=chat_id, text='Starting download torrents', parse_mode=ParseMode.MARKDOWN_V2)
+    app.telegram_sender.send_message(chat_id=chat_id, text='Starting download torrents',
+                                     parse_mode=ParseMode.MARKDOWN_V2)
 
 
 def torrent_id_matcher_from_exception(e):
     return re.search('^Torrent already in session \\((.+?)\\)\\.$', str(e), re.MULTILINE)
 
 
+def is_known_torrent(torrent_id: Optional[str]) -> bool:
+    # found in the recent deluge statuses or being downloaded by the local db, without the rpc call;
+    # downloaded rows are not polled anymore and stay after the torrent is removed in deluge
+    if not torrent_id:
+        return False
+    return app.deluge_service.is_cached_torrent(torrent_id) or \
+        any(t['deluge_torrent_status'] != str(TorrentStatus.DOWNLOADED)
+            for t in app.repository.torrents_by_deluge_id(torrent_id))
+
+
+def torrent_name_or_id(torrent_id: str) -> str:
+    # the torrent may be removed in deluge since the question was asked
+    return app.deluge_service.torrent_status(torrent_id).get('name') or torrent_id
+
+
+def delete_torrent_if_exist(torrent_id: str):
+    try:
+        app.deluge_service.delete_torrent(torrent_id)
+    except Exception as e:
+        # https://github.com/deluge-torrent/deluge/blob/deluge-2.0.3/deluge/core/torrentmanager.py, remove
+        if type(e).__name__ != 'InvalidTorrentError':
+            raise e
+        logging.info(f"Torrent {torrent_id} is already removed from deluge")
+
+
+def already_exist_torrent_id_from_exception(e: Exception, local_torrent_id: Optional[str]) -> Optional[str]:
+    if type(e).__name__ != 'AddTorrentError':
+        return None
+    if local_torrent_id:
+        # deluge raises AddTorrentError for invalid torrents too, the daemon is asked whether it has the torrent
+        return local_torrent_id if app.deluge_service.torrent_status(local_torrent_id) else None
+    # the infohash of the input is unknown, the torrent id is only in the error message
+    torrent_id_matcher = torrent_id_matcher_from_exception(e)
+    return torrent_id_matcher.group(1) if torrent_id_matcher else None
+
+
+def reply_already_exist_torrent(chat_id: int, torrent_id: str, cache_key: str, cache_value: str):
+    app.repository.create_cache(cache_key, cache_value, override_on_exist=True)
+    reply_markup = build_reply_markup(torrent_id, cache_key)
+    app.telegram_sender.send_message(chat_id=chat_id,
+                                     text='Torrent already downloaded, what to do?', reply_markup=reply_markup)
+
+
 def sha256_str(skip_callback_data: str) -> str:
     return sha256(skip_callback_data.encode()).hexdigest()
 
 
 def start_download_torrent_by_magnet(magnet_url: str, user_id: int, override_on_exist=False) -> (str, str):
-    deluge_torrent_id = deluge_service.add_torrent_magnet(magnet_url)
-    torrent_name = deluge_service.torrent_name_by_id(deluge_torrent_id)
-    repository.create_torrent(user_id, deluge_torrent_id, override_on_exist=override_on_exist)
+    deluge_torrent_id = app.deluge_service.add_torrent_magnet(magnet_url)
+    torrent_name = app.deluge_service.torrent_name_by_id(deluge_torrent_id)
+    app.repository.create_torrent(user_id, deluge_torrent_id, override_on_exist=override_on_exist,
+                                  deluge_daemon=app.deluge_service.daemon_of(deluge_torrent_id))
     return torrent_name, deluge_torrent_id
 
 
@@ -368,11 +595,22 @@ def cache_key_file_value(torrent_id: str, user_id: int) -> str:
     return f'{torrent_id}_{user_id}_file_value'
 
 
-def start_download_torrent_by_file(base64_file_str: str, file_name, user_id: int, override_on_exist=False) -> (
+def cached_torrent_file_base64(cache_value: str) -> bytes:
+    # the cache value is sha256 of the file in the torrent files store, or the whole base64 file in old rows
+    if re.fullmatch('[0-9a-f]{64}', cache_value):
+        file_bytes = app.repository.get_torrent_file(cache_value)
+        if file_bytes is None:
+            raise ValueError(f"torrent file {cache_value} is expired")
+        return base64.b64encode(file_bytes)
+    return cache_value.encode()
+
+
+def start_download_torrent_by_file(file_base64: bytes, file_name, user_id: int, override_on_exist=False) -> (
         str, str):
-    deluge_torrent_id = deluge_service.add_torrent_file(file_name, base64_file_str)
-    torrent_name = deluge_service.torrent_name_by_id(deluge_torrent_id)
-    repository.create_torrent(user_id, deluge_torrent_id, override_on_exist=override_on_exist)
+    deluge_torrent_id = app.deluge_service.add_torrent_file(file_name, file_base64)
+    torrent_name = app.deluge_service.torrent_name_by_id(deluge_torrent_id)
+    app.repository.create_torrent(user_id, deluge_torrent_id, override_on_exist=override_on_exist,
+                                  deluge_daemon=app.deluge_service.daemon_of(deluge_torrent_id))
     return torrent_name, deluge_torrent_id
 
 
@@ -385,8 +623,8 @@ def build_reply_markup(already_exist_torrent_id, cache_key):
     # 64 bytes string, this is limit of callback_data
     skip_callback_data_hash = sha256_str(skip_callback_data)
     reload_callback_data_hash = sha256_str(reload_callback_data)
-    repository.create_cache(skip_callback_data_hash, skip_callback_data, override_on_exist=True)
-    repository.create_cache(reload_callback_data_hash, reload_callback_data, override_on_exist=True)
+    app.repository.create_cache(skip_callback_data_hash, skip_callback_data, override_on_exist=True)
+    app.repository.create_cache(reload_callback_data_hash, reload_callback_data, override_on_exist=True)
     keyboard = [
         [
             InlineKeyboardButton("Skip, do nothing", callback_data=skip_callback_data_hash),
@@ -401,51 +639,243 @@ def error_callback(update: Update, context: CallbackContext):
     logging.error(context.error)
 
 
-tg_request_params = {}
-if config.has_section('socks5'):
-    socks5_cfg = config['socks5']
-    tg_request_params['proxy_url'] = 'socks5://{0}:{1}'.format(socks5_cfg.get('host'), socks5_cfg.get('port'))
-    if 'username' in socks5_cfg and 'password' in socks5_cfg:
-        tg_request_params['urllib3_proxy_kwargs'] = {
-            'username': socks5_cfg['username'],
-            'password': socks5_cfg['password'],
-        }
-
-message_reload_manager = RepeatedJobManager()
-
-tg_updater = Updater(config.get('telegram', 'token'), use_context=True, request_kwargs=tg_request_params)
-dispatcher = tg_updater.dispatcher
-dispatcher.add_handler(MessageHandler(Filters.text & (~Filters.command), handle_message))
-dispatcher.add_handler(MessageHandler(Filters.document, handle_file))
-dispatcher.add_handler(CallbackQueryHandler(handle_button_callback))
-dispatcher.add_handler(CommandHandler('list', handle_torrents_list))
-dispatcher.add_handler(CommandHandler('last_torrent_status', handle_last_torrent_status))
-dispatcher.add_handler(CommandHandler('stop_torrents', handle_stop_download_torrents))
-dispatcher.add_handler(CommandHandler('resume_torrents', handle_resume_download_torrents))
-dispatcher.add_error_handler(error_callback)
-
-st = ScheduleThread([NotDownloadedTorrentsStatusCheckJob(repository, tg_updater.bot, deluge_service),
-                     ScanCommonTorrents(repository, deluge_service),
-                     DeleteExpiredCacheJob(repository)])
-st.start()
-message_reload_manager.start()
+class Application:
+    """
+    Components of the bot and their lifecycle.
+
+    Nothing connects in the constructor. `start` begins telegram polling, or the webhook listener, right away
+    and connects to deluge in the background, the scheduler and the event listener start once deluge is ready.
+    """
+    _CONNECT_MAX_BACKOFF_SECONDS = 60
+
+    def __init__(self, config: configparser.ConfigParser):
+        self.config = config
+        self.deluge_ready = threading.Event()
+        self._stopped = threading.Event()
+        self.repository = Repository(_DB_SQLITE_FILE,
+                                     journal_mode=config.get('database', 'JournalMode', fallback='DELETE'),
+                                     synchronous=config.get('database', 'Synchronous', fallback='FULL'),
+                                     write_behind=config.getboolean('database', 'WriteBehind', fallback=False))
+        self.deluge_service = DelugeCluster(config)
+        self.torrent_renderer = TorrentLineRenderer()
+        self.message_reload_manager = RepeatedJobManager()
+        self.tg_updater = self._create_updater()
+        self.telegram_sender = TelegramSender(
+            self.tg_updater.bot,
+            messages_per_second=float(config.get('telegram', 'MessagesPerSecond', fallback='25')),
+            chat_interval_seconds=float(config.get('telegram', 'ChatMessageIntervalSeconds', fallback='1')))
+
+        self.deluge_event_listeners = []
+        self.deluge_events_jobs = None
+        if config.getboolean('deluge', 'EventsEnable', fallback=False):
+            # status polling stays as a safety net for events missed while the event connection was down
+            status_check_job = NotDownloadedTorrentsStatusCheckJob(
+                self.repository, self.telegram_sender, self.deluge_service,
+                interval_seconds=int(config.get('deluge', 'EventsSafetyNetCheckIntervalSeconds', fallback='600')))
+            # checks of added torrents are delayed and run one at a time, whatever the burst of events
+            self.deluge_events_jobs = RepeatedJobManager(max_workers=1, name="deluge-events-jobs")
+            events_handler = TorrentEventsHandler(self.repository, self.deluge_service,
+                                                  TorrentStatusNotifier(self.repository, self.telegram_sender),
+                                                  self.deluge_events_jobs)
+            # a listener per daemon, the handler finds the daemon of a torrent itself
+            self.deluge_event_listeners = [DelugeEventListener(daemon.create_client, events_handler.handlers())
+                                           for daemon in self.deluge_service.daemons().values()]
+        else:
+            status_check_job = NotDownloadedTorrentsStatusCheckJob(self.repository, self.telegram_sender,
+                                                                   self.deluge_service)
+        self.free_space_sample_job = FreeSpaceSampleJob(
+            self.deluge_service, self.telegram_sender, ALLOWED_TELEGRAM_USER_IDS,
+            storage_lower_threshold_notification_bytes(),
+            interval_seconds=int(config.get('storage', 'FreeSpaceSampleIntervalSeconds', fallback='60')),
+            alert_interval_seconds=int(config.get('storage', 'FreeSpaceAlertIntervalSeconds', fallback='3600')))
+        self.schedule_thread = ScheduleThread([status_check_job,
+                                               ScanCommonTorrents(self.repository, self.deluge_service),
+                                               DeleteExpiredCacheJob(self.repository),
+                                               self.free_space_sample_job],
+                                              max_workers=int(config.get('scheduler', 'MaxWorkers', fallback='3')),
+                                              jitter_seconds=int(config.get('scheduler', 'JitterSeconds',
+                                                                            fallback='0')))
+        self.metrics_server = None
+        self.webhook_server = None
+        # `kill -USR1 <pid>` samples all threads for DurationSeconds, a second signal stops sampling early
+        self.profiler = SamplingProfiler(
+            config.get('profiling', 'Directory', fallback='profiles'),
+            duration_seconds=float(config.get('profiling', 'DurationSeconds', fallback='30')),
+            interval_seconds=float(config.get('profiling', 'SampleIntervalMs', fallback='10')) / 1000)
+
+    def _create_updater(self) -> Updater:
+        tg_request_params = {}
+        if self.config.has_section('socks5'):
+            socks5_cfg = self.config['socks5']
+            tg_request_params['proxy_url'] = 'socks5://{0}:{1}'.format(socks5_cfg.get('host'),
+                                                                       socks5_cfg.get('port'))
+            if 'username' in socks5_cfg and 'password' in socks5_cfg:
+                tg_request_params['urllib3_proxy_kwargs'] = {
+                    'username': socks5_cfg['username'],
+                    'password': socks5_cfg['password'],
+                }
+        # a local Bot API server or a stand-in like tools/fake_bot_api.py
+        base_url = self.config.get('telegram', 'BaseUrl', fallback=None) or None
+        tg_updater = Updater(self.config.get('telegram', 'token'), base_url=base_url, use_context=True,
+                             request_kwargs=tg_request_params)
+        dispatcher = tg_updater.dispatcher
+        dispatcher.add_handler(MessageHandler(Filters.text & (~Filters.command), handle_message))
+        dispatcher.add_handler(MessageHandler(Filters.document, handle_file))
+        dispatcher.add_handler(CallbackQueryHandler(handle_button_callback))
+        dispatcher.add_handler(CommandHandler('list', handle_torrents_list))
+        dispatcher.add_handler(CommandHandler('last_torrent_status', handle_last_torrent_status))
+        dispatcher.add_handler(CommandHandler('stop_torrents', handle_stop_download_torrents))
+        dispatcher.add_handler(CommandHandler('resume_torrents', handle_resume_download_torrents))
+        dispatcher.add_error_handler(error_callback)
+        return tg_updater
+
+    def start(self):
+        if self.config.getboolean('metrics', 'Enable', fallback=False):
+            self._start_metrics_server()
+        self.telegram_sender.start()
+        self.message_reload_manager.start()
+        if self.config.getboolean('webhook', 'Enable', fallback=False):
+            self._start_webhook()
+        else:
+            self.tg_updater.start_polling()
+        threading.Thread(target=self._connect_deluge, name="deluge-connect", daemon=True).start()
+
+    def _start_webhook(self):
+        # a random token unless configured, setWebhook registers it on every start anyway
+        secret_token = self.config.get('webhook', 'SecretToken', fallback=None) or secrets.token_urlsafe(32)
+        self.webhook_server = WebhookServer(self.config.get('webhook', 'Host', fallback='127.0.0.1'),
+                                            int(self.config.get('webhook', 'Port', fallback='8443')),
+                                            self.config.get('webhook', 'Path', fallback='/telegram'),
+                                            secret_token,
+                                            self.tg_updater.bot,
+                                            self.tg_updater.dispatcher,
+                                            workers=int(self.config.get('webhook', 'Workers', fallback='4')))
+        self.webhook_server.start()
+        threading.Thread(target=self._set_webhook, args=(secret_token,), name="webhook-register",
+                         daemon=True).start()
+
+    def _set_webhook(self, secret_token: str):
+        backoff = 1
+        while not self._stopped.is_set():
+            try:
+                self.tg_updater.bot.set_webhook(
+                    url=self.config.get('webhook', 'Url'),
+                    secret_token=secret_token,
+                    max_connections=int(self.config.get('webhook', 'MaxConnections', fallback='40')))
+                logging.info(f"Webhook is set to {self.config.get('webhook', 'Url')}")
+                return
+            except Exception as e:
+                logging.error(f"Can't set webhook, retry in {backoff} seconds. {e}")
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, self._CONNECT_MAX_BACKOFF_SECONDS)
+
+    def _connect_deluge(self):
+        self.deluge_service.set_owners(self.repository.torrent_daemons())
+        backoff = 1
+        while not self._stopped.is_set():
+            try:
+                self.deluge_service.connect()
+                break
+            except Exception as e:
+                logging.error(f"Can't connect to deluge, retry in {backoff} seconds. {e}")
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, self._CONNECT_MAX_BACKOFF_SECONDS)
+        if self._stopped.is_set():
+            return
+        logging.info("Deluge is connected")
+        self.deluge_ready.set()
+        self.schedule_thread.start()
+        if self.deluge_events_jobs:
+            self.deluge_events_jobs.start()
+        for listener in self.deluge_event_listeners:
+            listener.start()
+
+    def _start_metrics_server(self):
+        def scheduler_samples():
+            for job_name, job_stats in self.schedule_thread.stats().items():
+                yield 'cron_job_runs_total', 'counter', {'job': job_name}, job_stats['runs']
+                yield 'cron_job_failures_total', 'counter', {'job': job_name}, job_stats['failures']
+                yield 'cron_job_overruns_total', 'counter', {'job': job_name}, job_stats['overruns']
+                yield 'cron_job_last_duration_seconds', 'gauge', {'job': job_name}, \
+                    job_stats['last_duration_seconds']
+
+        def queue_samples():
+            yield 'repeat_jobs_pending', 'gauge', {}, self.message_reload_manager.pending_jobs()
+            sender_stats = self.telegram_sender.stats()
+            yield 'telegram_send_queue_depth', 'gauge', {}, sender_stats['queue_depth']
+            yield 'telegram_sent_total', 'counter', {}, sender_stats['sent']
+            yield 'telegram_send_failed_total', 'counter', {}, sender_stats['failed']
+            yield 'telegram_edits_merged_total', 'counter', {}, sender_stats['edits_merged']
+            yield 'telegram_edits_skipped_total', 'counter', {}, sender_stats['edits_skipped']
+            if self.webhook_server:
+                webhook_stats = self.webhook_server.stats()
+                yield 'webhook_queue_depth', 'gauge', {}, webhook_stats['queue_depth']
+                for key in ('received', 'rejected', 'processed', 'failed'):
+                    yield f'webhook_updates_{key}_total', 'counter', {}, webhook_stats[key]
+
+        def cache_samples():
+            status_cache_stats = self.deluge_service.status_cache_stats()
+            # coalesced requests waited for an in-flight load and made no rpc call
+            yield 'cache_hits_total', 'counter', {'cache': 'deluge_status'}, \
+                status_cache_stats['hits'] + status_cache_stats['coalesced']
+            yield 'cache_misses_total', 'counter', {'cache': 'deluge_status'}, status_cache_stats['misses']
+            memory_cache_stats = self.repository.memory_cache_stats()
+            yield 'cache_hits_total', 'counter', {'cache': 'repository_memory'}, memory_cache_stats['hits']
+            yield 'cache_misses_total', 'counter', {'cache': 'repository_memory'}, memory_cache_stats['misses']
+            renderer_stats = self.torrent_renderer.stats()
+            yield 'cache_hits_total', 'counter', {'cache': 'torrent_lines'}, renderer_stats['hits']
+            yield 'cache_misses_total', 'counter', {'cache': 'torrent_lines'}, renderer_stats['misses']
+
+        def deluge_samples():
+            yield 'deluge_ready', 'gauge', {}, 1 if self.deluge_ready.is_set() else 0
+            for daemon_name, pool_metrics in self.deluge_service.pool_metrics().items():
+                for key, value in pool_metrics.items():
+                    yield f'deluge_pool_{key}', 'gauge', {'daemon': daemon_name}, value
+
+        for collector in (scheduler_samples, queue_samples, cache_samples, deluge_samples):
+            REGISTRY.add_collector(collector)
+        self.metrics_server = MetricsServer(self.config.get('metrics', 'Host', fallback='127.0.0.1'),
+                                            int(self.config.get('metrics', 'Port', fallback='9100')))
+        self.metrics_server.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self.schedule_thread.is_alive():
+            self.schedule_thread.stop()
+        for listener in self.deluge_event_listeners:
+            if listener.is_alive():
+                listener.stop()
+        if self.metrics_server:
+            self.metrics_server.stop()
+        if self.webhook_server:
+            self.webhook_server.stop()
+        self.repository.disconnect()
+        self.tg_updater.stop()
+        self.telegram_sender.stop()
+        self.deluge_service.disconnect()
+
+
+app: Optional[Application] = None
 
 
 def stop_app(g, i):
     try:
-        st.stop()
-        repository.disconnect()
-        tg_updater.stop()
-        deluge_service.disconnect()
+        app.stop()
         sys.exit(0)
     except Exception as e:
         logging.error("Exiting immediately cause error {}".format(e))
         sys.exit(1)
 
 
-signal.signal(signal.SIGINT, stop_app)
-signal.signal(signal.SIGTERM, stop_app)
+def main():
+    global app
+    app = Application(config)
+    signal.signal(signal.SIGINT, stop_app)
+    signal.signal(signal.SIGTERM, stop_app)
+    signal.signal(signal.SIGUSR1, app.profiler.toggle)
+    app.start()
+    signal.pause()
 
-tg_updater.start_polling()
 
-signal.pause()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+import bisect
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, TypeVar
+
+T = TypeVar('T')
+# (metric name, 'gauge' or 'counter', labels, value), read from the component on every scrape
+Sample = Tuple[str, str, Dict[str, str], float]
+
+_DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# timing of the handler running in the current thread, see `timed_handler`
+_current_request = threading.local()
+
+
+class _RequestTiming:
+
+    def __init__(self, label: str):
+        self.label = label
+        self.seconds_by_category: Dict[str, float] = defaultdict(float)
+        # calls of the handler may run on worker threads, see `with_request_timing`
+        self._lock = threading.Lock()
+
+    def add(self, category: str, seconds: float):
+        with self._lock:
+            self.seconds_by_category[category] += seconds
+
+    def breakdown(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self.seconds_by_category)
+
+
+class Histogram:
+    """
+    Latency histogram with one label, rendered in the prometheus text format.
+
+    Observing is a bisect and two additions under a lock, cheap enough to stay on in production.
+    """
+
+    def __init__(self, name: str, documentation: str, label_name: str, buckets: Sequence[float] = _DEFAULT_BUCKETS,
+                 category: Optional[str] = None):
+        self.name = name
+        # observations are also added to the breakdown of the running handler under this category
+        self._category = category
+        self._documentation = documentation
+        self._label_name = label_name
+        self._buckets = tuple(buckets)
+        # label value -> [count per bucket..., count of +Inf bucket, sum]
+        self._values: Dict[str, List[float]] = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, seconds: float):
+        index = bisect.bisect_left(self._buckets, seconds)
+        with self._lock:
+            values = self._values.get(label_value)
+            if values is None:
+                values = self._values[label_value] = [0] * (len(self._buckets) + 2)
+            values[index] += 1
+            values[-1] += seconds
+        request = getattr(_current_request, 'timing', None)
+        if request is not None and self._category:
+            request.add(self._category, seconds)
+
+    @contextmanager
+    def time(self, label_value: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(label_value, time.perf_counter() - start)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self._documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values_by_label = {label: list(values) for label, values in self._values.items()}
+        for label_value, values in sorted(values_by_label.items()):
+            label = f'{self._label_name}="{_escape(label_value)}"'
+            cumulative = 0
+            for bound, count in zip(self._buckets + ('+Inf',), values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{label}}} {values[-1]}')
+            lines.append(f'{self.name}_count{{{label}}} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self._histograms: List[Histogram] = []
+        self._collectors: List[Callable[[], Iterable[Sample]]] = []
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str, documentation: str, label_name: str, category: Optional[str] = None) -> Histogram:
+        histogram = Histogram(name, documentation, label_name, category=category)
+        with self._lock:
+            self._histograms.append(histogram)
+        return histogram
+
+    def add_collector(self, collector: Callable[[], Iterable[Sample]]):
+        """
+        `collector` is called on every scrape, samples with the same name are rendered as one family.
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self) -> str:
+        with self._lock:
+            histograms = list(self._histograms)
+            collectors = list(self._collectors)
+        lines = []
+        for histogram in histograms:
+            lines += histogram.render()
+        families: Dict[str, List[str]] = dict()
+        for collector in collectors:
+            try:
+                samples = list(collector())
+            except Exception as e:
+                logging.error(f"Metrics collector {collector.__name__} failed. {e}")
+                continue
+            for name, metric_type, labels, value in samples:
+                family = families.setdefault(name, [f"# TYPE {name} {metric_type}"])
+                label_str = ','.join(f'{k}="{_escape(str(v))}"' for k, v in labels.items())
+                family.append(f"{name}{{{label_str}}} {float(value)}" if label_str else f"{name} {float(value)}")
+        for family in families.values():
+            lines += family
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+DELUGE_RPC_SECONDS = REGISTRY.histogram('deluge_rpc_seconds', 'Deluge rpc call latency.', 'method', category='rpc')
+REPOSITORY_QUERY_SECONDS = REGISTRY.histogram('repository_query_seconds', 'Sqlite repository call latency.',
+                                              'query', category='db')
+TELEGRAM_API_SECONDS = REGISTRY.histogram('telegram_api_seconds', 'Synchronous telegram Bot API call latency.',
+                                          'method', category='telegram')
+HANDLER_SECONDS = REGISTRY.histogram('telegram_handler_seconds', 'Telegram update handler latency.', 'handler')
+
+
+def timed(histogram: Histogram):
+    """
+    Decorator observing the duration of every call, labeled with the function name.
+    """
+
+    def decorator(func):
+        label_value = func.__name__
+
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            with histogram.time(label_value):
+                return func(*args, **kwargs)
+
+        return wrapped
+
+    return decorator
+
+
+def timed_handler(histogram: Histogram, slow_threshold_seconds: float):
+    """
+    Decorator of telegram handlers, observes the handler duration and logs slow runs with the time spent
+    in deluge rpc, sqlite and telegram calls made by the handler, also on executor threads with `with_request_timing`.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            previous = getattr(_current_request, 'timing', None)
+            timing = _current_request.timing = _RequestTiming(func.__name__)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                _current_request.timing = previous
+                histogram.observe(timing.label, seconds)
+                if seconds > slow_threshold_seconds:
+                    breakdown = timing.breakdown()
+                    breakdown['other'] = max(seconds - sum(breakdown.values()), 0)
+                    logging.warning(f"Slow handler {timing.label} {seconds:.3f}s: " +
+                                    ', '.join(f'{k} {v:.3f}s' for k, v in sorted(breakdown.items())))
+
+        return wrapped
+
+    return decorator
+
+
+def with_request_timing(fn: Callable[..., T]) -> Callable[..., T]:
+    """
+    Binds `fn` to the timing of the handler running in the current thread, for callables submitted to
+    an executor: their calls are in the breakdown of the handler. Calls in parallel threads add up,
+    so the breakdown may sum up to more than the handler duration.
+    """
+    timing = getattr(_current_request, 'timing', None)
+    if timing is None:
+        return fn
+
+    @wraps(fn)
+    def wrapped(*args, **kwargs):
+        previous = getattr(_current_request, 'timing', None)
+        _current_request.timing = timing
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current_request.timing = previous
+
+    return wrapped
+
+
+def label_request(label: str):
+    """
+    Replaces the handler name in the timing of the running handler, e.g. with a callback action.
+    """
+    timing = getattr(_current_request, 'timing', None)
+    if timing is not None:
+        timing.label = label
+
+
+class MetricsServer(threading.Thread):
+    """
+    Serves `GET /metrics` of the registry in the prometheus text format.
+    """
+
+    def __init__(self, host: str, port: int, registry: MetricsRegistry = REGISTRY):
+        super().__init__(name="metrics-server", daemon=True)
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(f"metrics {self.address_string()} {format % args}")
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+
+    def run(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,82 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Optional
+
+
+class SamplingProfiler:
+    """
+    Samples stacks of all threads for a while and writes them to disk, started and stopped by a signal.
+
+    cProfile sees only the thread which enabled it, and the bot works in the dispatcher, scheduler and sender
+    threads, so the stacks are sampled with `sys._current_frames`. The `.collapsed` file has one stack per line with
+    its sample count (flamegraph.pl and speedscope read it), `.top.txt` lists the hottest functions.
+    """
+    _TOP_FUNCTIONS = 30
+
+    def __init__(self, output_dir: str, duration_seconds: float = 30, interval_seconds: float = 0.01):
+        self._output_dir = output_dir
+        self._duration_seconds = duration_seconds
+        self._interval_seconds = interval_seconds
+        self._lock = threading.Lock()
+        self._stop_event: Optional[threading.Event] = None
+
+    def toggle(self, *_):
+        """
+        Signal handler, starts a session or stops the running one early.
+        """
+        with self._lock:
+            if self._stop_event:
+                self._stop_event.set()
+                return
+            self._stop_event = threading.Event()
+            threading.Thread(target=self._run, args=(self._stop_event,), name="sampling-profiler",
+                             daemon=True).start()
+
+    def _run(self, stop_event: threading.Event):
+        logging.info(f"Profiling for {self._duration_seconds} seconds")
+        own_thread_id = threading.get_ident()
+        thread_names = {t.ident: t.name for t in threading.enumerate()}
+        stacks = Counter()
+        samples = 0
+        deadline = time.monotonic() + self._duration_seconds
+        while not stop_event.is_set() and time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                thread_name = thread_names.get(thread_id) or str(thread_id)
+                stacks[';'.join([thread_name] + stack[::-1])] += 1
+            samples += 1
+            stop_event.wait(self._interval_seconds)
+        with self._lock:
+            self._stop_event = None
+        try:
+            path = self._dump(stacks, samples)
+            logging.info(f"Profile of {samples} samples is written to {path}")
+        except OSError as e:
+            logging.error(f"Profile dump failed. {e}")
+
+    def _dump(self, stacks: Counter, samples: int) -> str:
+        os.makedirs(self._output_dir, exist_ok=True)
+        path = os.path.join(self._output_dir, f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}")
+        with open(f"{path}.collapsed", 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        # leaf functions by samples, the time spent in the function itself
+        leaves = Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        with open(f"{path}.top.txt", 'w') as f:
+            f.write(f"{samples} samples every {self._interval_seconds}s\n")
+            for function, count in leaves.most_common(self._TOP_FUNCTIONS):
+                f.write(f"{count:8d} {function}\n")
+        return path
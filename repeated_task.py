@@ -1,10 +1,13 @@
+import heapq
+import itertools
 import logging
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import timedelta
-from queue import Queue
 from threading import Thread
-from typing import Dict, Callable
+from typing import Dict, Callable, List, Tuple
 
 
 @dataclass
@@ -15,53 +18,73 @@ class RepeatJob:
     repeat_count: int = 5
 
 
+class _ScheduledRepeatJob:
+
+    def __init__(self, repeat_job: RepeatJob):
+        self.repeat_job = repeat_job
+        self.executed = 0
+        self.cancelled = False
+
+
 class RepeatedJobManager(Thread):
+    """
+    Runs all repeat jobs from one timer thread ordered by a heap of deadlines, jobs are executed by a small pool.
+
+    Scheduling a job with the same `uniq_id` replaces the previous one and starts counting repeats again.
+    """
 
-    def __init__(self):
-        Thread.__init__(self, name="repeated-job-manager", daemon=True)
-        self._queue = Queue()
-        self._workers: Dict[str, RepeatJobThread] = dict()
+    def __init__(self, max_workers: int = 4, name: str = "repeated-job-manager"):
+        Thread.__init__(self, name=name, daemon=True)
+        self._condition = threading.Condition()
+        self._heap: List[Tuple[float, int, _ScheduledRepeatJob]] = []
+        self._sequence = itertools.count()
+        self._jobs: Dict[str, _ScheduledRepeatJob] = dict()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}-worker")
 
     def run(self):
         while True:
-            repeat_job = self._queue.get()
-
-            if isinstance(repeat_job, RepeatJob):
-                worker_thread = self._workers.get(repeat_job.uniq_id, None)
-                if worker_thread and worker_thread.is_alive():
-                    logging.info(f"Reset worker for {repeat_job.uniq_id}")
-                    worker_thread.reset(repeat_job.job)
-                else:
-                    logging.info(f"Create new worker for {repeat_job.uniq_id}")
-                    message_reloader = RepeatJobThread(repeat_job)
-                    self._workers[repeat_job.uniq_id] = message_reloader
-                    message_reloader.start()
-            self._queue.task_done()
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._condition.wait(timeout)
+                _, _, scheduled_job = heapq.heappop(self._heap)
+            # cancelled jobs are removed lazily, when their deadline comes
+            if not scheduled_job.cancelled:
+                self._executor.submit(self._execute, scheduled_job)
 
     def schedule(self, reload_message_job: RepeatJob):
-        self._queue.put(reload_message_job)
-
+        scheduled_job = _ScheduledRepeatJob(reload_message_job)
+        with self._condition:
+            previous_job = self._jobs.get(reload_message_job.uniq_id)
+            if previous_job:
+                logging.info(f"Reset worker for {reload_message_job.uniq_id}")
+                previous_job.cancelled = True
+            else:
+                logging.info(f"Create new worker for {reload_message_job.uniq_id}")
+            self._jobs[reload_message_job.uniq_id] = scheduled_job
+            self._push(scheduled_job)
 
-class RepeatJobThread(Thread):
+    def pending_jobs(self) -> int:
+        with self._condition:
+            return len(self._jobs)
 
-    def __init__(self, repeat_job: RepeatJob):
-        Thread.__init__(self, name=f"repeat-job-{repeat_job.uniq_id}", daemon=True)
-        self._uniq_id = repeat_job.uniq_id
-        self._repeat_interval = repeat_job.repeat_interval
-        self._repeat_count = repeat_job.repeat_count
-        self._job = repeat_job.job
-        self._execute_job_counter = 0
-
-    def run(self):
-        while self._execute_job_counter < self._repeat_count:
-            time.sleep(self._repeat_interval.total_seconds())
-            logging.info(f"Execute job for {self._uniq_id}")
-            try:
-                self._job()
-            except Exception as e:
-                logging.error(f"RepeatJob {self._uniq_id} error. {e}")
-            self._execute_job_counter += 1
+    def _execute(self, scheduled_job: _ScheduledRepeatJob):
+        repeat_job = scheduled_job.repeat_job
+        logging.info(f"Execute job for {repeat_job.uniq_id}")
+        try:
+            repeat_job.job()
+        except Exception as e:
+            logging.error(f"RepeatJob {repeat_job.uniq_id} error. {e}")
+        scheduled_job.executed += 1
+        with self._condition:
+            if scheduled_job.cancelled:
+                return
+            if scheduled_job.executed < repeat_job.repeat_count:
+                self._push(scheduled_job)
+            else:
+                del self._jobs[repeat_job.uniq_id]
 
-    def reset(self, job: Callable[[], None]):
-        self._execute_job_counter = self._repeat_count
-        self._job = job
+    def _push(self, scheduled_job: _ScheduledRepeatJob):
+        deadline = time.monotonic() + scheduled_job.repeat_job.repeat_interval.total_seconds()
+        heapq.heappush(self._heap, (deadline, next(self._sequence), scheduled_job))
+        self._condition.notify()
@@ -1,6 +1,16 @@
+import logging
 import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 from enum import Enum
+from hashlib import sha256
+from typing import Callable, Optional, List, Set, Tuple, Dict
+
+from metrics import timed, REPOSITORY_QUERY_SECONDS
 
 COMMON_FOR_ALL_TG_USER_ID = 0
 
@@ -29,45 +39,198 @@ class TorrentStatus(Enum):
 class Repository:
     _TORRENT_TABLE = "torrents"
     _CACHE_TABLE = "cache"
+    _TORRENT_FILE_TABLE = "torrent_files"
 
-    def __init__(self, db_file):
-        self.conn = sqlite3.connect(db_file, check_same_thread=False)
-        self.conn.row_factory = sqlite3.Row
-        self.__ini_db()
+    _SCHEMA_VERSION_TABLE = "schema_version"
+    # ordered schema migrations, a position in the list (starting from 1) is a schema version
+    _MIGRATIONS = [
+        [
+            f"""CREATE TABLE IF NOT EXISTS {_TORRENT_TABLE} (
+            id integer PRIMARY KEY,
+            create_time text NOT NULL,
+            last_update_time text NOT NULL,
+            tg_user_id integer NOT NULL,
+            deluge_torrent_id text NOT NULL,
+            deluge_torrent_status text NOT NULL ,
+            UNIQUE(tg_user_id,deluge_torrent_id) )
+            """,
+            f"""CREATE TABLE IF NOT EXISTS {_CACHE_TABLE} (
+            key text NOT NULL,
+            value text NOT NULL,
+            create_time text NOT NULL,
+            ttl_seconds integer NOT NULL)
+            """,
+            f"CREATE UNIQUE INDEX IF NOT EXISTS idx_key ON {_CACHE_TABLE} (key)",
+        ],
+        [
+            # torrent_exist_by_deluge_id, update_status, delete_torrent, torrents_by_deluge_id
+            f"CREATE INDEX IF NOT EXISTS idx_torrents_deluge_torrent_id "
+            f"ON {_TORRENT_TABLE} (deluge_torrent_id, tg_user_id, deluge_torrent_status)",
+            # not_downloaded_torrents, only not downloaded rows are in the index
+            f"CREATE INDEX IF NOT EXISTS idx_torrents_not_downloaded "
+            f"ON {_TORRENT_TABLE} (deluge_torrent_status, tg_user_id, deluge_torrent_id) "
+            f"WHERE deluge_torrent_status != '{TorrentStatus.DOWNLOADED}'",
+            # last_torrent
+            f"CREATE INDEX IF NOT EXISTS idx_torrents_tg_user_id_create_time "
+            f"ON {_TORRENT_TABLE} (tg_user_id, create_time)",
+        ],
+        [
+            # unix time of expiration, expired rows are found by the index range instead of evaluating every row
+            f"ALTER TABLE {_CACHE_TABLE} ADD COLUMN expires_at integer NOT NULL DEFAULT 0",
+            f"UPDATE {_CACHE_TABLE} SET expires_at = CAST(strftime('%s', create_time) AS integer) + ttl_seconds",
+            f"CREATE INDEX IF NOT EXISTS idx_cache_expires_at ON {_CACHE_TABLE} (expires_at)",
+        ],
+        [
+            # unix time the torrent list is ordered by: deluge 'completed_time', or 'time_added' if not completed
+            f"ALTER TABLE {_TORRENT_TABLE} ADD COLUMN sort_time real NOT NULL DEFAULT 0",
+            f"UPDATE {_TORRENT_TABLE} SET sort_time = CAST(strftime('%s', create_time) AS real)",
+            # keyset pagination of user_torrents_page
+            f"CREATE INDEX IF NOT EXISTS idx_torrents_tg_user_id_sort_time "
+            f"ON {_TORRENT_TABLE} (tg_user_id, sort_time, id)",
+        ],
+        [
+            # last known deluge torrent status, NULL until the torrent is seen in deluge
+            f"ALTER TABLE {_TORRENT_TABLE} ADD COLUMN name text",
+            f"ALTER TABLE {_TORRENT_TABLE} ADD COLUMN state text",
+            f"ALTER TABLE {_TORRENT_TABLE} ADD COLUMN progress real",
+            f"ALTER TABLE {_TORRENT_TABLE} ADD COLUMN total_wanted integer",
+            f"ALTER TABLE {_TORRENT_TABLE} ADD COLUMN total_done integer",
+            f"ALTER TABLE {_TORRENT_TABLE} ADD COLUMN time_added real",
+            f"ALTER TABLE {_TORRENT_TABLE} ADD COLUMN completed_time real",
+        ],
+        [
+            # uploaded .torrent files by sha256 of the content, raw bytes instead of base64 text in the cache table
+            f"""CREATE TABLE IF NOT EXISTS {_TORRENT_FILE_TABLE} (
+            sha256 text PRIMARY KEY,
+            data blob NOT NULL,
+            size integer NOT NULL,
+            expires_at integer NOT NULL)
+            """,
+            f"CREATE INDEX IF NOT EXISTS idx_torrent_files_expires_at ON {_TORRENT_FILE_TABLE} (expires_at)",
+        ],
+        [
+            # name of the deluge daemon the torrent is on, NULL until known
+            f"ALTER TABLE {_TORRENT_TABLE} ADD COLUMN deluge_daemon text",
+        ],
+    ]
+    # deluge status fields materialized in the torrents table, the column names match deluge field names
+    _METADATA_FIELDS = ['name', 'state', 'progress', 'total_wanted', 'total_done', 'time_added', 'completed_time']
+    _TORRENT_COLUMNS = ', '.join(['id', 'create_time', 'last_update_time', 'tg_user_id', 'deluge_torrent_id',
+                                  'deluge_torrent_status', 'sort_time', 'deluge_daemon'] + _METADATA_FIELDS)
+    _DELETE_EXPIRED_CACHE_BATCH_SIZE = 500
+    # a writer waits this long for the lock held by another connection
+    _BUSY_TIMEOUT_SECONDS = 10
+    # https://www.sqlite.org/pragma.html, applied to every connection
+    _CONNECTION_PRAGMAS = [
+        "PRAGMA temp_store = MEMORY",
+        # 8 MiB page cache per connection
+        "PRAGMA cache_size = -8192",
+    ]
 
-    def __ini_db(self):
-        sql_create_auth_token = f"""CREATE TABLE IF NOT EXISTS {self._TORRENT_TABLE} (
-        id integer PRIMARY KEY,
-        create_time text NOT NULL,
-        last_update_time text NOT NULL,
-        tg_user_id integer NOT NULL,
-        deluge_torrent_id text NOT NULL,
-        deluge_torrent_status text NOT NULL ,
-        UNIQUE(tg_user_id,deluge_torrent_id) )
+    def __init__(self, db_file, memory_cache_size: int = 1024, torrent_files_max_bytes: int = 256 * 1024 * 1024,
+                 journal_mode: str = 'DELETE', synchronous: str = 'FULL', write_behind=False):
         """
-
-        sql_create_cache = f"""CREATE TABLE IF NOT EXISTS {self._CACHE_TABLE} (
-        key text NOT NULL,
-        value text NOT NULL,
-        create_time text NOT NULL,
-        ttl_seconds integer NOT NULL)
+        The rollback journal keeps every commit in the database file itself. WAL is opt-in: readers don't block
+        the writer and a commit appends to the log, with synchronous NORMAL only checkpoints wait for fsync,
+        but the `-wal` and `-shm` files next to the database must be kept too, e.g. a mounted directory.
+        With `write_behind` writes in a `batch` block are committed together.
         """
+        self._torrent_files_max_bytes = torrent_files_max_bytes
+        self._db_file = db_file
+        self._journal_mode = journal_mode
+        self._synchronous = synchronous
+        self._write_behind = write_behind
+        # a connection per thread, closed when the thread is finished; an in-memory database exists
+        # only in its connection, so it is shared by all threads
+        self._local = threading.local()
+        self._connections: List[Tuple[weakref.ref, sqlite3.Connection]] = []
+        self._connections_lock = threading.Lock()
+        self._shared_conn = self._connect() if db_file == ':memory:' else None
+        # in-memory front of the cache table, rows are dicts with the same keys as in the table
+        self._memory_cache = _LruDict(memory_cache_size)
+        self.__ini_db()
 
-        sql_cache_index = f"CREATE UNIQUE INDEX IF NOT EXISTS idx_key ON {self._CACHE_TABLE} (key);"
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._shared_conn is not None:
+            return self._shared_conn
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            with self._connections_lock:
+                connections = []
+                for thread_ref, thread_conn in self._connections:
+                    thread = thread_ref()
+                    if thread is not None and thread.is_alive():
+                        connections.append((thread_ref, thread_conn))
+                    else:
+                        thread_conn.close()
+                connections.append((weakref.ref(threading.current_thread()), conn))
+                self._connections = connections
+        return conn
 
-        for sql in [sql_create_auth_token, sql_create_cache, sql_cache_index]:
-            self.conn.execute(sql)
+    def _connect(self) -> sqlite3.Connection:
+        # the connection is used by its thread only, another thread closes it after the owner is finished
+        conn = sqlite3.connect(self._db_file, check_same_thread=False, timeout=self._BUSY_TIMEOUT_SECONDS)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA synchronous = {self._synchronous}")
+        for pragma in self._CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
 
-    def create_torrent(self, tg_user_id: int, deluge_torrent_id: str, override_on_exist=False):
+    def __ini_db(self):
+        # persistent, set once for the database file
+        self.conn.execute(f"PRAGMA journal_mode = {self._journal_mode}")
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {self._SCHEMA_VERSION_TABLE} (version integer NOT NULL)")
+        row = self.conn.execute(f"SELECT MAX(version) as version FROM {self._SCHEMA_VERSION_TABLE}").fetchone()
+        current_version = row['version'] or 0
+        for version, statements in enumerate(self._MIGRATIONS[current_version:], start=current_version + 1):
+            logging.info(f"Migrate database schema to version {version}")
+            # every migration is applied atomically, a failed one is retried on the next start
+            with self.conn:
+                self.conn.execute("BEGIN")
+                for sql in statements:
+                    self.conn.execute(sql)
+                self.conn.execute(f"INSERT INTO {self._SCHEMA_VERSION_TABLE} (version) VALUES (?)", (version,))
+
+    @timed(REPOSITORY_QUERY_SECONDS)
+    def schema_version(self) -> int:
+        row = self.conn.execute(f"SELECT MAX(version) as version FROM {self._SCHEMA_VERSION_TABLE}").fetchone()
+        return row['version'] or 0
+
+    @timed(REPOSITORY_QUERY_SECONDS)
+    def create_torrent(self, tg_user_id: int, deluge_torrent_id: str, override_on_exist=False,
+                       sort_time: Optional[float] = None, deluge_daemon: Optional[str] = None):
         x = (datetime.utcnow().isoformat(), datetime.utcnow().isoformat(), tg_user_id, deluge_torrent_id,
-             str(TorrentStatus.CREATED))
+             str(TorrentStatus.CREATED), sort_time or time.time(), deluge_daemon)
         with self.conn:
             self.conn.execute(
                 f"INSERT {'OR REPLACE' if override_on_exist else ''} INTO {self._TORRENT_TABLE} "
                 f"(create_time, last_update_time, tg_user_id, deluge_torrent_id, "
-                f"deluge_torrent_status) VALUES (?,?,?,?,?)",
+                f"deluge_torrent_status, sort_time, deluge_daemon) VALUES (?,?,?,?,?,?,?)",
                 x)
 
+    @timed(REPOSITORY_QUERY_SECONDS)
+    def create_torrents(self, tg_user_id: int, deluge_torrent_ids: List[str],
+                        deluge_daemons: Optional[Dict[str, str]] = None):
+        """
+        Bulk insert of the user torrents in one transaction, existing rows are replaced.
+        `deluge_daemons` maps torrent ids to their daemon names.
+        """
+        now = datetime.utcnow().isoformat()
+        sort_time = time.time()
+        deluge_daemons = deluge_daemons or dict()
+        rows = [(now, now, tg_user_id, torrent_id, str(TorrentStatus.CREATED), sort_time,
+                 deluge_daemons.get(torrent_id))
+                for torrent_id in deluge_torrent_ids]
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO {self._TORRENT_TABLE} "
+                f"(create_time, last_update_time, tg_user_id, deluge_torrent_id, "
+                f"deluge_torrent_status, sort_time, deluge_daemon) VALUES (?,?,?,?,?,?,?)",
+                rows)
+
+    @timed(REPOSITORY_QUERY_SECONDS)
     def delete_torrent(self, deluge_torrent_id: str):
         with self.conn:
             self.conn.execute(
@@ -75,9 +238,55 @@ class Repository:
                 f"WHERE deluge_torrent_id = '{deluge_torrent_id}'")
             return self.conn.total_changes
 
-    def create_common_torrent(self, deluge_torrent_id: str, override_on_exist=False):
-        return self.create_torrent(COMMON_FOR_ALL_TG_USER_ID, deluge_torrent_id, override_on_exist)
+    @timed(REPOSITORY_QUERY_SECONDS)
+    def delete_not_downloaded_torrent(self, deluge_torrent_id: str) -> int:
+        """
+        Deletes rows of the torrent which are not downloaded yet, downloaded ones stay in the history.
+        """
+        with self.conn:
+            return self.conn.execute(f"DELETE FROM {self._TORRENT_TABLE} "
+                                     f"WHERE deluge_torrent_id = ? AND deluge_torrent_status != ?",
+                                     (deluge_torrent_id, str(TorrentStatus.DOWNLOADED))).rowcount
+
+    def create_common_torrent(self, deluge_torrent_id: str, override_on_exist=False,
+                              deluge_daemon: Optional[str] = None):
+        return self.create_torrent(COMMON_FOR_ALL_TG_USER_ID, deluge_torrent_id, override_on_exist,
+                                   deluge_daemon=deluge_daemon)
 
+    @timed(REPOSITORY_QUERY_SECONDS)
+    def create_common_torrents(self, deluge_torrents: List[Tuple[str, float, Optional[str]]]) -> int:
+        """
+        Bulk insert in one transaction, `deluge_torrents` are deluge torrent id, sort time and daemon name.
+        """
+        now = datetime.utcnow().isoformat()
+        rows = [(now, now, COMMON_FOR_ALL_TG_USER_ID, torrent_id, str(TorrentStatus.CREATED), sort_time,
+                 deluge_daemon)
+                for torrent_id, sort_time, deluge_daemon in deluge_torrents]
+        with self.conn:
+            c = self.conn.executemany(
+                f"INSERT OR IGNORE INTO {self._TORRENT_TABLE} "
+                f"(create_time, last_update_time, tg_user_id, deluge_torrent_id, "
+                f"deluge_torrent_status, sort_time, deluge_daemon) VALUES (?,?,?,?,?,?,?)",
+                rows)
+            return c.rowcount
+
+    @timed(REPOSITORY_QUERY_SECONDS)
+    def all_deluge_torrent_ids(self) -> Set[str]:
+        c = self.conn.cursor()
+        c.execute(f"SELECT DISTINCT deluge_torrent_id FROM {self._TORRENT_TABLE}")
+        return {row['deluge_torrent_id'] for row in c.fetchall()}
+
+    @timed(REPOSITORY_QUERY_SECONDS)
+    def torrent_daemons(self) -> Dict[str, str]:
+        """
+        Deluge daemon name by torrent id, of torrents with a known daemon.
+        """
+        c = self.conn.cursor()
+        c.execute(f"SELECT DISTINCT deluge_torrent_id, deluge_daemon FROM {self._TORRENT_TABLE} "
+                  f"WHERE deluge_daemon IS NOT NULL")
+        return {row['deluge_torrent_id']: row['deluge_daemon'] for row in c.fetchall()}
+
+    @timed(REPOSITORY_QUERY_SECONDS)
     def torrent_exist_by_deluge_id(self, deluge_torrent_id: str) -> bool:
         c = self.conn.cursor()
         c.execute(
@@ -88,61 +297,250 @@ class Repository:
         else:
             return False
 
-    def update_status(self, deluge_torrent_id: str, new_status: TorrentStatus):
+    @timed(REPOSITORY_QUERY_SECONDS)
+    def update_status(self, deluge_torrent_id: str, new_status: TorrentStatus, sort_time: Optional[float] = None):
         if new_status is None or not isinstance(new_status, TorrentStatus):
             raise ValueError("invalid 'torrent_status' to update")
-        with self.conn:
-            self.conn.execute(f"UPDATE {self._TORRENT_TABLE} SET deluge_torrent_status = '{new_status}',"
-                              f"last_update_time='{datetime.utcnow().isoformat()}'"
-                              f"WHERE deluge_torrent_id = '{deluge_torrent_id}'")
+        if sort_time is None and new_status is TorrentStatus.DOWNLOADED:
+            # completed just now
+            sort_time = time.time()
+        self._write(f"UPDATE {self._TORRENT_TABLE} SET deluge_torrent_status = ?, last_update_time = ?, "
+                    f"sort_time = COALESCE(?, sort_time) "
+                    f"WHERE deluge_torrent_id = ?",
+                    [(str(new_status), datetime.utcnow().isoformat(), sort_time, deluge_torrent_id)])
+
+    @timed(REPOSITORY_QUERY_SECONDS)
+    def update_metadata(self, torrents: List[Dict]):
+        """
+        Stores deluge statuses, `torrents` are dicts with the deluge torrent id in '_id' and `_METADATA_FIELDS`,
+        and optionally the daemon name in '_daemon'.
+        """
+        rows = []
+        for t in torrents:
+            sort_time = t['completed_time'] if t['completed_time'] > 0 else t['time_added']
+            rows.append(tuple(t[f] for f in self._METADATA_FIELDS) + (sort_time, t.get('_daemon'), t['_id']))
+        self._write(f"UPDATE {self._TORRENT_TABLE} SET "
+                    f"{', '.join(f'{f} = ?' for f in self._METADATA_FIELDS)}, sort_time = ?, "
+                    f"deluge_daemon = COALESCE(?, deluge_daemon) "
+                    f"WHERE deluge_torrent_id = ?",
+                    rows)
+
+    @contextmanager
+    def batch(self):
+        """
+        With write-behind, status and metadata updates of the thread in the block are committed in one
+        transaction at its end, instead of a transaction and a commit each. Reads in the block don't see them.
+        """
+        if not self._write_behind or getattr(self._local, 'pending', None) is not None:
+            yield
+            return
+        self._local.pending = []
+        try:
+            yield
+        finally:
+            pending, self._local.pending = self._local.pending, None
+            if pending:
+                with REPOSITORY_QUERY_SECONDS.time('batch'), self.conn:
+                    for sql, rows in pending:
+                        self.conn.executemany(sql, rows)
+
+    def _write(self, sql: str, rows: List[tuple]):
+        pending = getattr(self._local, 'pending', None)
+        if pending is None:
+            with self.conn:
+                self.conn.executemany(sql, rows)
+        elif pending and pending[-1][0] == sql:
+            # consecutive updates of the same kind are one executemany
+            pending[-1][1].extend(rows)
+        else:
+            pending.append((sql, list(rows)))
+
+    @staticmethod
+    def metadata_snapshot(row: sqlite3.Row) -> Optional[Dict]:
+        """
+        Materialized deluge status of the row in the shape of DelugeService.torrents_status items.
+        """
+        if row['name'] is None:
+            return None
+        snapshot = {f: row[f] for f in Repository._METADATA_FIELDS}
+        snapshot['_id'] = row['deluge_torrent_id']
+        return snapshot
 
-    def all_user_torrents(self, tg_user_id: int, include_common=True, limit: int = 20, offset: int = 0):
+    @timed(REPOSITORY_QUERY_SECONDS)
+    def user_torrents_page(self, tg_user_id: int, limit: int, cursor: Optional[Tuple[float, int]] = None,
+                           backward=False, include_common=True) -> List[sqlite3.Row]:
+        """
+        Keyset page of user torrents ordered by (sort_time, id) descending.
+
+        `cursor` is (sort_time, id) of the row the page starts after, or before when `backward`.
+        """
         assert limit > 0, "negative limit"
-        c = self.conn.cursor()
-        r = c.execute(f"SELECT id, create_time, last_update_time, tg_user_id, deluge_torrent_id, deluge_torrent_status "
+        user_ids = [tg_user_id]
+        if include_common and tg_user_id != COMMON_FOR_ALL_TG_USER_ID:
+            user_ids.append(COMMON_FOR_ALL_TG_USER_ID)
+        comparison, order = ('>', 'ASC') if backward else ('<', 'DESC')
+        rows = []
+        # a query per user walks the (tg_user_id, sort_time, id) index without sorting
+        for user_id in user_ids:
+            c = self.conn.cursor()
+            c.execute(f"SELECT {self._TORRENT_COLUMNS} "
                       f"FROM {self._TORRENT_TABLE} "
-                      f"WHERE tg_user_id = {tg_user_id} "
-                      f"{'or tg_user_id = {}'.format(COMMON_FOR_ALL_TG_USER_ID) if include_common else ''} "
-                      f"ORDER BY create_time DESC "
-                      f"LIMIT {limit} "
-                      f"OFFSET {offset} ")
-        return c.fetchmany(limit)
+                      f"WHERE tg_user_id = ? "
+                      f"{f'AND (sort_time, id) {comparison} (?, ?) ' if cursor else ''}"
+                      f"ORDER BY sort_time {order}, id {order} "
+                      f"LIMIT ?",
+                      (user_id, *(cursor or ()), limit))
+            rows.extend(c.fetchall())
+        rows.sort(key=lambda row: (row['sort_time'], row['id']), reverse=not backward)
+        rows = rows[:limit]
+        if backward:
+            rows.reverse()
+        return rows
 
+    @timed(REPOSITORY_QUERY_SECONDS)
     def not_downloaded_torrents(self):
         c = self.conn.cursor()
         r = c.execute(f"SELECT tg_user_id, deluge_torrent_id, deluge_torrent_status FROM {self._TORRENT_TABLE} "
-                      f"WHERE deluge_torrent_status IS NOT '{TorrentStatus.DOWNLOADED}'")
+                      f"WHERE deluge_torrent_status != '{TorrentStatus.DOWNLOADED}'")
+        return c.fetchall()
+
+    @timed(REPOSITORY_QUERY_SECONDS)
+    def torrents_by_deluge_id(self, deluge_torrent_id: str):
+        c = self.conn.cursor()
+        c.execute(f"SELECT tg_user_id, deluge_torrent_id, deluge_torrent_status FROM {self._TORRENT_TABLE} "
+                  f"WHERE deluge_torrent_id = ?", (deluge_torrent_id,))
         return c.fetchall()
 
+    @timed(REPOSITORY_QUERY_SECONDS)
     def last_torrent(self, tg_user_id: int):
         c = self.conn.cursor()
-        r = c.execute(f"SELECT id, create_time, last_update_time, tg_user_id, deluge_torrent_id, deluge_torrent_status "
+        r = c.execute(f"SELECT {self._TORRENT_COLUMNS} "
                       f"FROM {self._TORRENT_TABLE} "
                       f"WHERE tg_user_id = {tg_user_id} "
                       "ORDER BY create_time DESC "
                       "LIMIT 1")
         return c.fetchone()
 
+    @timed(REPOSITORY_QUERY_SECONDS)
     def create_cache(self, key, value, ttl_seconds=60 * 60 * 24 * 30, override_on_exist=False) -> None:
-        x = (key, value, datetime.utcnow().isoformat(), ttl_seconds)
+        now = datetime.utcnow()
+        expires_at = int(time.time()) + ttl_seconds
+        x = (key, value, now.isoformat(), ttl_seconds, expires_at)
         with self.conn:
             self.conn.execute(
                 f"INSERT {'OR REPLACE' if override_on_exist else ''} INTO {self._CACHE_TABLE} "
-                f"(key, value, create_time, ttl_seconds) VALUES (?,?,?,?)",
+                f"(key, value, create_time, ttl_seconds, expires_at) VALUES (?,?,?,?,?)",
                 x)
+        self._memory_cache.put(key, dict(zip(('key', 'value', 'create_time', 'ttl_seconds', 'expires_at'), x)))
 
+    @timed(REPOSITORY_QUERY_SECONDS)
     def get_cache(self, key) -> dict:
+        now = int(time.time())
+        cached = self._memory_cache.get(key)
+        if cached and cached['expires_at'] > now:
+            return cached
         c = self.conn.cursor()
-        r = c.execute(f"SELECT key, value, create_time, ttl_seconds FROM {self._CACHE_TABLE} "
-                      f"WHERE key = '{key}'")
-        return c.fetchone()
+        c.execute(f"SELECT key, value, create_time, ttl_seconds, expires_at FROM {self._CACHE_TABLE} "
+                  f"WHERE key = ? AND expires_at > ?", (key, now))
+        row = c.fetchone()
+        if row:
+            row = dict(row)
+            self._memory_cache.put(key, row)
+        return row
 
+    @timed(REPOSITORY_QUERY_SECONDS)
     def delete_expired_cache(self) -> int:
+        now = int(time.time())
+        self._memory_cache.remove_if(lambda v: v['expires_at'] <= now)
+        deleted = 0
+        # small batches don't hold the write lock for long
+        while True:
+            with self.conn:
+                c = self.conn.execute(
+                    f"DELETE FROM {self._CACHE_TABLE} WHERE rowid IN "
+                    f"(SELECT rowid FROM {self._CACHE_TABLE} WHERE expires_at <= ? LIMIT ?)",
+                    (now, self._DELETE_EXPIRED_CACHE_BATCH_SIZE))
+            deleted += c.rowcount
+            if c.rowcount < self._DELETE_EXPIRED_CACHE_BATCH_SIZE:
+                return deleted
+
+    @timed(REPOSITORY_QUERY_SECONDS)
+    def create_torrent_file(self, data: bytes, ttl_seconds=60 * 60 * 24 * 30) -> str:
+        """
+        Stores .torrent content once per sha256, returns the sha256 hex. The oldest files are evicted
+        when the store exceeds `torrent_files_max_bytes`.
+        """
+        file_sha256 = sha256(data).hexdigest()
         with self.conn:
             self.conn.execute(
-                f"DELETE FROM {self._CACHE_TABLE} "
-                f"WHERE strftime('%s',create_time) + ttl_seconds - strftime('%s','now')  < 0")
-            return self.conn.total_changes
+                f"INSERT INTO {self._TORRENT_FILE_TABLE} (sha256, data, size, expires_at) VALUES (?,?,?,?) "
+                f"ON CONFLICT(sha256) DO UPDATE SET expires_at = MAX(expires_at, excluded.expires_at)",
+                (file_sha256, sqlite3.Binary(data), len(data), int(time.time()) + ttl_seconds))
+            total_size = self.conn.execute(f"SELECT TOTAL(size) FROM {self._TORRENT_FILE_TABLE}").fetchone()[0]
+            for row in self.conn.execute(f"SELECT sha256, size FROM {self._TORRENT_FILE_TABLE} "
+                                         f"ORDER BY expires_at").fetchall():
+                if total_size <= self._torrent_files_max_bytes or row['sha256'] == file_sha256:
+                    break
+                self.conn.execute(f"DELETE FROM {self._TORRENT_FILE_TABLE} WHERE sha256 = ?", (row['sha256'],))
+                total_size -= row['size']
+        return file_sha256
+
+    @timed(REPOSITORY_QUERY_SECONDS)
+    def get_torrent_file(self, file_sha256: str) -> Optional[bytes]:
+        c = self.conn.cursor()
+        c.execute(f"SELECT data FROM {self._TORRENT_FILE_TABLE} WHERE sha256 = ? AND expires_at > ?",
+                  (file_sha256, int(time.time())))
+        row = c.fetchone()
+        return bytes(row['data']) if row else None
+
+    @timed(REPOSITORY_QUERY_SECONDS)
+    def delete_expired_torrent_files(self) -> int:
+        with self.conn:
+            c = self.conn.execute(f"DELETE FROM {self._TORRENT_FILE_TABLE} WHERE expires_at <= ?",
+                                  (int(time.time()),))
+            return c.rowcount
+
+    def memory_cache_stats(self) -> dict:
+        return dict(hits=self._memory_cache.hits, misses=self._memory_cache.misses)
 
     def disconnect(self):
-        self.conn.close()
+        if self._shared_conn is not None:
+            self._shared_conn.close()
+        with self._connections_lock:
+            for _, conn in self._connections:
+                conn.close()
+            self._connections = []
+
+
+class _LruDict:
+
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key) -> Optional[dict]:
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return value
+
+    def put(self, key, value: dict):
+        if self._max_size <= 0:
+            return
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self._max_size:
+                self._items.popitem(last=False)
+
+    def remove_if(self, predicate: Callable[[dict], bool]):
+        with self._lock:
+            for key in [k for k, v in self._items.items() if predicate(v)]:
+                del self._items[key]
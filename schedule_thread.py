@@ -1,25 +1,87 @@
+import logging
 import threading
 import time
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from traceback import format_exc
+from typing import List, Dict, Optional
 
 from cron_jobs import CronJob
 from safe_schedule import SafeScheduler
 
 
+@dataclass
+class CronJobStats:
+    runs: int = 0
+    failures: int = 0
+    # runs skipped because the previous run of the job was still in progress
+    overruns: int = 0
+    running: bool = False
+    last_duration_seconds: float = 0.0
+    last_run_time: Optional[datetime] = None
+
+
 class ScheduleThread(threading.Thread):
 
-    def __init__(self, cron_jobs: List[CronJob]):
-        super().__init__()
+    def __init__(self, cron_jobs: List[CronJob], max_workers: int = 3, jitter_seconds: int = 0):
+        super().__init__(name="schedule-thread")
         self._cron_jobs: List[CronJob] = cron_jobs
+        self._jitter_seconds = jitter_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cron-job")
+        self._stats: Dict[str, CronJobStats] = {self._job_name(j): CronJobStats() for j in cron_jobs}
+        self._stats_lock = threading.Lock()
         self.cease_continuous_run = threading.Event()
 
     def run(self):
         scheduler = SafeScheduler()
         for cron_job in self._cron_jobs:
-            scheduler.every(cron_job.interval_seconds()).seconds.do(cron_job.run)
+            interval_seconds = cron_job.interval_seconds()
+            job = scheduler.every(interval_seconds)
+            if self._jitter_seconds > 0:
+                # random interval in [interval, interval + jitter], jobs with the same interval don't fire together
+                job = job.to(interval_seconds + self._jitter_seconds)
+            job.seconds.do(self._submit, cron_job)
         while not self.cease_continuous_run.is_set():
             scheduler.run_pending()
-            time.sleep(1)
+            idle_seconds = scheduler.idle_seconds
+            # sleep until the next deadline, stop() wakes up immediately
+            self.cease_continuous_run.wait(max(idle_seconds, 0) if idle_seconds is not None else None)
+        self._executor.shutdown(wait=False)
 
     def stop(self):
         self.cease_continuous_run.set()
+
+    def stats(self) -> Dict[str, dict]:
+        with self._stats_lock:
+            return {name: asdict(s) for name, s in self._stats.items()}
+
+    def _submit(self, cron_job: CronJob):
+        stats = self._stats[self._job_name(cron_job)]
+        with self._stats_lock:
+            if stats.running:
+                stats.overruns += 1
+                logging.warning(f"Skip {self._job_name(cron_job)}, the previous run is still in progress")
+                return
+            stats.running = True
+        self._executor.submit(self._run_job, cron_job, stats)
+
+    def _run_job(self, cron_job: CronJob, stats: CronJobStats):
+        start_time = datetime.now()
+        start = time.monotonic()
+        failed = False
+        try:
+            cron_job.run()
+        except Exception:
+            failed = True
+            logging.error(format_exc())
+        with self._stats_lock:
+            stats.running = False
+            stats.runs += 1
+            stats.failures += 1 if failed else 0
+            stats.last_duration_seconds = time.monotonic() - start
+            stats.last_run_time = start_time
+
+    @staticmethod
+    def _job_name(cron_job: CronJob) -> str:
+        return type(cron_job).__name__
@@ -0,0 +1,122 @@
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+CacheKey = Tuple[str, Tuple[str, ...]]
+
+
+@dataclass
+class StatusCacheStats:
+    hits: int = 0
+    misses: int = 0
+    coalesced: int = 0
+    evictions: int = 0
+    loads: int = 0
+
+
+class _Flight:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: Optional[dict] = None
+        self.error: Optional[Exception] = None
+
+
+class TorrentStatusCache:
+    """
+    Short living snapshot of deluge torrent statuses keyed by torrent id and requested fields.
+
+    Bounded by `max_size` entries with LRU eviction. Concurrent callers asking for the same not cached
+    torrent wait for the single in-flight load instead of making own rpc call.
+    """
+
+    def __init__(self, ttl_seconds: float = 2, max_size: int = 10000):
+        self._ttl_seconds = ttl_seconds
+        self._max_size = max_size
+        self._entries: 'OrderedDict[CacheKey, Tuple[float, dict]]' = OrderedDict()
+        self._in_flight: Dict[CacheKey, _Flight] = dict()
+        self._lock = threading.Lock()
+        self._stats = StatusCacheStats()
+
+    def get_many(self, torrent_ids: Sequence[str], fields: Sequence[str],
+                 loader: Callable[[List[str]], Dict[str, dict]]) -> Dict[str, dict]:
+        """
+        Statuses by torrent id, `loader` is called once with ids which are neither cached nor loading.
+        Torrents unknown to deluge are absent in the result and never cached.
+        """
+        fields = tuple(fields)
+        result = dict()
+        to_load: List[str] = []
+        to_wait: List[Tuple[str, _Flight]] = []
+        now = time.monotonic()
+        with self._lock:
+            for torrent_id in dict.fromkeys(torrent_ids):
+                key = (torrent_id, fields)
+                entry = self._entries.get(key)
+                if entry and entry[0] > now:
+                    self._entries.move_to_end(key)
+                    result[torrent_id] = dict(entry[1])
+                    self._stats.hits += 1
+                elif key in self._in_flight:
+                    to_wait.append((torrent_id, self._in_flight[key]))
+                    self._stats.coalesced += 1
+                else:
+                    self._in_flight[key] = _Flight()
+                    to_load.append(torrent_id)
+                    self._stats.misses += 1
+
+        if to_load:
+            self._load(to_load, fields, loader, result)
+
+        for torrent_id, flight in to_wait:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            if flight.value is not None:
+                result[torrent_id] = dict(flight.value)
+        return result
+
+    def contains(self, torrent_id: str, fields: Sequence[str]) -> bool:
+        with self._lock:
+            entry = self._entries.get((torrent_id, tuple(fields)))
+            return entry is not None and entry[0] > time.monotonic()
+
+    def invalidate(self, torrent_id: str):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == torrent_id]:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return asdict(self._stats)
+
+    def _load(self, torrent_ids: List[str], fields: Tuple[str, ...],
+              loader: Callable[[List[str]], Dict[str, dict]], result: Dict[str, dict]):
+        try:
+            loaded = loader(torrent_ids)
+        except Exception as e:
+            with self._lock:
+                for torrent_id in torrent_ids:
+                    flight = self._in_flight.pop((torrent_id, fields))
+                    flight.error = e
+                    flight.done.set()
+            raise
+        expires_at = time.monotonic() + self._ttl_seconds
+        with self._lock:
+            self._stats.loads += 1
+            for torrent_id in torrent_ids:
+                key = (torrent_id, fields)
+                value = loaded.get(torrent_id)
+                if value is not None and self._ttl_seconds > 0:
+                    self._entries[key] = (expires_at, value)
+                    self._entries.move_to_end(key)
+                flight = self._in_flight.pop(key)
+                flight.value = value
+                flight.done.set()
+                if value is not None:
+                    result[torrent_id] = dict(value)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self._stats.evictions += 1
@@ -0,0 +1,195 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from dataclasses import dataclass, asdict
+from hashlib import sha1
+from typing import Deque, Dict, Optional, Tuple
+
+from telegram import Bot, InlineKeyboardMarkup
+from telegram.error import RetryAfter, BadRequest
+
+
+@dataclass
+class TelegramSenderStats:
+    queue_depth: int = 0
+    sent: int = 0
+    failed: int = 0
+    edits_merged: int = 0
+    edits_skipped: int = 0
+    retries_after_flood: int = 0
+    send_latency_seconds_total: float = 0.0
+    send_latency_seconds_max: float = 0.0
+
+
+class _Request:
+
+    def __init__(self, method: str, chat_id: int, kwargs: dict, edit_key: Optional[Tuple[int, int]] = None,
+                 content_hash: Optional[str] = None):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.edit_key = edit_key
+        self.content_hash = content_hash
+        self.enqueue_time = time.monotonic()
+        self.futures = [Future()]
+
+
+class TelegramSender(threading.Thread):
+    """
+    Single outbound queue in front of the Bot, keeps the bot under telegram flood limits.
+
+    Requests of one chat are sent in order, chats are served round-robin. A pending edit of a message
+    is replaced by a newer edit of the same message, and an edit with the already sent text and markup is skipped.
+    """
+    # https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+    _SENT_HASHES_MAX_SIZE = 10000
+    _CHATS_MAX_SIZE = 1000
+
+    def __init__(self, bot: Bot, messages_per_second: float = 25, chat_interval_seconds: float = 1):
+        super().__init__(name="telegram-sender", daemon=True)
+        self._bot = bot
+        self._global_interval_seconds = 1 / messages_per_second
+        self._chat_interval_seconds = chat_interval_seconds
+        self._condition = threading.Condition()
+        # round-robin order of chats with pending requests
+        self._chat_queues: 'OrderedDict[int, Deque[_Request]]' = OrderedDict()
+        self._chat_next_time: Dict[int, float] = dict()
+        self._global_next_time = 0.0
+        self._pending_edits: Dict[Tuple[int, int], _Request] = dict()
+        self._sent_hashes: 'OrderedDict[Tuple[int, int], str]' = OrderedDict()
+        self._stats = TelegramSenderStats()
+        self._stopped = False
+
+    def send_message(self, chat_id: int, text: str, **kwargs) -> Future:
+        return self._enqueue(_Request('send_message', chat_id, dict(chat_id=chat_id, text=text, **kwargs)))
+
+    def edit_message_text(self, chat_id: int, message_id: int, text: str,
+                          reply_markup: Optional[InlineKeyboardMarkup] = None, **kwargs) -> Future:
+        edit_key = (chat_id, message_id)
+        content_hash = self._content_hash(text, reply_markup)
+        request = _Request('edit_message_text', chat_id,
+                           dict(chat_id=chat_id, message_id=message_id, text=text, reply_markup=reply_markup,
+                                **kwargs),
+                           edit_key=edit_key, content_hash=content_hash)
+        with self._condition:
+            if self._sent_hashes.get(edit_key) == content_hash and edit_key not in self._pending_edits:
+                self._stats.edits_skipped += 1
+                request.futures[0].set_result(None)
+                return request.futures[0]
+            pending = self._pending_edits.get(edit_key)
+            if pending:
+                # the pending edit keeps its place in the queue, only the content is replaced
+                pending.kwargs = request.kwargs
+                pending.content_hash = content_hash
+                pending.futures.append(request.futures[0])
+                self._stats.edits_merged += 1
+                return request.futures[0]
+            self._pending_edits[edit_key] = request
+        return self._enqueue(request)
+
+    def stats(self) -> dict:
+        with self._condition:
+            self._stats.queue_depth = sum(len(q) for q in self._chat_queues.values())
+            return asdict(self._stats)
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            request = self._next_request()
+            if request is None:
+                return
+            self._send(request)
+
+    def _enqueue(self, request: _Request) -> Future:
+        with self._condition:
+            self._chat_queues.setdefault(request.chat_id, deque()).append(request)
+            self._condition.notify()
+        return request.futures[0]
+
+    def _next_request(self) -> Optional[_Request]:
+        with self._condition:
+            while not self._stopped:
+                now = time.monotonic()
+                wait_until = None
+                if self._global_next_time <= now:
+                    for chat_id in self._chat_queues:
+                        chat_next_time = self._chat_next_time.get(chat_id, 0)
+                        if chat_next_time <= now:
+                            queue = self._chat_queues[chat_id]
+                            request = queue.popleft()
+                            if queue:
+                                self._chat_queues.move_to_end(chat_id)
+                            else:
+                                del self._chat_queues[chat_id]
+                            if request.edit_key:
+                                self._pending_edits.pop(request.edit_key, None)
+                                # remembered before sending, a newer edit with the in-flight content is skipped
+                                self._remember_sent_hash(request)
+                            self._global_next_time = now + self._global_interval_seconds
+                            self._chat_next_time[chat_id] = now + self._chat_interval_seconds
+                            return request
+                        wait_until = chat_next_time if wait_until is None else min(wait_until, chat_next_time)
+                else:
+                    wait_until = self._global_next_time
+                self._condition.wait(wait_until - now if wait_until is not None else None)
+                self._forget_idle_chats()
+            return None
+
+    def _forget_idle_chats(self):
+        if len(self._chat_next_time) > self._CHATS_MAX_SIZE:
+            now = time.monotonic()
+            self._chat_next_time = {k: v for k, v in self._chat_next_time.items() if v > now}
+
+    def _remember_sent_hash(self, request: _Request):
+        self._sent_hashes[request.edit_key] = request.content_hash
+        self._sent_hashes.move_to_end(request.edit_key)
+        while len(self._sent_hashes) > self._SENT_HASHES_MAX_SIZE:
+            self._sent_hashes.popitem(last=False)
+
+    def _send(self, request: _Request):
+        while True:
+            try:
+                result = getattr(self._bot, request.method)(**request.kwargs)
+                break
+            except RetryAfter as e:
+                logging.warning(f"Telegram flood limit, retry {request.method} in {e.retry_after} seconds")
+                with self._condition:
+                    self._stats.retries_after_flood += 1
+                    self._global_next_time = time.monotonic() + e.retry_after
+                time.sleep(e.retry_after)
+            except BadRequest as e:
+                if 'message is not modified' in str(e).lower():
+                    result = None
+                    break
+                self._fail(request, e)
+                return
+            except Exception as e:
+                self._fail(request, e)
+                return
+        latency = time.monotonic() - request.enqueue_time
+        with self._condition:
+            self._stats.sent += 1
+            self._stats.send_latency_seconds_total += latency
+            self._stats.send_latency_seconds_max = max(self._stats.send_latency_seconds_max, latency)
+        for future in request.futures:
+            future.set_result(result)
+
+    def _fail(self, request: _Request, e: Exception):
+        logging.error(f"Telegram {request.method} to chat {request.chat_id} failed. {e}")
+        with self._condition:
+            self._stats.failed += 1
+            if request.edit_key and self._sent_hashes.get(request.edit_key) == request.content_hash:
+                del self._sent_hashes[request.edit_key]
+        for future in request.futures:
+            future.set_exception(e)
+
+    @staticmethod
+    def _content_hash(text: str, reply_markup: Optional[InlineKeyboardMarkup]) -> str:
+        markup_json = reply_markup.to_json() if reply_markup else ''
+        return sha1(f"{text}\0{markup_json}".encode()).hexdigest()
@@ -0,0 +1,143 @@
+import configparser
+import time
+from datetime import timedelta
+
+import pytest
+
+from deluge_cluster import DelugeCluster
+from deluge_events import DelugeEventListener, TorrentEventsHandler
+from repeated_task import RepeatedJobManager
+from repository import COMMON_FOR_ALL_TG_USER_ID, Repository, TorrentStatus
+from telegram_sender import TelegramSender
+from tools.fake_bot_api import FakeBotApi
+from tools.fake_deluge_daemon import FakeDelugeDaemon
+from torrent_status_notifier import TorrentStatusNotifier
+
+_LABEL_ID = 'deluge-telegram'
+_USER_ID = 100
+
+
+@pytest.fixture
+def daemon():
+    daemon = FakeDelugeDaemon().start()
+    yield daemon
+    daemon.stop()
+
+
+@pytest.fixture
+def deluge_service(daemon: FakeDelugeDaemon):
+    config = configparser.ConfigParser()
+    config.read_dict({'deluge': {'Host': daemon.host, 'Port': str(daemon.port),
+                                 'Username': 'deluge', 'Password': 'deluge',
+                                 'LabelEnable': 'true', 'LabelId': _LABEL_ID}})
+    deluge_service = DelugeCluster(config)
+    deluge_service.connect()
+    yield deluge_service
+    deluge_service.disconnect()
+
+
+@pytest.fixture
+def bot_api():
+    bot_api = FakeBotApi().start()
+    yield bot_api
+    bot_api.stop()
+
+
+@pytest.fixture
+def repository():
+    repository = Repository(':memory:')
+    yield repository
+    repository.disconnect()
+
+
+@pytest.fixture
+def handler(repository: Repository, deluge_service: DelugeCluster, bot_api: FakeBotApi):
+    telegram_sender = TelegramSender(bot_api.bot(), messages_per_second=1000, chat_interval_seconds=0)
+    telegram_sender.start()
+    delayed_jobs = RepeatedJobManager(max_workers=1, name="test-deluge-events-jobs")
+    delayed_jobs.start()
+    handler = TorrentEventsHandler(repository, deluge_service, TorrentStatusNotifier(repository, telegram_sender),
+                                   delayed_jobs)
+    handler._ADDED_TORRENT_CHECK_DELAY = timedelta(seconds=0)
+    yield handler
+    telegram_sender.stop()
+
+
+def wait_for(condition, timeout_seconds: float = 5) -> bool:
+    deadline = time.monotonic() + timeout_seconds
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+def statuses(repository: Repository, torrent_id: str) -> list:
+    return [t['deluge_torrent_status'] for t in repository.torrents_by_deluge_id(torrent_id)]
+
+
+def test_removed_torrent_deletes_not_downloaded_rows(daemon, repository, handler):
+    torrent_id = daemon.add_torrent('removed')
+    repository.create_torrent(_USER_ID, torrent_id)
+    daemon.torrents.pop(torrent_id)
+
+    handler.on_torrent_removed(torrent_id)
+
+    assert statuses(repository, torrent_id) == []
+
+
+def test_removed_torrent_keeps_downloaded_rows(daemon, repository, handler):
+    torrent_id = daemon.add_torrent('downloaded', state='Seeding', progress=100)
+    repository.create_torrent(_USER_ID, torrent_id)
+    repository.update_status(torrent_id, TorrentStatus.DOWNLOADED)
+    daemon.torrents.pop(torrent_id)
+
+    handler.on_torrent_removed(torrent_id)
+
+    assert statuses(repository, torrent_id) == [str(TorrentStatus.DOWNLOADED)]
+
+
+def test_removed_event_after_re_add_keeps_new_row(daemon, repository, handler):
+    # reload removes the torrent and adds it again, the removed event comes after the new row is created
+    torrent_id = daemon.add_torrent('re-added')
+    repository.create_torrent(_USER_ID, torrent_id)
+
+    handler.on_torrent_removed(torrent_id)
+
+    assert statuses(repository, torrent_id) == [str(TorrentStatus.CREATED)]
+
+
+def test_finished_torrent_is_downloaded_and_owner_notified(daemon, repository, handler, bot_api):
+    torrent_id = daemon.add_torrent('finished', state='Seeding', progress=100)
+    repository.create_torrent(_USER_ID, torrent_id)
+
+    handler.on_torrent_finished(torrent_id)
+
+    assert statuses(repository, torrent_id) == [str(TorrentStatus.DOWNLOADED)]
+    assert wait_for(lambda: any('finished' in m['text'] for m in bot_api.messages))
+
+
+def test_added_labeled_torrent_becomes_common(daemon, repository, handler):
+    torrent_id = daemon.add_torrent('labeled', label=_LABEL_ID)
+    from_state_torrent_id = daemon.add_torrent('from state', label=_LABEL_ID)
+
+    handler.on_torrent_added(from_state_torrent_id, True)
+    handler.on_torrent_added(torrent_id)
+
+    assert wait_for(lambda: repository.torrent_exist_by_deluge_id(torrent_id))
+    assert [t['tg_user_id'] for t in repository.torrents_by_deluge_id(torrent_id)] == [COMMON_FOR_ALL_TG_USER_ID]
+    assert not repository.torrent_exist_by_deluge_id(from_state_torrent_id)
+
+
+def test_listener_dispatches_daemon_events(daemon, deluge_service, repository, handler):
+    torrent_id = daemon.add_torrent('removed by user')
+    repository.create_torrent(_USER_ID, torrent_id)
+    listener = DelugeEventListener(deluge_service.daemons()['default'].create_client, handler.handlers())
+    listener.start()
+    try:
+        assert wait_for(lambda: daemon.calls.get('daemon.set_event_interest'))
+        deluge_service.delete_torrent(torrent_id)
+
+        assert wait_for(lambda: not repository.torrent_exist_by_deluge_id(torrent_id))
+    finally:
+        listener.stop()
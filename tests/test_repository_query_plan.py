@@ -0,0 +1,121 @@
+import sqlite3
+from typing import Callable, List
+
+import pytest
+
+from repository import Repository, TorrentStatus
+
+_TORRENT_ID = 'a' * 40
+_USER_ID = 100
+
+
+@pytest.fixture
+def repository():
+    # no memory cache, get_cache has to query the table
+    repository = Repository(':memory:', memory_cache_size=0)
+    repository.create_torrents(_USER_ID, [f'{i:040x}' for i in range(100)] + [_TORRENT_ID])
+    for i in range(100):
+        repository.create_cache(f'key_{i}', 'value', ttl_seconds=i)
+    yield repository
+    repository.disconnect()
+
+
+def executed_statements(repository: Repository, fn: Callable[[], object]) -> List[str]:
+    """
+    Statements run by `fn` with bound values, transaction control excluded.
+    """
+    statements = []
+    repository.conn.set_trace_callback(statements.append)
+    try:
+        fn()
+    finally:
+        repository.conn.set_trace_callback(None)
+    return [s for s in statements if s.split()[0].upper() in ('SELECT', 'UPDATE', 'DELETE', 'INSERT')]
+
+
+# partial index of not downloaded rows, its scan reads only them
+_PARTIAL_INDEXES = ('idx_torrents_not_downloaded',)
+
+
+def full_scans(conn: sqlite3.Connection, sql: str) -> List[str]:
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+    # 'SCAN torrents' reads every row, 'SCAN torrents USING COVERING INDEX' every index entry
+    return [row['detail'] for row in plan
+            if row['detail'].startswith(('SCAN torrents', 'SCAN cache'))
+            and not row['detail'].endswith(_PARTIAL_INDEXES)]
+
+
+@pytest.mark.parametrize('name, query', [
+    ('torrent_exist_by_deluge_id', lambda r: r.torrent_exist_by_deluge_id(_TORRENT_ID)),
+    ('update_status', lambda r: r.update_status(_TORRENT_ID, TorrentStatus.DOWNLOADING)),
+    ('delete_torrent', lambda r: r.delete_torrent(_TORRENT_ID)),
+    ('delete_not_downloaded_torrent', lambda r: r.delete_not_downloaded_torrent(_TORRENT_ID)),
+    ('not_downloaded_torrents', lambda r: r.not_downloaded_torrents()),
+    ('last_torrent', lambda r: r.last_torrent(_USER_ID)),
+    ('user_torrents_page', lambda r: r.user_torrents_page(_USER_ID, 5)),
+    ('user_torrents_page_cursor', lambda r: r.user_torrents_page(_USER_ID, 5, cursor=(1.0, 10))),
+    ('user_torrents_page_backward', lambda r: r.user_torrents_page(_USER_ID, 5, cursor=(1.0, 10), backward=True)),
+    ('get_cache', lambda r: r.get_cache('key_50')),
+    ('delete_expired_cache', lambda r: r.delete_expired_cache()),
+])
+def test_hot_query_has_no_full_scan(repository: Repository, name: str, query: Callable[[Repository], object]):
+    statements = executed_statements(repository, lambda: query(repository))
+    assert statements, f"{name} ran no statements"
+    for sql in statements:
+        assert full_scans(repository.conn, sql) == [], f"{name} scans the table: {sql}"
+
+
+# schema of the first release, before versioned migrations
+_BASELINE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS torrents (
+    id integer PRIMARY KEY,
+    create_time text NOT NULL,
+    last_update_time text NOT NULL,
+    tg_user_id integer NOT NULL,
+    deluge_torrent_id text NOT NULL,
+    deluge_torrent_status text NOT NULL ,
+    UNIQUE(tg_user_id,deluge_torrent_id) )
+    """,
+    """CREATE TABLE IF NOT EXISTS cache (
+    key text NOT NULL,
+    value text NOT NULL,
+    create_time text NOT NULL,
+    ttl_seconds integer NOT NULL)
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_key ON cache (key);",
+]
+
+
+def test_baseline_database_is_migrated(tmp_path):
+    db_file = str(tmp_path / 'db.sqlite3')
+    conn = sqlite3.connect(db_file)
+    with conn:
+        for sql in _BASELINE_SCHEMA:
+            conn.execute(sql)
+        conn.execute("INSERT INTO torrents (create_time, last_update_time, tg_user_id, deluge_torrent_id, "
+                     "deluge_torrent_status) VALUES ('2021-01-02T03:04:05', '2021-01-02T03:04:05', ?, ?, ?)",
+                     (_USER_ID, _TORRENT_ID, str(TorrentStatus.DOWNLOADING)))
+        conn.execute("INSERT INTO cache (key, value, create_time, ttl_seconds) "
+                     "VALUES ('key', 'value', '2021-01-02T03:04:05', 60)")
+    conn.close()
+
+    repository = Repository(db_file)
+    try:
+        assert repository.schema_version() == len(Repository._MIGRATIONS)
+        torrent = repository.last_torrent(_USER_ID)
+        assert torrent['deluge_torrent_id'] == _TORRENT_ID
+        assert torrent['sort_time'] == 1609556645.0
+        assert torrent['name'] is None and torrent['deluge_daemon'] is None
+        assert [t['deluge_torrent_id'] for t in repository.not_downloaded_torrents()] == [_TORRENT_ID]
+        expires_at = repository.conn.execute("SELECT expires_at FROM cache WHERE key = 'key'").fetchone()[0]
+        assert expires_at == 1609556645 + 60
+    finally:
+        repository.disconnect()
+
+    # a migrated database is opened without migrating again
+    repository = Repository(db_file)
+    try:
+        assert repository.schema_version() == len(Repository._MIGRATIONS)
+        assert repository.torrent_exist_by_deluge_id(_TORRENT_ID)
+    finally:
+        repository.disconnect()
@@ -0,0 +1,194 @@
+"""
+Offline benchmark of the bot against in-process fake deluge daemon and telegram Bot API.
+
+Runs the real DelugeCluster, Repository, cron jobs and TelegramSender, and prints one row per scenario.
+
+    python -m tools.benchmark --torrents 10000 --latency-ms 1 --format csv
+"""
+import argparse
+import configparser
+import csv
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+from cron_jobs import NotDownloadedTorrentsStatusCheckJob, ScanCommonTorrents
+from deluge_cluster import DelugeCluster
+from repository import Repository, TorrentStatus
+from telegram_sender import TelegramSender
+from torrent_renderer import TorrentLineRenderer
+from tools.fake_bot_api import FakeBotApi
+from tools.fake_deluge_daemon import FakeDelugeDaemon
+
+_LABEL_ID = 'deluge-telegram'
+_USER_ID = 100
+_RESULT_FIELDS = ['scenario', 'torrents', 'runs', 'total_seconds', 'mean_ms', 'p95_ms', 'rpc_calls', 'bot_calls']
+
+
+class Benchmark:
+
+    def __init__(self, torrents: int, latency_seconds: float, status_cache_ttl_seconds: float, db_dir: str):
+        self.torrents = torrents
+        self.daemon = FakeDelugeDaemon(latency_seconds=latency_seconds).start()
+        self.bot_api = FakeBotApi().start()
+        self._db_dir = db_dir
+        config = configparser.ConfigParser()
+        config.read_dict({'deluge': {'Host': self.daemon.host, 'Port': str(self.daemon.port),
+                                     'Username': 'deluge', 'Password': 'deluge',
+                                     'LabelEnable': 'true', 'LabelId': _LABEL_ID,
+                                     'StatusCacheTtlSeconds': str(status_cache_ttl_seconds)}})
+        self.deluge_service = DelugeCluster(config)
+        self.deluge_service.connect()
+        self.telegram_sender = TelegramSender(self.bot_api.bot(), messages_per_second=1000, chat_interval_seconds=0)
+        self.telegram_sender.start()
+        self.torrent_ids = self._create_torrents(torrents)
+        self.results: List[dict] = []
+
+    def _create_torrents(self, count: int) -> List[str]:
+        # every second torrent is finished, all are labeled like torrents added by the bot
+        now = time.time()
+        return [self.daemon.add_torrent(f'Synthetic.Torrent.{i:06d}.1080p',
+                                        state='Seeding' if i % 2 else 'Downloading',
+                                        progress=100.0 if i % 2 else 42.0, total_wanted=(i % 50 + 1) * 1024 ** 3,
+                                        label=_LABEL_ID, time_added=now - count + i)
+                for i in range(count)]
+
+    def repository(self, name: str) -> Repository:
+        db_file = os.path.join(self._db_dir, f'{name}.sqlite3')
+        if os.path.exists(db_file):
+            os.remove(db_file)
+        return Repository(db_file)
+
+    def measure(self, scenario: str, fn: Callable[[], None], runs: int = 1):
+        rpc_calls = sum(self.daemon.calls.values())
+        bot_calls = sum(self.bot_api.calls.values())
+        durations = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            fn()
+            durations.append(time.perf_counter() - start)
+        durations.sort()
+        self.results.append({
+            'scenario': scenario,
+            'torrents': self.torrents,
+            'runs': runs,
+            'total_seconds': round(sum(durations), 4),
+            'mean_ms': round(statistics.mean(durations) * 1000, 3),
+            'p95_ms': round(durations[min(int(runs * 0.95), runs - 1)] * 1000, 3),
+            'rpc_calls': sum(self.daemon.calls.values()) - rpc_calls,
+            'bot_calls': sum(self.bot_api.calls.values()) - bot_calls,
+        })
+
+    def status_check_tick(self):
+        repository = self.repository('status_check')
+        repository.create_torrents(_USER_ID, self.torrent_ids)
+        job = NotDownloadedTorrentsStatusCheckJob(repository, self.telegram_sender, self.deluge_service)
+        # the first tick marks finished torrents and queues their notifications, next ticks see only active ones
+        self.measure('status_check_first_tick', job.run)
+        self.measure('status_check_tick', job.run, runs=3)
+        repository.disconnect()
+
+    def list_page(self, pages: int):
+        # imported here, logging is configured by the benchmark before main.py configures its own
+        import main as bot
+        repository = self.repository('list_page')
+        repository.create_torrents(_USER_ID, self.torrent_ids)
+        for t in self.deluge_service.torrents_status([i for n, i in enumerate(self.torrent_ids) if n % 2]):
+            repository.update_status(t['_id'], TorrentStatus.DOWNLOADED, sort_time=t['time_added'])
+        repository.update_metadata(self.deluge_service.labeled_torrents())
+        # torrents_list_message of the /list handler, it reads the components from the bot application
+        bot.app = SimpleNamespace(repository=repository, deluge_service=self.deluge_service,
+                                  torrent_renderer=TorrentLineRenderer())
+        cursor = None
+
+        def load_page():
+            nonlocal cursor
+            reply_markup, _ = bot.torrents_list_message(_USER_ID, cursor=cursor)
+            buttons = [b for row in reply_markup.inline_keyboard for b in row] if reply_markup else []
+            next_data = [b.callback_data for b in buttons if b.callback_data.startswith(bot.NEXT_LIST_PREFIX)]
+            cursor = bot.list_cursor_from_callback_data(bot.NEXT_LIST_PREFIX, next_data[0]) if next_data else None
+
+        self.measure('list_page', load_page, runs=pages)
+        bot.app = None
+        repository.disconnect()
+
+    def scan_common_torrents(self):
+        repository = self.repository('scan_common')
+        job = ScanCommonTorrents(repository, self.deluge_service)
+        self.measure('scan_common_full', job.run)
+        self.measure('scan_common_incremental', job.run, runs=3)
+        repository.disconnect()
+
+    def add_burst(self, adds: int):
+        repository = self.repository('add_burst')
+        magnets = [f'magnet:?xt=urn:btih:{i:040x}&dn=burst-{i}' for i in range(adds)]
+        bulk_magnets = [f'magnet:?xt=urn:btih:{i + adds:040x}&dn=burst-{i}' for i in range(adds)]
+
+        def add_one_by_one():
+            # the single add path of handle_message
+            for magnet in magnets:
+                torrent_id = self.deluge_service.add_torrent_magnet(magnet)
+                self.deluge_service.torrent_name_by_id(torrent_id)
+                repository.create_torrent(_USER_ID, torrent_id, override_on_exist=True)
+                self.telegram_sender.send_message(chat_id=_USER_ID, text=f'Downloading {torrent_id}')
+            self.telegram_sender.send_message(chat_id=_USER_ID, text='done').result()
+
+        def add_bulk():
+            torrent_ids = [r for r in self.deluge_service.add_torrent_magnets(bulk_magnets) if isinstance(r, str)]
+            self.deluge_service.torrents_status(torrent_ids)
+            repository.create_torrents(_USER_ID, torrent_ids)
+            self.telegram_sender.send_message(chat_id=_USER_ID, text=f'Downloading {len(torrent_ids)}').result()
+
+        self.measure(f'add_burst_{adds}_sequential', add_one_by_one)
+        self.measure(f'add_burst_{adds}_bulk', add_bulk)
+        repository.disconnect()
+
+    def stop(self):
+        self.telegram_sender.stop()
+        self.deluge_service.disconnect()
+        self.bot_api.stop()
+        self.daemon.stop()
+
+
+def write_results(results: List[Dict], output_format: str, fields: List[str] = _RESULT_FIELDS):
+    if output_format == 'json':
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        writer = csv.DictWriter(sys.stdout, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--torrents', type=int, default=10000, help='synthetic torrents in the fake daemon')
+    parser.add_argument('--latency-ms', type=float, default=1, help='latency of every fake deluge rpc call')
+    parser.add_argument('--status-cache-ttl', type=float, default=0,
+                        help='status cache ttl, 0 makes every run pay for its rpc calls')
+    parser.add_argument('--pages', type=int, default=100, help='/list pages to load')
+    parser.add_argument('--adds', type=int, default=50, help='torrents in the add burst')
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory(prefix='deluge-telegram-benchmark-') as db_dir:
+        benchmark = Benchmark(args.torrents, args.latency_ms / 1000, args.status_cache_ttl, db_dir)
+        try:
+            benchmark.status_check_tick()
+            benchmark.list_page(args.pages)
+            benchmark.scan_common_torrents()
+            benchmark.add_burst(args.adds)
+        finally:
+            benchmark.stop()
+    write_results(benchmark.results, args.format)
+
+
+if __name__ == '__main__':
+    main()
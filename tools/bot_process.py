@@ -0,0 +1,77 @@
+import configparser
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from tools.fake_bot_api import FakeBotApi
+
+_MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+
+
+def unused_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(condition: Callable[[], object], timeout_seconds: float) -> bool:
+    deadline = time.monotonic() + timeout_seconds
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.005)
+    return False
+
+
+class BotProcess:
+    """
+    `main.py` in a subprocess, run from a temporary directory with a generated config.ini and a fresh database.
+
+    The bot talks to the fake Bot API and to the deluge daemon on `deluge_port`, `extra_config` sections
+    are merged over the generated ones.
+    """
+
+    def __init__(self, bot_api: FakeBotApi, deluge_port: int, user_ids: List[int],
+                 extra_config: Optional[Dict[str, Dict[str, str]]] = None):
+        self._config = configparser.ConfigParser()
+        self._config.optionxform = str
+        self._config.read_dict({
+            'deluge': {'Host': '127.0.0.1', 'Port': str(deluge_port), 'Username': 'deluge', 'Password': 'deluge',
+                       'LabelId': 'deluge-telegram', 'LabelEnable': 'true', 'TimeoutSeconds': '5'},
+            'telegram': {'Token': '1111:token', 'UserIds': ','.join(str(i) for i in user_ids),
+                         'BaseUrl': bot_api.base_url()},
+            'logging': {'Level': 'INFO'},
+        })
+        self._config.read_dict(extra_config or dict())
+        self._work_dir: Optional[tempfile.TemporaryDirectory] = None
+        self._process: Optional[subprocess.Popen] = None
+        self.start_time: Optional[float] = None
+        self.deluge_ready_time: Optional[float] = None
+
+    def start(self) -> 'BotProcess':
+        self._work_dir = tempfile.TemporaryDirectory(prefix='deluge-telegram-bot-')
+        with open(os.path.join(self._work_dir.name, 'config.ini'), 'w') as f:
+            self._config.write(f)
+        self.start_time = time.monotonic()
+        self._process = subprocess.Popen([sys.executable, _MAIN], cwd=self._work_dir.name,
+                                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        threading.Thread(target=self._read_log, name='bot-process-log', daemon=True).start()
+        return self
+
+    def wait_deluge_ready(self, timeout_seconds: float) -> bool:
+        return wait_for(lambda: self.deluge_ready_time, timeout_seconds)
+
+    def stop(self):
+        self._process.terminate()
+        self._process.wait(timeout=10)
+        self._work_dir.cleanup()
+
+    def _read_log(self):
+        for line in self._process.stderr:
+            if 'Deluge is connected' in line and self.deluge_ready_time is None:
+                self.deluge_ready_time = time.monotonic()
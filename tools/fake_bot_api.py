@@ -0,0 +1,133 @@
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs
+
+from telegram import Bot
+
+
+class FakeBotApi:
+    """
+    In-process stand-in of the telegram Bot API, answers the methods the bot calls with minimal valid objects.
+
+    A `Bot` from `bot()` talks to it over http like to api.telegram.org. Calls are counted per method,
+    sent and edited texts are kept in `messages` and the monotonic time they were received in `message_times`.
+    Updates queued with `push_text_message` are returned to a polling `Updater` by getUpdates.
+    """
+    # getUpdates holds the request at most this long, an idle poll returns sooner than with the bot timeout
+    _MAX_POLL_SECONDS = 1
+    _BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'fake', 'username': 'fake_bot'}
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency_seconds: float = 0,
+                 method_latency_seconds: Optional[Dict[str, float]] = None):
+        self.latency_seconds = latency_seconds
+        # overrides `latency_seconds` of single methods, e.g. of getUpdates only
+        self.method_latency_seconds = method_latency_seconds or dict()
+        self.calls: Dict[str, int] = dict()
+        self.messages: List[dict] = []
+        self.message_times: List[float] = []
+        self._message_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+        self._updates: List[dict] = []
+        self._lock = threading.Lock()
+        self._updates_changed = threading.Condition(self._lock)
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are separate writes, nagle would hold the body until the delayed ack
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                method = self.path.rstrip('/').rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    params = json.loads(body or b'{}')
+                else:
+                    params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+                response = json.dumps(api._call(method, params)).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.host, self.port = self._server.server_address
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-bot-api', daemon=True)
+
+    def start(self) -> 'FakeBotApi':
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def bot(self, token: str = '1111:token') -> Bot:
+        return Bot(token, base_url=self.base_url())
+
+    def base_url(self) -> str:
+        return f'http://{self.host}:{self.port}/bot'
+
+    def text_message(self, chat_id: int, user_id: int, text: str) -> dict:
+        """
+        A private text message of the user, commands like `/list` get their bot_command entity.
+        """
+        message = {'message_id': next(self._message_ids), 'date': int(time.time()), 'text': text,
+                   'chat': {'id': chat_id, 'type': 'private'},
+                   'from': {'id': user_id, 'is_bot': False, 'first_name': 'user'}}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split(' ', 1)[0])}]
+        return message
+
+    def push_text_message(self, chat_id: int, user_id: int, text: str) -> int:
+        """
+        Queues the `text_message` update for getUpdates.
+        """
+        message = self.text_message(chat_id, user_id, text)
+        with self._updates_changed:
+            update_id = next(self._update_ids)
+            self._updates.append({'update_id': update_id, 'message': message})
+            self._updates_changed.notify_all()
+        return update_id
+
+    def _get_updates(self, params: dict) -> List[dict]:
+        offset = int(params.get('offset') or 0)
+        timeout = min(float(params.get('timeout') or 0), self._MAX_POLL_SECONDS)
+        with self._updates_changed:
+            # a poll with offset confirms all earlier updates
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            self._updates_changed.wait_for(lambda: self._updates, timeout=timeout)
+            return list(self._updates[:int(params.get('limit') or 100)])
+
+    def _call(self, method: str, params: dict) -> dict:
+        latency_seconds = self.method_latency_seconds.get(method, self.latency_seconds)
+        if latency_seconds:
+            time.sleep(latency_seconds)
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getMe':
+            return {'ok': True, 'result': self._BOT_USER}
+        if method in ('sendMessage', 'editMessageText'):
+            message_id = int(params['message_id']) if 'message_id' in params else next(self._message_ids)
+            message = {'message_id': message_id, 'date': int(time.time()), 'text': params.get('text', ''),
+                       'chat': {'id': int(params['chat_id']), 'type': 'private'}, 'from': self._BOT_USER}
+            with self._lock:
+                self.messages.append(message)
+                self.message_times.append(time.monotonic())
+            return {'ok': True, 'result': message}
+        if method == 'getUpdates':
+            return {'ok': True, 'result': self._get_updates(params)}
+        if method in ('answerCallbackQuery', 'deleteWebhook', 'setWebhook'):
+            return {'ok': True, 'result': True}
+        return {'ok': False, 'error_code': 404, 'description': f'Not Found: method {method} is not faked'}
@@ -0,0 +1,276 @@
+import base64
+import logging
+import os
+import socketserver
+import ssl
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from typing import Dict, List, Optional
+
+from deluge_client.rencode import dumps, loads
+
+from infohash import magnet_infohash, torrent_file_infohash
+
+RPC_RESPONSE = 1
+RPC_ERROR = 2
+RPC_EVENT = 3
+
+_PROTOCOL_VERSION = 1
+_MESSAGE_HEADER_SIZE = 5
+
+
+class FakeDelugeDaemon:
+    """
+    In-process stand-in of the Deluge 2 daemon, speaking the same TLS + rencode protocol as `deluge-client`.
+
+    Keeps torrents in memory, answers the rpc methods used by DelugeService, and pushes events
+    to every session which called `daemon.set_event_interest`. Needs the `openssl` binary for a self-signed cert.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency_seconds: float = 0,
+                 free_space_bytes: int = 1024 ** 4):
+        self.torrents: Dict[str, dict] = dict()
+        self.labels: List[str] = []
+        self.config = dict()
+        self.latency_seconds = latency_seconds
+        self.free_space_bytes = free_space_bytes
+        self.calls: Dict[str, int] = dict()
+        self._lock = threading.Lock()
+        self._sessions: List['_Session'] = []
+        self._cert_dir = tempfile.TemporaryDirectory(prefix='fake-deluge-')
+        self._ssl_context = self._create_ssl_context(self._cert_dir.name)
+        daemon = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                session = _Session(daemon, daemon._ssl_context.wrap_socket(self.request, server_side=True))
+                with daemon._lock:
+                    daemon._sessions.append(session)
+                try:
+                    session.serve()
+                finally:
+                    with daemon._lock:
+                        daemon._sessions.remove(session)
+
+        self._server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.host, self.port = self._server.server_address
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-deluge-daemon', daemon=True)
+
+    def start(self) -> 'FakeDelugeDaemon':
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        with self._lock:
+            for session in self._sessions:
+                session.close()
+        self._cert_dir.cleanup()
+
+    def add_torrent(self, name: str, state: str = 'Downloading', progress: float = 0.0, total_wanted: int = 1024,
+                    label: str = '', torrent_id: Optional[str] = None, time_added: Optional[float] = None) -> str:
+        torrent_id = torrent_id or uuid.uuid4().hex + uuid.uuid4().hex[:8]
+        with self._lock:
+            self.torrents[torrent_id] = {
+                'name': name,
+                'state': state,
+                'progress': progress,
+                'total_wanted': total_wanted,
+                'total_done': int(total_wanted * progress / 100),
+                'time_added': time_added if time_added is not None else time.time(),
+                'completed_time': 0,
+                'label': label,
+            }
+        return torrent_id
+
+    def emit(self, event_name: str, *args):
+        with self._lock:
+            sessions = [s for s in self._sessions if event_name in s.event_interest]
+        for session in sessions:
+            session.send((RPC_EVENT, event_name, args))
+
+    # deluge rpc methods, names match 'component.method' with '.' replaced by '_'
+
+    def daemon_info(self):
+        return '2.0.3'
+
+    def daemon_login(self, username, password, client_version=None):
+        return 10
+
+    def core_add_torrent_magnet(self, uri, options):
+        return self._add(uri, torrent_id=magnet_infohash(uri))
+
+    def core_add_torrent_file(self, filename, filedump, options):
+        torrent_id = torrent_file_infohash(base64.b64decode(filedump))
+        return self._add(filedump, name=os.path.splitext(filename)[0], torrent_id=torrent_id)
+
+    def core_remove_torrent(self, torrent_id, remove_data):
+        with self._lock:
+            if self.torrents.pop(torrent_id, None) is None:
+                raise _RemoteError('InvalidTorrentError', 'torrent_id not in session')
+        self.emit('TorrentRemovedEvent', torrent_id)
+        return True
+
+    def core_get_torrent_status(self, torrent_id, keys):
+        with self._lock:
+            torrent = self.torrents.get(torrent_id)
+            return self._fields(torrent, keys) if torrent else {}
+
+    def core_get_torrents_status(self, filter_dict, keys):
+        ids = filter_dict.get('id')
+        ids = set([ids] if isinstance(ids, str) else ids) if ids is not None else None
+        label = filter_dict.get('label')
+        states = filter_dict.get('state')
+        states = set([states] if isinstance(states, str) else states) if states is not None else None
+        with self._lock:
+            return {torrent_id: self._fields(t, keys) for torrent_id, t in self.torrents.items()
+                    if (ids is None or torrent_id in ids) and (label is None or t['label'] == label)
+                    and (states is None or t['state'] in states)}
+
+    def core_get_free_space(self, path=None):
+        return self.free_space_bytes
+
+    def core_set_config(self, config):
+        self.config.update(config)
+
+    def label_add(self, label_id):
+        if label_id in self.labels:
+            raise _RemoteError('Exception', 'Label already exists')
+        self.labels.append(label_id)
+
+    def label_remove(self, label_id):
+        if label_id not in self.labels:
+            raise _RemoteError('Exception', 'Unknown Label')
+        self.labels.remove(label_id)
+
+    def label_get_labels(self):
+        return list(self.labels)
+
+    def label_set_torrent(self, torrent_id, label_id):
+        with self._lock:
+            self.torrents[torrent_id]['label'] = label_id
+
+    def _add(self, payload, name: Optional[str] = None, torrent_id: Optional[str] = None) -> str:
+        # the real infohash when the payload has one, like deluge does
+        torrent_id = torrent_id or uuid.uuid5(uuid.NAMESPACE_URL, str(payload)).hex + '00000000'
+        with self._lock:
+            if torrent_id in self.torrents:
+                raise _RemoteError('AddTorrentError', f'Torrent already in session ({torrent_id}).')
+        self.add_torrent(name or f'torrent-{torrent_id[:8]}', torrent_id=torrent_id)
+        self.emit('TorrentAddedEvent', torrent_id, False)
+        return torrent_id
+
+    @staticmethod
+    def _fields(torrent: dict, keys) -> dict:
+        return {k: torrent.get(k) for k in keys} if keys else dict(torrent)
+
+    @staticmethod
+    def _create_ssl_context(cert_dir: str) -> ssl.SSLContext:
+        cert_file = os.path.join(cert_dir, 'cert.pem')
+        key_file = os.path.join(cert_dir, 'key.pem')
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                        '-subj', '/CN=fake-deluge', '-keyout', key_file, '-out', cert_file],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert_file, key_file)
+        return context
+
+
+class _RemoteError(Exception):
+
+    def __init__(self, exception_type: str, message: str):
+        super().__init__(message)
+        self.exception_type = exception_type
+        self.message = message
+
+
+class _Session:
+
+    def __init__(self, daemon: FakeDelugeDaemon, sock: ssl.SSLSocket):
+        self.event_interest = set()
+        self._daemon = daemon
+        self._socket = sock
+        self._send_lock = threading.Lock()
+        self._buffer = bytearray()
+
+    def serve(self):
+        try:
+            while True:
+                message, framed = self._read_message()
+                if message is None:
+                    return
+                # deluge-client probes the protocol with three framings of 'daemon.info', answer only protocol 1
+                if not framed:
+                    continue
+                for request_id, method, args, kwargs in loads(message, decode_utf8=True):
+                    self._daemon.calls[method] = self._daemon.calls.get(method, 0) + 1
+                    self.send(self._call(request_id, method, args, kwargs))
+        except (OSError, ssl.SSLError):
+            return
+
+    def send(self, message: tuple):
+        data = zlib.compress(dumps(message))
+        with self._send_lock:
+            try:
+                self._socket.sendall(struct.pack('!BI', _PROTOCOL_VERSION, len(data)) + data)
+            except OSError:
+                pass
+
+    def close(self):
+        try:
+            self._socket.close()
+        except OSError:
+            pass
+
+    def _call(self, request_id, method: str, args, kwargs) -> tuple:
+        if self._daemon.latency_seconds:
+            time.sleep(self._daemon.latency_seconds)
+        if method == 'daemon.set_event_interest':
+            self.event_interest.update(args[0])
+            return RPC_RESPONSE, request_id, True
+        fn = getattr(self._daemon, method.replace('.', '_'), None)
+        if fn is None:
+            return RPC_ERROR, request_id, 'WrappedException', (f'Unknown method {method}',), {}, ''
+        try:
+            return RPC_RESPONSE, request_id, fn(*args, **kwargs)
+        except _RemoteError as e:
+            # the traceback of a real daemon ends with the exception line, DelugeService matches it
+            return RPC_ERROR, request_id, e.exception_type, (e.message,), {}, f'{e.exception_type}: {e.message}\n'
+        except Exception as e:
+            logging.exception(f'fake deluge daemon {method} failed')
+            return RPC_ERROR, request_id, type(e).__name__, (str(e),), {}, ''
+
+    def _read_message(self) -> (Optional[bytes], bool):
+        first = self._read(1)
+        if not first:
+            return None, False
+        if first[0] in (_PROTOCOL_VERSION, ord('D')):
+            header = first + self._read(_MESSAGE_HEADER_SIZE - 1)
+            length = struct.unpack('!I' if first[0] == _PROTOCOL_VERSION else '!i', header[1:])[0]
+            return zlib.decompress(self._read(length)), first[0] == _PROTOCOL_VERSION
+        # deluge 1 framing, a bare zlib stream
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(first)
+        while not decompressor.eof:
+            chunk = self._read(1)
+            if not chunk:
+                return None, False
+            data += decompressor.decompress(chunk)
+        return data, False
+
+    def _read(self, size: int) -> bytes:
+        while len(self._buffer) < size:
+            chunk = self._socket.recv(64 * 1024)
+            if not chunk:
+                break
+            self._buffer += chunk
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
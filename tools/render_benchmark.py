@@ -0,0 +1,43 @@
+"""
+Torrent list lines rendered per second by TorrentLineRenderer, cold (every line rendered) and warm (cached lines).
+
+    python -m tools.render_benchmark --torrents 1000 --rounds 20
+"""
+import argparse
+import time
+
+from torrent_renderer import TorrentLineRenderer
+
+
+def synthetic_torrents(count: int):
+    now = time.time()
+    return [{'_id': f'{i:040x}', 'name': f'Synthetic.Torrent.{i:06d}.1080p.[group]', 'state': 'Downloading',
+             'progress': i % 100 + 0.5, 'total_done': i * 1024 ** 2, 'total_wanted': 100 * 1024 ** 3,
+             'time_added': now - i * 3600} for i in range(count)]
+
+
+def lines_per_second(renderer: TorrentLineRenderer, torrents, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for t in torrents:
+            renderer.list_line(t)
+    return rounds * len(torrents) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--torrents', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+    torrents = synthetic_torrents(args.torrents)
+    # a cache smaller than one round never hits, every line is rendered again
+    cold = lines_per_second(TorrentLineRenderer(max_size=0), torrents, args.rounds)
+    warm_renderer = TorrentLineRenderer(max_size=args.torrents)
+    lines_per_second(warm_renderer, torrents, 1)
+    warm = lines_per_second(warm_renderer, torrents, args.rounds)
+    print(f"cold: {cold:,.0f} lines/s")
+    print(f"warm: {warm:,.0f} lines/s, {warm / cold:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Write throughput of the sqlite Repository, with the old rollback journal against WAL with and without write-behind.
+
+Every workload runs while another thread reads list pages in a loop, so the read rate shows how much
+the writes block readers. Use `--dir` on the disk of the bot, fsync on tmpfs costs nothing.
+
+    python -m tools.repository_benchmark --torrents 2000 --dir /var/lib/deluge-telegram --format csv
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+from typing import Callable, List
+
+from repository import Repository, TorrentStatus
+from tools.benchmark import write_results
+
+_USER_ID = 100
+_RESULT_FIELDS = ['config', 'workload', 'ops', 'seconds', 'ops_per_second', 'concurrent_reads_per_second']
+# name, journal mode, synchronous, write-behind
+_CONFIGS = [
+    ('rollback_full', 'DELETE', 'FULL', False),
+    ('wal_normal', 'WAL', 'NORMAL', False),
+    ('wal_normal_write_behind', 'WAL', 'NORMAL', True),
+]
+
+
+class RepositoryBenchmark:
+
+    def __init__(self, torrents: int, db_dir: str):
+        self._torrent_ids = [f'{i:040x}' for i in range(torrents)]
+        self._db_dir = db_dir
+        self.results: List[dict] = []
+
+    def run(self, name: str, journal_mode: str, synchronous: str, write_behind: bool):
+        db_file = os.path.join(self._db_dir, f'{name}.sqlite3')
+        repository = Repository(db_file, journal_mode=journal_mode, synchronous=synchronous,
+                                write_behind=write_behind)
+        repository.create_torrents(_USER_ID, self._torrent_ids)
+        statuses = [self._status(i, torrent_id) for i, torrent_id in enumerate(self._torrent_ids)]
+
+        def status_updates():
+            with repository.batch():
+                for torrent_id in self._torrent_ids:
+                    repository.update_status(torrent_id, TorrentStatus.DOWNLOADING)
+
+        def status_tick():
+            # NotDownloadedTorrentsStatusCheckJob: metadata of all torrents and the finished ones marked
+            with repository.batch():
+                repository.update_metadata(statuses)
+                for torrent_id in self._torrent_ids[::2]:
+                    repository.update_status(torrent_id, TorrentStatus.DOWNLOADED)
+
+        def cache_writes():
+            for torrent_id in self._torrent_ids:
+                repository.create_cache(torrent_id, torrent_id, override_on_exist=True)
+
+        self._measure(name, 'status_updates', len(self._torrent_ids), status_updates, repository)
+        self._measure(name, 'status_tick', len(self._torrent_ids) * 3 // 2, status_tick, repository)
+        self._measure(name, 'cache_writes', len(self._torrent_ids), cache_writes, repository)
+        repository.disconnect()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_file + suffix):
+                os.remove(db_file + suffix)
+
+    def _measure(self, config: str, workload: str, ops: int, fn: Callable[[], None], repository: Repository):
+        stop = threading.Event()
+        reads = 0
+
+        def read_loop():
+            nonlocal reads
+            while not stop.is_set():
+                repository.user_torrents_page(_USER_ID, 5)
+                reads += 1
+
+        reader = threading.Thread(target=read_loop, name='benchmark-reader', daemon=True)
+        reader.start()
+        start = time.perf_counter()
+        fn()
+        seconds = time.perf_counter() - start
+        stop.set()
+        reader.join()
+        self.results.append({
+            'config': config,
+            'workload': workload,
+            'ops': ops,
+            'seconds': round(seconds, 4),
+            'ops_per_second': round(ops / seconds),
+            'concurrent_reads_per_second': round(reads / seconds),
+        })
+
+    @staticmethod
+    def _status(i: int, torrent_id: str) -> dict:
+        return {'_id': torrent_id, 'name': f'Synthetic.Torrent.{i:06d}', 'state': 'Downloading',
+                'progress': 42.0, 'total_wanted': 1024 ** 3, 'total_done': 430 * 1024 ** 2,
+                'time_added': time.time() - i, 'completed_time': 0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--torrents', type=int, default=2000, help='torrent rows written by every workload')
+    parser.add_argument('--dir', default=None, help='directory of the benchmark databases, a temp dir by default')
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='deluge-telegram-repository-', dir=args.dir) as db_dir:
+        benchmark = RepositoryBenchmark(args.torrents, db_dir)
+        for config in _CONFIGS:
+            benchmark.run(*config)
+    write_results(benchmark.results, args.format, _RESULT_FIELDS)
+
+
+if __name__ == '__main__':
+    main()
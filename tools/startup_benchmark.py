@@ -0,0 +1,78 @@
+"""
+Startup time of the bot, run as `main.py` in a subprocess against the fake deluge daemon and telegram Bot API.
+
+A `/last_torrent_status` command is queued before the start, the time to the first reply is the time to the
+first handled update. Scenarios: a fast daemon, a slow one (every rpc call has the latency) and an unreachable one.
+
+    python -m tools.startup_benchmark --slow-latency-ms 2000 --runs 3
+"""
+import argparse
+import statistics
+import time
+from typing import Dict, List, Optional
+
+from tools.benchmark import write_results
+from tools.bot_process import BotProcess, unused_port, wait_for
+from tools.fake_bot_api import FakeBotApi
+from tools.fake_deluge_daemon import FakeDelugeDaemon
+
+_USER_ID = 100
+_RESULT_FIELDS = ['scenario', 'runs', 'first_poll_ms', 'first_reply_ms', 'deluge_ready_ms']
+
+
+def run_once(deluge_port: int, wait_ready: bool, timeout_seconds: float) -> Dict[str, Optional[float]]:
+    bot_api = FakeBotApi().start()
+    bot_api.push_text_message(_USER_ID, _USER_ID, '/last_torrent_status')
+    bot = BotProcess(bot_api, deluge_port, [_USER_ID]).start()
+    try:
+        deadline = time.monotonic() + timeout_seconds
+        polled = wait_for(lambda: bot_api.calls.get('getUpdates'), deadline - time.monotonic())
+        first_poll = time.monotonic()
+        replied = wait_for(lambda: bot_api.messages, deadline - time.monotonic())
+        first_reply = time.monotonic()
+        if wait_ready:
+            bot.wait_deluge_ready(deadline - time.monotonic())
+    finally:
+        bot.stop()
+        bot_api.stop()
+    return {
+        'first_poll_ms': (first_poll - bot.start_time) * 1000 if polled else None,
+        'first_reply_ms': (first_reply - bot.start_time) * 1000 if replied else None,
+        'deluge_ready_ms': (bot.deluge_ready_time - bot.start_time) * 1000 if bot.deluge_ready_time else None,
+    }
+
+
+def measure(scenario: str, runs: int, deluge_port: int, wait_ready: bool, timeout_seconds: float) -> dict:
+    samples: List[Dict[str, Optional[float]]] = [run_once(deluge_port, wait_ready, timeout_seconds)
+                                                 for _ in range(runs)]
+    result = {'scenario': scenario, 'runs': runs}
+    for field in _RESULT_FIELDS[2:]:
+        values = [s[field] for s in samples if s[field] is not None]
+        # median of the runs, empty when it never happened within the timeout
+        result[field] = round(statistics.median(values), 1) if values else ''
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=3, help='bot starts per scenario')
+    parser.add_argument('--slow-latency-ms', type=float, default=2000, help='rpc latency of the slow daemon')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for a reply and readiness')
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv')
+    args = parser.parse_args()
+
+    results = []
+    daemon = FakeDelugeDaemon().start()
+    slow_daemon = FakeDelugeDaemon(latency_seconds=args.slow_latency_ms / 1000).start()
+    try:
+        results.append(measure('deluge_fast', args.runs, daemon.port, True, args.timeout))
+        results.append(measure('deluge_slow', args.runs, slow_daemon.port, True, args.timeout))
+        results.append(measure('deluge_unreachable', args.runs, unused_port(), False, args.timeout))
+    finally:
+        slow_daemon.stop()
+        daemon.stop()
+    write_results(results, args.format, _RESULT_FIELDS)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Peak memory of one .torrent upload, from the downloaded telegram file to the rpc argument.
+
+Compares the old pipeline (bytes copy + base64 str) with the current one (single bytearray + base64 bytes).
+Peak is measured with tracemalloc, which tracks python allocations, the bulk of the process RSS growth per upload.
+
+    python -m tools.upload_memory_benchmark --size-mb 10 --uploads 5
+"""
+import argparse
+import base64
+import tracemalloc
+from typing import Callable
+
+
+def old_pipeline(downloaded: bytearray):
+    file_bytes = bytes(downloaded)
+    return base64.b64encode(file_bytes).decode("utf-8")
+
+
+def new_pipeline(downloaded: bytearray):
+    return base64.b64encode(downloaded)
+
+
+def peak_bytes(pipeline: Callable[[bytearray], object], size_bytes: int) -> int:
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    # the download buffer is the part both pipelines share, it is counted too
+    downloaded = bytearray(size_bytes)
+    rpc_argument = pipeline(downloaded)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del rpc_argument, downloaded
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=float, default=10)
+    parser.add_argument('--uploads', type=int, default=5)
+    args = parser.parse_args()
+    size_bytes = int(args.size_mb * 1024 * 1024)
+    for name, pipeline in (('old', old_pipeline), ('new', new_pipeline)):
+        peaks = [peak_bytes(pipeline, size_bytes) for _ in range(args.uploads)]
+        peak = max(peaks)
+        print(f"{name}: peak {peak / 1024 / 1024:.1f} MiB per upload, {peak / size_bytes:.2f}x of the file size")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+Update-to-reply latency of the bot in polling and webhook mode under a steady rate of text messages.
+
+Runs `main.py` in a subprocess against the fake deluge daemon and telegram Bot API. In polling mode updates are
+queued in the fake Bot API for getUpdates, in webhook mode they are posted to the local listener like telegram
+does. The latency is from queuing/posting an update to the fake Bot API receiving the reply of the bot.
+
+    python -m tools.webhook_load_test --rates 50,200,500 --duration 5 --poll-latency-ms 50
+"""
+import argparse
+import http.client
+import json
+import queue
+import statistics
+import threading
+import time
+from itertools import count
+from typing import Dict, List
+
+from tools.benchmark import write_results
+from tools.bot_process import BotProcess, unused_port, wait_for
+from tools.fake_bot_api import FakeBotApi
+from tools.fake_deluge_daemon import FakeDelugeDaemon
+from webhook import SECRET_TOKEN_HEADER
+
+_SECRET_TOKEN = 'load-test-secret'
+_WEBHOOK_PATH = '/telegram'
+_FIRST_USER_ID = 1000
+_RESULT_FIELDS = ['mode', 'rate', 'sent', 'replied', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+
+
+class LoadTest:
+
+    def __init__(self, deluge_port: int, users: int, workers: int, poll_latency_seconds: float,
+                 sender_threads: int, timeout_seconds: float):
+        self._deluge_port = deluge_port
+        self._user_ids = list(range(_FIRST_USER_ID, _FIRST_USER_ID + users))
+        self._workers = workers
+        self._poll_latency_seconds = poll_latency_seconds
+        self._sender_threads = sender_threads
+        self._timeout_seconds = timeout_seconds
+
+    def run(self, mode: str, rate: float, duration_seconds: float) -> dict:
+        bot_api = FakeBotApi(method_latency_seconds={'getUpdates': self._poll_latency_seconds}).start()
+        webhook_port = unused_port()
+        # the sender must not be the bottleneck, telegram flood limits are not part of the test
+        extra_config = {'telegram': {'MessagesPerSecond': '100000', 'ChatMessageIntervalSeconds': '0'}}
+        if mode == 'webhook':
+            extra_config['webhook'] = {'Enable': 'true', 'Port': str(webhook_port), 'Path': _WEBHOOK_PATH,
+                                       'SecretToken': _SECRET_TOKEN, 'Workers': str(self._workers),
+                                       'Url': f'http://127.0.0.1:{webhook_port}{_WEBHOOK_PATH}'}
+        bot = BotProcess(bot_api, self._deluge_port, self._user_ids, extra_config).start()
+        try:
+            ready_method = 'setWebhook' if mode == 'webhook' else 'getUpdates'
+            if not bot.wait_deluge_ready(self._timeout_seconds) or \
+                    not wait_for(lambda: bot_api.calls.get(ready_method), self._timeout_seconds):
+                raise RuntimeError(f"bot in {mode} mode is not ready in {self._timeout_seconds} seconds")
+            sent_times = self._send(bot_api, mode, webhook_port, rate, duration_seconds)
+            sent = sum(len(times) for times in sent_times.values())
+            wait_for(lambda: len(bot_api.messages) >= sent, self._timeout_seconds)
+        finally:
+            bot.stop()
+            bot_api.stop()
+        latencies = self._latencies(bot_api, sent_times)
+        return self._result(mode, rate, sent, latencies)
+
+    def _send(self, bot_api: FakeBotApi, mode: str, webhook_port: int, rate: float, duration_seconds: float) \
+            -> Dict[int, List[float]]:
+        """
+        Sends updates on a fixed schedule, users round-robin, returns the send times by chat id.
+        """
+        total = int(rate * duration_seconds)
+        sent_times: Dict[int, List[float]] = {user_id: [] for user_id in self._user_ids}
+        # a chat is always sent by the same thread, so its updates arrive in order
+        queues = [queue.Queue() for _ in range(self._sender_threads)]
+        update_ids = count(1)
+
+        def send_loop(updates: queue.Queue):
+            connection = http.client.HTTPConnection('127.0.0.1', webhook_port) if mode == 'webhook' else None
+            while True:
+                item = updates.get()
+                if item is None:
+                    break
+                user_id, scheduled_time = item
+                time.sleep(max(scheduled_time - time.monotonic(), 0))
+                sent_times[user_id].append(time.monotonic())
+                if connection is None:
+                    bot_api.push_text_message(user_id, user_id, 'ping')
+                    continue
+                update = {'update_id': next(update_ids), 'message': bot_api.text_message(user_id, user_id, 'ping')}
+                connection.request('POST', _WEBHOOK_PATH, body=json.dumps(update),
+                                   headers={'Content-Type': 'application/json', SECRET_TOKEN_HEADER: _SECRET_TOKEN})
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    raise RuntimeError(f"webhook answered {response.status}")
+            if connection:
+                connection.close()
+
+        threads = [threading.Thread(target=send_loop, args=(q,), daemon=True) for q in queues]
+        for thread in threads:
+            thread.start()
+        start = time.monotonic() + 0.1
+        for i in range(total):
+            user_id = self._user_ids[i % len(self._user_ids)]
+            queues[user_id % len(queues)].put((user_id, start + i / rate))
+        for q in queues:
+            q.put(None)
+        for thread in threads:
+            thread.join()
+        return sent_times
+
+    @staticmethod
+    def _latencies(bot_api: FakeBotApi, sent_times: Dict[int, List[float]]) -> List[float]:
+        # replies of a chat come in the order of its updates
+        reply_times: Dict[int, List[float]] = dict()
+        for message, received_time in zip(bot_api.messages, bot_api.message_times):
+            reply_times.setdefault(message['chat']['id'], []).append(received_time)
+        latencies = []
+        for chat_id, times in sent_times.items():
+            latencies += [reply - sent for sent, reply in zip(times, reply_times.get(chat_id, []))]
+        return sorted(latencies)
+
+    @staticmethod
+    def _result(mode: str, rate: float, sent: int, latencies: List[float]) -> dict:
+        def percentile(p: float) -> float:
+            return round(latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000, 1)
+
+        result = {'mode': mode, 'rate': rate, 'sent': sent, 'replied': len(latencies)}
+        if latencies:
+            result.update(mean_ms=round(statistics.mean(latencies) * 1000, 1), p50_ms=percentile(0.5),
+                          p95_ms=percentile(0.95), p99_ms=percentile(0.99), max_ms=round(latencies[-1] * 1000, 1))
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rates', default='50,200,500', help='comma separated updates per second')
+    parser.add_argument('--duration', type=float, default=5, help='seconds of load per rate')
+    parser.add_argument('--users', type=int, default=50, help='chats sending updates round-robin')
+    parser.add_argument('--workers', type=int, default=4, help='webhook workers')
+    # sendMessage latency is left out, the single telegram sender thread would cap the reply rate of both modes
+    parser.add_argument('--poll-latency-ms', type=float, default=0,
+                        help='latency of getUpdates, like the round trip to api.telegram.org')
+    parser.add_argument('--sender-threads', type=int, default=8, help='load generator threads')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for readiness and replies')
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv')
+    args = parser.parse_args()
+
+    daemon = FakeDelugeDaemon().start()
+    load_test = LoadTest(daemon.port, args.users, args.workers, args.poll_latency_ms / 1000, args.sender_threads,
+                         args.timeout)
+    results = []
+    try:
+        for rate in [float(r) for r in args.rates.split(',')]:
+            for mode in ('polling', 'webhook'):
+                results.append(load_test.run(mode, rate, args.duration))
+    finally:
+        daemon.stop()
+    write_results(results, args.format, _RESULT_FIELDS)
+
+
+if __name__ == '__main__':
+    main()
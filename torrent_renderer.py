@@ -0,0 +1,106 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from datetime import datetime, date
+from functools import lru_cache
+from typing import Dict
+
+from telegram.utils import helpers
+
+from repository import TorrentStatus
+
+
+@lru_cache(maxsize=None)
+def emoji_map() -> Dict[TorrentStatus, str]:
+    # emoji loads its tables on import, it is imported on the first rendered line instead of at startup
+    from emoji import emojize
+    return {
+        TorrentStatus.CREATED: emojize(':arrow_down:', use_aliases=True),
+        TorrentStatus.DOWNLOADED: emojize(':white_check_mark:', use_aliases=True),
+        TorrentStatus.DOWNLOADING: emojize(':arrow_double_down:', use_aliases=True),
+        TorrentStatus.QUEUED: emojize(':back:', use_aliases=True),
+        TorrentStatus.MOVING: emojize(':soon:', use_aliases=True),
+        TorrentStatus.ERROR: emojize(':sos:', use_aliases=True),
+        TorrentStatus.UNKNOWN_STUB: emojize(':question:', use_aliases=True)
+    }
+
+
+@dataclass
+class RendererStats:
+    hits: int = 0
+    misses: int = 0
+
+
+def status_emoji(state: str, progress: float) -> str:
+    torrent_status = TorrentStatus.get_by_value_safe(state)
+    emojis = emoji_map()
+    if torrent_status is TorrentStatus.ERROR:
+        return emojis.get(TorrentStatus.ERROR)
+    elif progress >= 100 and torrent_status is TorrentStatus.MOVING:
+        return emojis.get(TorrentStatus.MOVING)
+    elif progress >= 100:
+        return emojis.get(TorrentStatus.DOWNLOADED)
+    elif progress > 0:
+        return emojis.get(TorrentStatus.DOWNLOADING)
+    elif progress == 0:
+        return emojis.get(TorrentStatus.CREATED)
+    return emojis.get(TorrentStatus.UNKNOWN_STUB)
+
+
+class TorrentLineRenderer:
+    """
+    Renders torrent snapshots, items of DelugeService.torrents_status, into MarkdownV2 lines.
+
+    List lines are kept in a bounded LRU keyed by everything the line shows, so a refresh of the list
+    escapes and humanizes only torrents which changed.
+    """
+
+    def __init__(self, max_size: int = 4096):
+        self._max_size = max_size
+        self._lines: 'OrderedDict[tuple, str]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = RendererStats()
+
+    def list_line(self, t: Dict) -> str:
+        progress = t.get('progress', -1.0)
+        # the line shows whole percents, and the added date relative to today
+        key = (t['_id'], t['name'], t['state'], int(progress), t['total_done'], t['total_wanted'], t['time_added'],
+               date.today().toordinal())
+        with self._lock:
+            line = self._lines.get(key)
+            if line is not None:
+                self._lines.move_to_end(key)
+                self._stats.hits += 1
+                return line
+            self._stats.misses += 1
+        line = self._render_list_line(t, progress)
+        with self._lock:
+            self._lines[key] = line
+            while len(self._lines) > self._max_size:
+                self._lines.popitem(last=False)
+        return line
+
+    @staticmethod
+    def status_line(t: Dict) -> str:
+        progress = t.get('progress', -1.0)
+        progress_message = ''
+        if 0 <= progress < 100:
+            progress_message = f" `{progress}%`"
+        return f"{status_emoji(t['state'], progress)}{helpers.escape_markdown(progress_message, version=2)} " \
+               f"`{helpers.escape_markdown(t['name'], version=2)}`"
+
+    def stats(self) -> dict:
+        with self._lock:
+            return asdict(self._stats)
+
+    @staticmethod
+    def _render_list_line(t: Dict, progress: float) -> str:
+        import humanize
+        if progress >= 100:
+            filex_size_progress = f"{humanize.naturalsize(t['total_wanted'])} {int(progress)}%"
+        else:
+            filex_size_progress = f"{humanize.naturalsize(t['total_done'])} / " \
+                                  f"{humanize.naturalsize(t['total_wanted'])} {int(progress)}%"
+        return f"{status_emoji(t['state'], progress)} **{helpers.escape_markdown(t['name'], version=2)}** \n " \
+               f"{helpers.escape_markdown(filex_size_progress, version=2)}, added " \
+               f"{humanize.naturaldate(datetime.fromtimestamp(t['time_added']))} \n"
@@ -0,0 +1,27 @@
+from typing import Optional
+
+from telegram import ParseMode
+
+from repository import Repository, TorrentStatus, COMMON_FOR_ALL_TG_USER_ID
+from telegram_sender import TelegramSender
+
+
+class TorrentStatusNotifier:
+    """
+    Applies a deluge torrent state to the local torrent row and notifies the owner about completed download.
+    """
+
+    def __init__(self, repository: Repository, telegram_sender: TelegramSender):
+        self._repository = repository
+        self._telegram_sender = telegram_sender
+
+    def apply(self, telegram_user_id: int, deluge_torrent_id: str, torrent_name: str, deluge_state: str,
+              sort_time: Optional[float] = None):
+        if str(deluge_state) == TorrentStatus.DOWNLOADED.value:
+            if telegram_user_id != COMMON_FOR_ALL_TG_USER_ID:
+                self._telegram_sender.send_message(chat_id=telegram_user_id,
+                                                   text=f"Download `{torrent_name}` completed",
+                                                   parse_mode=ParseMode.MARKDOWN)
+            self._repository.update_status(deluge_torrent_id, TorrentStatus.DOWNLOADED, sort_time=sort_time)
+        if str(deluge_state) == TorrentStatus.DOWNLOADING.value:
+            self._repository.update_status(deluge_torrent_id, TorrentStatus.DOWNLOADING, sort_time=sort_time)
@@ -0,0 +1,124 @@
+import hmac
+import json
+import logging
+import queue
+import threading
+from dataclasses import dataclass, asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher
+
+# https://core.telegram.org/bots/api#setwebhook
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+@dataclass
+class WebhookStats:
+    received: int = 0
+    rejected: int = 0
+    processed: int = 0
+    failed: int = 0
+
+
+class WebhookServer(threading.Thread):
+    """
+    Receives telegram updates pushed to `POST <path>` and processes them with a pool of workers.
+
+    Requests without the secret token set by setWebhook are rejected. An update is acknowledged as soon as
+    it is queued. Updates of one chat go to the same worker, so they are handled in order, while
+    different chats are handled in parallel.
+    """
+    _MAX_BODY_BYTES = 1024 * 1024
+
+    def __init__(self, host: str, port: int, path: str, secret_token: str, bot: Bot, dispatcher: Dispatcher,
+                 workers: int = 4):
+        super().__init__(name="webhook-server", daemon=True)
+        self._bot = bot
+        self._dispatcher = dispatcher
+        self._stats = WebhookStats()
+        self._stats_lock = threading.Lock()
+        self._queues: List[queue.Queue] = [queue.Queue() for _ in range(workers)]
+        self._workers = [threading.Thread(target=self._work, args=(q,), name=f"webhook-worker-{i}", daemon=True)
+                         for i, q in enumerate(self._queues)]
+        expected_token = secret_token.encode()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                if self.path.split('?')[0] != path:
+                    self._reply(404)
+                    return
+                token = (self.headers.get(SECRET_TOKEN_HEADER) or '').encode()
+                length = int(self.headers.get('Content-Length') or 0)
+                if not hmac.compare_digest(token, expected_token) or length > WebhookServer._MAX_BODY_BYTES:
+                    server._count('rejected')
+                    self.close_connection = True
+                    self._reply(403)
+                    return
+                try:
+                    server._enqueue(json.loads(self.rfile.read(length)))
+                except (ValueError, TypeError, AttributeError, KeyError) as e:
+                    logging.warning(f"Malformed webhook update. {e}")
+                    server._count('rejected')
+                    self._reply(400)
+                    return
+                self._reply(200)
+
+            def _reply(self, code: int):
+                self.send_response(code)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logging.debug(f"webhook {self.address_string()} {format % args}")
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+
+    def run(self):
+        for worker in self._workers:
+            worker.start()
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        for q in self._queues:
+            q.put(None)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            stats = asdict(self._stats)
+        stats['queue_depth'] = sum(q.qsize() for q in self._queues)
+        return stats
+
+    def _enqueue(self, update_data: dict):
+        update = Update.de_json(update_data, self._bot)
+        if update is None:
+            return
+        self._count('received')
+        chat = update.effective_chat
+        # updates without a chat, e.g. inline queries, are spread by update id
+        key = chat.id if chat else update_data.get('update_id', 0)
+        self._queues[hash(key) % len(self._queues)].put(update)
+
+    def _work(self, updates: queue.Queue):
+        while True:
+            update = updates.get()
+            if update is None:
+                return
+            try:
+                self._dispatcher.process_update(update)
+                self._count('processed')
+            except Exception as e:
+                self._count('failed')
+                logging.error(f"Webhook update {update.update_id} failed. {e}")
+
+    def _count(self, field: str):
+        with self._stats_lock:
+            setattr(self._stats, field, getattr(self._stats, field) + 1)